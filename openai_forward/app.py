@@ -1,13 +1,17 @@
+import zlib
 from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, Request, status
+from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 
 from . import __version__
 from .config.settings import (
     BENCHMARK_MODE,
+    FWD_KEY,
     RATE_LIMIT_BACKEND,
     RATE_LIMIT_STRATEGY,
     dynamic_request_rate_limit,
@@ -57,6 +61,20 @@ async def normalize_route(request: Request, call_next):
     return response
 
 
+def verify_admin_key(request: Request):
+    """
+    Raises:
+        HTTPException: Unless the request carries a level 0 forward key.
+    """
+    auth = request.headers.get("Authorization", "")
+    fk = auth[len("Bearer ") :] if auth.startswith("Bearer ") else ""
+    if FWD_KEY.get(fk) != 0:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="a level 0 forward key is required",
+        )
+
+
 @app.get(
     "/healthz",
     summary="Perform a Health Check",
@@ -67,6 +85,105 @@ def healthz(request: Request):
     return "OK"
 
 
+@app.get(
+    "/healthz/upstreams",
+    summary="Show the circuit breaker state of every upstream",
+    status_code=status.HTTP_200_OK,
+    dependencies=[Depends(verify_admin_key)],
+)
+def upstreams_healthz(request: Request):
+    return forward_manager.stats()
+
+
+@app.get(
+    "/healthz/cache",
+    summary="Show the counters of the cache database",
+    status_code=status.HTTP_200_OK,
+    dependencies=[Depends(verify_admin_key)],
+)
+def cache_healthz(request: Request):
+    from .cache.database import db_dict
+    from .cache.io import cache_io
+
+    info = db_dict.stats() if hasattr(db_dict, "stats") else {"items": len(db_dict)}
+    info["io"] = cache_io.stats()
+    return info
+
+
+@app.get(
+    "/admin/cache/stats",
+    summary="Show the hits, misses and bytes of the cache by route and model",
+    dependencies=[Depends(verify_admin_key)],
+)
+def cache_admin_stats(request: Request):
+    from .cache.admin import cache_index, cache_stats
+    from .cache.database import db_dict
+
+    return {
+        "items": len(db_dict),
+        "index_ready": cache_index.ready,
+        "routes": cache_stats.report(cache_index),
+    }
+
+
+@app.post(
+    "/admin/cache/invalidate",
+    summary="Delete the cache entries of a route and/or model, and/or older than some seconds",
+    dependencies=[Depends(verify_admin_key)],
+)
+async def cache_admin_invalidate(
+    route: Optional[str] = None,
+    model: Optional[str] = None,
+    older_than: Optional[float] = None,
+):
+    from .cache.admin import invalidate
+    from .cache.io import cache_io
+
+    if route is None and model is None and older_than is None:
+        # purging everything has to be asked for with `older_than=0`
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="one of route, model or older_than is required",
+        )
+    deleted = await cache_io.write(invalidate, route, model, older_than)
+    return {"deleted": deleted}
+
+
+@app.get(
+    "/admin/cache/snapshot",
+    summary="Stream a compressed snapshot of the cache",
+    dependencies=[Depends(verify_admin_key)],
+)
+def cache_admin_export(request: Request):
+    from .cache.admin import export_snapshot
+
+    return StreamingResponse(
+        export_snapshot(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="cache.snapshot"'},
+    )
+
+
+@app.post(
+    "/admin/cache/snapshot",
+    summary="Load a snapshot of `GET /admin/cache/snapshot` into the cache",
+    dependencies=[Depends(verify_admin_key)],
+)
+async def cache_admin_import(request: Request):
+    from .cache import load_records
+    from .cache.admin import import_snapshot
+    from .cache.io import cache_io
+
+    async def store(records):
+        await cache_io.write(load_records, records)
+
+    try:
+        imported = await import_snapshot(request.stream(), store)
+    except (ValueError, zlib.error) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"imported": imported}
+
+
 if BENCHMARK_MODE:
     from .cache.chat.chat_completions import chat_completions_benchmark
 
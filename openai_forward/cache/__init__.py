@@ -1,4 +1,7 @@
-from flaxkv.pack import encode
+from __future__ import annotations
+
+import time
+
 from loguru import logger
 
 from openai_forward.config.settings import (
@@ -8,9 +11,19 @@ from openai_forward.config.settings import (
     EMBEDDING_ROUTE,
 )
 
-from .chat.response import gen_response, get_cached_chat_response
+from .admin import cache_index, cache_stats, entry_created, entry_scope, value_size
+from .chat.response import gen_response, get_cached_chat_response, make_variant
 from .database import db_dict
-from .embedding.response import get_cached_embedding_response
+from .embedding.response import (
+    get_cached_embedding_response,
+    merge_response,
+    parse_items,
+    reduce_payload,
+    split_inputs,
+)
+from .memory import MemoryCache
+from .policy import cache_policies, key_matches, key_payload
+from .semantic import semantic_cache
 
 
 def get_cached_response(
@@ -25,59 +38,160 @@ def get_cached_response(
         return get_cached_chat_response(payload_info, valid_payload, request, **kwargs)
 
     elif route_path in CACHE_ROUTE_SET:
-        return get_cached_generic_response(payload, request, route_path)
+        return get_cached_generic_response(
+            payload, request, route_path, payload_info.get("model")
+        )
     else:
         return None, None
 
 
-def cache_response(cache_key, target_info, route_path, chunk_list):
+def store(
+    cache_key,
+    value,
+    route_path: str,
+    model: str | None = None,
+    ttl: float | None = None,
+):
+    """
+    Store a value in the cache database, with the TTL of its route and model when the
+    backend supports it.
+    """
+    # the payload of a `CacheKey` is stored in the value, not in the key
+    cache_key = bytes(cache_key)
+    if isinstance(db_dict, MemoryCache):
+        size = db_dict.set(cache_key, value, route_path, model, ttl)
+        if not size:
+            return
+    else:
+        db_dict[cache_key] = value
+        size = len(cache_key) + value_size(value)
+    cache_index.add(cache_key, route_path, model, entry_created(value), size)
+    cache_stats.write(route_path, model, size)
+
+
+def load_records(records: list):
+    """
+    Store the records of a cache snapshot, see `admin.export_snapshot`.
+    """
+    for record in records:
+        value = record["value"]
+        route_path, model = entry_scope(value)
+        policy = cache_policies.get(route_path, model)
+        store(record["key"], value, route_path, model, policy.retention)
+
+
+def cache_response(
+    cache_key, target_info, route_path, chunk_list, payload_info=None, delays=None
+):
+    model = payload_info.get("model") if payload_info else None
+    policy = cache_policies.get(route_path, model)
     if (
         target_info
         and CACHE_OPENAI
         and route_path == CHAT_COMPLETION_ROUTE
         and cache_key is not None
     ):
-        cached_value = db_dict.get(cache_key, {"data": []})["data"]
-        if len(cached_value) < 10:
-            cached_value.append(target_info["assistant"])
-            db_dict[cache_key] = {
-                "data": cached_value,
+        cached = db_dict.get(cache_key)
+        if (
+            cached is None
+            or not key_matches(cached, cache_key)
+            or not policy.is_fresh(cached.get("created"))
+        ):
+            cached = {
+                "data": [],
                 "route_path": route_path,
+                "model": model,
+                "created": time.time(),
+                "payload": key_payload(cache_key),
             }
+        if len(cached["data"]) < policy.variants_for(payload_info):
+            # a stream response is replayed as it was received
+            stream = bool(payload_info and payload_info.get("stream") and chunk_list)
+            variant = make_variant(
+                model,
+                target_info["assistant"],
+                chunk_list if stream else None,
+                delays if stream else None,
+                usage=target_info.get("usage"),
+                messages=payload_info.get("messages") if payload_info else None,
+            )
+            # a new value, the one read may be served to other requests meanwhile
+            cached = {**cached, "data": [*cached["data"], variant]}
+            store(cache_key, cached, route_path, model, policy.retention)
+        if semantic_cache is not None and payload_info and "semantic" in payload_info:
+            semantic_cache.add(cache_key, *payload_info["semantic"])
     elif (
         target_info
         and CACHE_OPENAI
         and route_path == EMBEDDING_ROUTE
         and cache_key is not None
     ):
-        cached_value = bytes(target_info["buffer"])
-        db_dict[cache_key] = {
-            "data": cached_value,
-            "route_path": route_path,
-        }
+        inputs = split_inputs(payload_info["input"])
+        policy = cache_policies.get(route_path, model)
+        items = parse_items(
+            bytes(target_info["buffer"]),
+            inputs,
+            list(cache_key),
+            dtype=policy.vector_dtype,
+        )
+        cache_embedding_items(items, model)
     else:
-        cache_generic_response(cache_key, route_path, chunk_list)
+        cache_generic_response(cache_key, chunk_list, route_path, model=model)
 
 
-def cache_generic_response(cache_key, buffer_list, route_path, max_cache=3):
-    if cache_key and route_path in CACHE_ROUTE_SET:
-        value_list = db_dict.get(cache_key, [])
+def cache_embedding_items(items: dict, model=None):
+    """
+    Store the cache entries of single embedding inputs.
+    """
+    policy = cache_policies.get(EMBEDDING_ROUTE, model)
+    for cache_key, item in items.items():
+        store(cache_key, item, EMBEDDING_ROUTE, model, policy.retention)
 
-        if len(value_list) < max_cache:
-            value_list.append({"data": buffer_list})
-            db_dict[cache_key] = value_list
 
-
-def get_cached_generic_response(payload: bytes, request, route_path):
+def cache_generic_response(
+    cache_key, buffer_list, route_path, max_cache=None, model=None
+):
+    if cache_key and route_path in CACHE_ROUTE_SET:
+        policy = cache_policies.get(route_path, model)
+        value_list = db_dict.get(cache_key, [])
+        if value_list and not (
+            key_matches(value_list[0], cache_key)
+            and policy.is_fresh(value_list[0].get("created"))
+        ):
+            value_list = []
+
+        if len(value_list) < (max_cache or policy.max_variants):
+            # a new list, the one read may be served to other requests meanwhile
+            value_list = [
+                *value_list,
+                {
+                    "data": buffer_list,
+                    "created": time.time(),
+                    "payload": key_payload(cache_key),
+                    "route_path": route_path,
+                    "model": model,
+                },
+            ]
+            store(cache_key, value_list, route_path, model, policy.retention)
+
+
+def get_cached_generic_response(payload: bytes, request, route_path, model=None):
 
     if route_path not in CACHE_ROUTE_SET:
         return None, None
 
     try:
-        cache_key = encode(payload)
+        policy = cache_policies.get(route_path, model)
+        cache_key = policy.make_raw_key(payload)
         value_list = db_dict.get(cache_key)
-        if value_list is None:
+        if (
+            value_list is None
+            or not key_matches(value_list[0], cache_key)
+            or not policy.is_fresh(value_list[0].get("created"))
+        ):
+            cache_stats.miss(route_path, model)
             return None, cache_key
+        cache_stats.hit(route_path, model)
 
         idx = -1
         buffer_list = value_list[idx]["data"]
@@ -0,0 +1,412 @@
+from __future__ import annotations
+
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import (
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from flaxkv.pack import decode, encode
+from loguru import logger
+
+from ..config.settings import CACHE_BACKEND, CACHE_ROOT_PATH_OR_URL
+from .database import db_dict
+from .memory import MemoryCache
+
+SNAPSHOT_MAGIC = b"OFCACHE1"
+_FRAME = struct.Struct(">I")
+
+# (route path, model)
+Scope = Tuple[Optional[str], Optional[str]]
+
+
+def entry_scope(value) -> Scope:
+    """The route and model a cached value belongs to, as far as it records them."""
+    if isinstance(value, list) and value:
+        value = value[0]
+    if isinstance(value, dict):
+        return value.get("route_path"), value.get("model")
+    return None, None
+
+
+def entry_created(value) -> float | None:
+    if isinstance(value, list) and value:
+        value = value[0]
+    return value.get("created") if isinstance(value, dict) else None
+
+
+def value_size(value) -> int:
+    """
+    The approximate bytes of a value, the length of its strings and bytes plus 8 bytes
+    for any other scalar, without encoding it.
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(value_size(k) + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(v) for v in value)
+    return 8
+
+
+class CacheIndex:
+    """
+    A secondary index of the cache database: the route, model, creation time and size
+    of every key, so entries can be counted and invalidated by route, model or age
+    without decoding the values.
+
+    It is kept up to date by every write. `start` loads the last snapshot, or rebuilds
+    the index by scanning the store if the snapshot does not match the size of the
+    store anymore, in a background thread that then saves a snapshot periodically.
+    """
+
+    def __init__(self, path: str | Path | None = None, save_interval: float = 300):
+        """
+        Args:
+            path (str | Path | None): File of the snapshot.
+            save_interval (float): Seconds between two snapshots.
+        """
+        self.path = Path(path) if path else None
+        self.save_interval = save_interval
+        # key -> (route path, model, created, size)
+        self._entries: Dict[bytes, Tuple] = {}
+        # keys discarded while a rebuild scans the store
+        self._discarded: set | None = None
+        self._lock = threading.Lock()
+        # whether the index covers the whole store, i.e. it was built completely
+        self.ready = True
+        self._built = threading.Event()
+        self._built.set()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(
+        self,
+        key: bytes,
+        route_path: str | None,
+        model: str | None,
+        created: float | None,
+        size: int,
+    ):
+        with self._lock:
+            self._entries[bytes(key)] = (route_path, model, created, size)
+
+    def discard(self, key: bytes):
+        with self._lock:
+            self._entries.pop(bytes(key), None)
+            if self._discarded is not None:
+                self._discarded.add(bytes(key))
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait until the index is not being built anymore."""
+        return self._built.wait(timeout)
+
+    def rebuild(self, store) -> bool:
+        """
+        Rebuild the index by scanning the store, until `stop` is called.
+
+        Returns:
+            bool: Whether the whole store was scanned.
+        """
+        # scan the persistent store itself, not through the hot tier of a `TieredCache`,
+        # and without counting hits
+        store = getattr(store, "store", store)
+        read = getattr(store, "peek", store.get)
+        with self._lock:
+            if self._discarded is None:
+                self._discarded = set()
+        entries = {}
+        try:
+            for key in list(store.keys()):
+                if self._stop.is_set():
+                    return False
+                value = read(key)
+                if value is not None:
+                    route_path, model = entry_scope(value)
+                    entries[bytes(key)] = (
+                        route_path,
+                        model,
+                        entry_created(value),
+                        len(key) + value_size(value),
+                    )
+        finally:
+            self._merge(entries)
+        return True
+
+    def _merge(self, entries: Dict[bytes, Tuple]):
+        with self._lock:
+            # writes since the index started to build win over what it read
+            entries.update(self._entries)
+            for key in self._discarded or ():
+                entries.pop(key, None)
+            self._entries = entries
+            self._discarded = None
+
+    def start(self, store):
+        """
+        Load or rebuild the index of `store` in a background thread, which then saves a
+        snapshot every `save_interval` seconds until `stop`.
+        """
+        if self._thread is not None:
+            return
+        self.ready = False
+        self._built.clear()
+        self._stop.clear()
+        with self._lock:
+            self._discarded = set()
+
+        def run():
+            try:
+                if self.load(len(store)):
+                    self.ready = True
+                else:
+                    start = time.perf_counter()
+                    self.ready = self.rebuild(store)
+                    if self.ready:
+                        logger.info(
+                            f"cache index of {len(self)} entries rebuilt in "
+                            f"{time.perf_counter() - start:.2f}s"
+                        )
+            except Exception as e:
+                logger.warning(f"cache index rebuild error: {e!r}")
+            finally:
+                self._built.set()
+            while not self._stop.wait(self.save_interval):
+                try:
+                    self.save(len(store))
+                except Exception as e:
+                    logger.warning(f"cache index snapshot error: {e!r}")
+
+        self._thread = threading.Thread(target=run, name="cache-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, and a rebuild still scanning the store."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def select(
+        self,
+        route_path: str | None = None,
+        model: str | None = None,
+        older_than: float | None = None,
+    ) -> List[bytes]:
+        """
+        The keys of a route and/or model, and/or created more than `older_than` seconds
+        ago.
+        """
+        deadline = time.time() - older_than if older_than is not None else None
+        with self._lock:
+            return [
+                key
+                for key, (r, m, created, _) in self._entries.items()
+                if (route_path is None or r == route_path)
+                and (model is None or m == model)
+                and (deadline is None or (created or 0) < deadline)
+            ]
+
+    def summary(self) -> Dict[Scope, List[int]]:
+        """Number of entries and their bytes by route and model."""
+        result: Dict[Scope, List[int]] = {}
+        with self._lock:
+            for route_path, model, _, size in self._entries.values():
+                counts = result.setdefault((route_path, model), [0, 0])
+                counts[0] += 1
+                counts[1] += size
+        return result
+
+    def save(self, store_size: int | None = None):
+        # a partial index must not pass for the whole one
+        if self.path is None or not self.ready:
+            return
+        with self._lock:
+            entries = [[key, *entry] for key, entry in self._entries.items()]
+        data = encode({"store_size": store_size, "entries": entries})
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self, store_size: int | None = None) -> bool:
+        """
+        Load the snapshot, unless it does not match the size of the store anymore.
+
+        Returns:
+            bool: Whether the snapshot was loaded.
+        """
+        if self.path is None or not self.path.exists():
+            return False
+        try:
+            data = decode(self.path.read_bytes())
+        except Exception as e:
+            logger.warning(f"invalid cache index snapshot {self.path}: {e!r}")
+            return False
+        if store_size is not None and data.get("store_size") != store_size:
+            return False
+        self._merge({key: tuple(entry) for key, *entry in data["entries"]})
+        return True
+
+
+class CacheStats:
+    """
+    Hit, miss and written byte counters of the cache, by route and model.
+    """
+
+    def __init__(self):
+        self._counters: Dict[Scope, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, route_path, model, i: int, n: int):
+        with self._lock:
+            counters = self._counters.setdefault((route_path, model), [0, 0, 0, 0])
+            counters[i] += n
+
+    def hit(self, route_path: str, model: str | None = None, n: int = 1):
+        self._add(route_path, model, 0, n)
+
+    def miss(self, route_path: str, model: str | None = None, n: int = 1):
+        self._add(route_path, model, 1, n)
+
+    def write(self, route_path: str, model: str | None, size: int):
+        self._add(route_path, model, 2, 1)
+        self._add(route_path, model, 3, size)
+
+    def report(self, index: CacheIndex | None = None) -> Dict[str, Dict[str, dict]]:
+        """
+        `{route: {model: counters}}`, with the stored entries and bytes of the index.
+        """
+        with self._lock:
+            counters = {scope: list(c) for scope, c in self._counters.items()}
+        stored = index.summary() if index is not None else {}
+        result: Dict[str, Dict[str, dict]] = {}
+        for scope in {*counters, *stored}:
+            hits, misses, writes, written = counters.get(scope, (0, 0, 0, 0))
+            items, size = stored.get(scope, (0, 0))
+            lookups = hits + misses
+            route_path, model = scope
+            result.setdefault(route_path or "-", {})[model or "-"] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "writes": writes,
+                "bytes_written": written,
+                "items": items,
+                "bytes": size,
+            }
+        return result
+
+
+def invalidate(
+    route_path: str | None = None,
+    model: str | None = None,
+    older_than: float | None = None,
+) -> int:
+    """
+    Delete the entries of a route and/or model, and/or older than `older_than` seconds.
+
+    Returns:
+        int: The number of deleted entries.
+    """
+    # the entries of a store still being scanned would be missed
+    cache_index.wait()
+    deleted = 0
+    for key in cache_index.select(route_path, model, older_than):
+        try:
+            del db_dict[key]
+            deleted += 1
+        except KeyError:
+            # evicted or expired in the meantime
+            pass
+        cache_index.discard(key)
+    return deleted
+
+
+def export_snapshot(level: int = 6) -> Iterator[bytes]:
+    """
+    Stream the cache as a zlib compressed sequence of length-prefixed msgpack records.
+    """
+    # read the store behind a `TieredCache`, without counting hits or promoting entries
+    store = getattr(db_dict, "store", db_dict)
+    read = getattr(store, "peek", store.get)
+    compressor = zlib.compressobj(level)
+    yield compressor.compress(SNAPSHOT_MAGIC)
+    for key in list(store.keys()):
+        value = read(key)
+        if value is None:
+            continue
+        record = encode({"key": bytes(key), "value": value})
+        chunk = compressor.compress(_FRAME.pack(len(record)) + record)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+async def import_snapshot(
+    stream: AsyncIterable[bytes],
+    store: Callable[[List[dict]], Awaitable],
+    batch_size: int = 256,
+) -> int:
+    """
+    Asynchronously read a snapshot of `export_snapshot` and hand its records to `store`
+    in batches.
+
+    Returns:
+        int: The number of imported entries.
+    """
+    decompressor = zlib.decompressobj()
+    buffer = bytearray()
+    records: List[dict] = []
+    count = 0
+    magic_checked = False
+    async for chunk in stream:
+        buffer += decompressor.decompress(chunk)
+        if not magic_checked:
+            if len(buffer) < len(SNAPSHOT_MAGIC):
+                continue
+            if buffer[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("not a cache snapshot")
+            del buffer[: len(SNAPSHOT_MAGIC)]
+            magic_checked = True
+        while len(buffer) >= _FRAME.size:
+            (size,) = _FRAME.unpack_from(buffer)
+            if len(buffer) < _FRAME.size + size:
+                break
+            records.append(decode(bytes(buffer[_FRAME.size : _FRAME.size + size])))
+            del buffer[: _FRAME.size + size]
+        if len(records) >= batch_size:
+            await store(records)
+            count += len(records)
+            records = []
+    buffer += decompressor.flush()
+    if buffer or not magic_checked:
+        raise ValueError("truncated cache snapshot")
+    if records:
+        await store(records)
+        count += len(records)
+    return count
+
+
+cache_stats = CacheStats()
+
+_index_path = None
+if CACHE_BACKEND.lower() in ("leveldb", "lmdb"):
+    _index_path = Path(CACHE_ROOT_PATH_OR_URL) / "CACHE_DB.index"
+cache_index = CacheIndex(_index_path)
+if isinstance(db_dict, MemoryCache):
+    # entries evicted or expired by the memory cache leave the index with them
+    db_dict.on_remove = cache_index.discard
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, List
+
+from flaxkv.pack import decode, encode
+from loguru import logger
+
+
+def _hash_pair(key) -> tuple:
+    if isinstance(key, str):
+        key = key.encode()
+    elif not isinstance(key, (bytes, bytearray)):
+        key = encode(key)
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class _Filter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(
+            int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8
+        )
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, h1: int, h2: int):
+        # double hashing: h1 + i * h2
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, h1: int, h2: int):
+        for pos in self._positions(h1, h2):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, pair) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(*pair))
+
+    def to_dict(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "count": self.count,
+            "bits": bytes(self.bits),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> _Filter:
+        f = cls(data["capacity"], data["error_rate"])
+        f.bits = bytearray(data["bits"])
+        f.count = data["count"]
+        return f
+
+
+class ScalableBloomFilter:
+    """
+    A Bloom filter over cache keys that grows with the number of keys.
+
+    A key the filter does not contain is definitely not cached, so the lookup can skip the
+    persistent store. Once a filter is full, a new one with twice the capacity and a
+    tighter error rate is added, which keeps the overall false positive rate bounded.
+    Deleted keys stay in the filter, they only cost a lookup.
+
+    A snapshot only covers the store as it was when written, so it is consumed by the
+    next `load`: keys added afterwards by a run that never saves again, e.g. one that
+    crashed, can not go missing from a loaded filter, the filter is rebuilt instead.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 100_000,
+        error_rate: float = 0.01,
+        path: str | Path | None = None,
+    ):
+        """
+        Args:
+            capacity (int): Number of keys of the first filter.
+            error_rate (float): Target false positive rate.
+            path (str | Path | None): File of the snapshot.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = Path(path) if path else None
+        self._filters: List[_Filter] = []
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+    def add(self, key):
+        pair = _hash_pair(key)
+        with self._lock:
+            if any(pair in f for f in self._filters):
+                return
+            if (
+                not self._filters
+                or self._filters[-1].count >= self._filters[-1].capacity
+            ):
+                n = len(self._filters)
+                self._filters.append(
+                    _Filter(self.capacity * 2**n, self.error_rate * 0.5 ** (n + 1))
+                )
+            self._filters[-1].add(*pair)
+
+    def __contains__(self, key) -> bool:
+        pair = _hash_pair(key)
+        if any(pair in f for f in self._filters):
+            return True
+        self.skipped += 1
+        return False
+
+    def update(self, keys: Iterable):
+        for key in keys:
+            self.add(key)
+
+    def save(self, store_size: int | None = None):
+        """
+        Write a snapshot of the filter, together with the size of the store it covers.
+        """
+        if self.path is None:
+            return
+        data = encode(
+            {
+                "store_size": store_size,
+                "filters": [f.to_dict() for f in self._filters],
+            }
+        )
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self, store_size: int | None = None) -> bool:
+        """
+        Load and consume the snapshot, unless it does not match the size of the store
+        anymore.
+
+        Returns:
+            bool: Whether the snapshot was loaded.
+        """
+        if self.path is None or not self.path.exists():
+            return False
+        try:
+            data = decode(self.path.read_bytes())
+        except Exception as e:
+            logger.warning(f"invalid bloom filter snapshot {self.path}: {e!r}")
+            return False
+        finally:
+            self.path.unlink(missing_ok=True)
+        if store_size is not None and data.get("store_size") != store_size:
+            return False
+        self._filters = [_Filter.from_dict(f) for f in data["filters"]]
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self),
+            "filters": len(self._filters),
+            "skipped_lookups": self.skipped,
+        }
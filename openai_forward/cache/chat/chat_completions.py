@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import asyncio
+import random
 import time
 from itertools import cycle
 from typing import List, Literal, Optional, Union
@@ -11,7 +13,7 @@ from fastapi.responses import Response, StreamingResponse
 
 from openai_forward.config.settings import FWD_KEY, token_interval_conf
 
-from ...decorators import async_token_rate_limit_auth_level, random_sleep
+from ...decorators import async_token_rate_limit_auth_level
 from ...helper import get_unique_id
 from .tokenizer import TIKTOKEN_VALID, count_tokens, encode_as_pieces
 
@@ -207,16 +209,18 @@ async def stream_generate(
     yield b'data: [DONE]\n\n'
 
 
-@async_token_rate_limit_auth_level(token_interval_conf, FWD_KEY)
-async def stream_generate_efficient(
-    model: str, content: str | None, tool_calls: list | None, request: Request
-):
-    """More efficient (use dict) version of stream_generate
+def render_frames(
+    model: str, content: str | None, tool_calls: list | None, done: bool = True
+) -> List[bytes]:
+    """Render a chat completion as the frames of a stream response.
     Args:
         model (str): The model to use.
         content (str): content.
         tool_calls (list | None): tool_calls list.
-        request (Request): A FastAPI request object. For rate limit.
+        done (bool): Whether to end with the `data: [DONE]` frame.
+
+    Returns:
+        List[bytes]: The SSE frames.
     """
     created = int(time.time())
     id = f"chatcmpl-{get_unique_id()}"
@@ -257,43 +261,78 @@ async def stream_generate_efficient(
         return b'data: ' + orjson.dumps(chunk) + b'\n\n'
 
     if tool_calls:
-        yield serialize_delta(
-            role="assistant",
-            delta_tool_calls=[
-                {
-                    'index': 0,
-                    'id': f"call_{get_unique_id()}",
-                    'function': {"name": function_name, "arguments": ""},
-                    'type': 'function',
-                }
-            ],
-        )
-    else:
-        yield serialize_delta(role="assistant", content="")
-
-    delta = {}
-    for content in texts:
-        if tool_calls:
-            yield serialize_delta(
+        frames = [
+            serialize_delta(
+                role="assistant",
                 delta_tool_calls=[
                     {
                         'index': 0,
-                        'id': None,
-                        'function': {"name": None, "arguments": content},
-                        'type': None,
+                        'id': f"call_{get_unique_id()}",
+                        'function': {"name": function_name, "arguments": ""},
+                        'type': 'function',
                     }
                 ],
             )
+        ]
+    else:
+        frames = [serialize_delta(role="assistant", content="")]
+
+    delta = {}
+    for content in texts:
+        if tool_calls:
+            frames.append(
+                serialize_delta(
+                    delta_tool_calls=[
+                        {
+                            'index': 0,
+                            'id': None,
+                            'function': {"name": None, "arguments": content},
+                            'type': None,
+                        }
+                    ],
+                )
+            )
         else:
-            yield serialize_delta(content=content)
+            frames.append(serialize_delta(content=content))
 
     delta = {}
-    yield serialize_delta(finish_reason="tool_calls" if tool_calls else "stop")
+    frames.append(serialize_delta(finish_reason="tool_calls" if tool_calls else "stop"))
+    if done:
+        frames.append(b'data: [DONE]\n\n')
+    return frames
 
-    yield b'data: [DONE]\n\n'
+
+def render_usage_frame(
+    model: str, usage: dict, id: str | None = None, created: int | None = None
+) -> bytes:
+    """Render the last frame of a stream that set `stream_options.include_usage`."""
+    chunk = {
+        "id": id or f"chatcmpl-{get_unique_id()}",
+        "object": "chat.completion.chunk",
+        "created": created or int(time.time()),
+        "model": model,
+        "system_fingerprint": "fp_0123456789",
+        "choices": [],
+        "usage": usage,
+    }
+    return b'data: ' + orjson.dumps(chunk) + b'\n\n'
+
+
+@async_token_rate_limit_auth_level(token_interval_conf, FWD_KEY)
+async def stream_generate_efficient(
+    model: str, content: str | None, tool_calls: list | None, request: Request
+):
+    """More efficient (use dict) version of stream_generate
+    Args:
+        model (str): The model to use.
+        content (str): content.
+        tool_calls (list | None): tool_calls list.
+        request (Request): A FastAPI request object. For rate limit.
+    """
+    for frame in render_frames(model, content, tool_calls):
+        yield frame
 
 
-@random_sleep(min_time=1, max_time=2)
 def generate(model: str, content: str | None, tool_calls: list | None, usage: dict):
     created = int(time.time())
     id = f"chatcmpl-{get_unique_id()}"
@@ -352,6 +391,8 @@ async def chat_completions_benchmark(request: Request):
             media_type="text/event-stream",
         )
     else:
+        # simulated latency, without blocking the event loop
+        await asyncio.sleep(random.uniform(1, 2))
         return Response(
             content=generate(model, model_result.content, None, model_result.usage),
             media_type="application/json",
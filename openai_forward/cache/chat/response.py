@@ -1,47 +1,184 @@
 from __future__ import annotations
 
+import asyncio
 import random
-from typing import List
+from typing import AsyncGenerator, List, Tuple
 
+import orjson
 from fastapi.responses import Response, StreamingResponse
-from flaxkv.pack import encode
 from loguru import logger
 
-from openai_forward.config.settings import CACHE_OPENAI, FWD_KEY
+from openai_forward.config.settings import CACHE_OPENAI, CHAT_COMPLETION_ROUTE, FWD_KEY
 
+from ...content.helper import SSEParser
+from ...decorators import get_token_interval
+from ..admin import cache_stats
 from ..database import db_dict
+from ..policy import CachePolicy, cache_policies, key_matches
 from .chat_completions import (
     async_token_rate_limit_auth_level,
     generate,
-    stream_generate_efficient,
+    render_frames,
+    render_usage_frame,
     token_interval_conf,
 )
+from .tokenizer import count_tokens
 
 
 def construct_cache_key(payload_info: dict):
-    elements = [
-        payload_info["n"],
-        payload_info['messages'],
-        payload_info['model'],
-        payload_info["max_tokens"],
-        payload_info['response_format'],
-        payload_info['seed'],
-        # payload_info['temperature'],
-        payload_info["tools"],
-        payload_info["tool_choice"],
-    ]
-
-    return encode(elements)
-
-
-def get_response_from_key(key, payload_info, request, **kwargs):
-    value = db_dict[key]
+    policy = cache_policies.get(CHAT_COMPLETION_ROUTE, payload_info['model'])
+    return policy.make_key(payload_info)
+
+
+DONE_FRAME = b'data: [DONE]\n\n'
+
+
+def split_assistant(assistant: str | list) -> Tuple[str | None, list | None]:
+    """The text and the tool calls of a cached response, one of them is None."""
+    if isinstance(assistant, list):
+        return None, assistant
+    return assistant, None
+
+
+def split_frames(
+    chunks: List[bytes], delays: List[float] | None = None
+) -> Tuple[List[bytes], List[float], dict | None]:
+    """
+    Split the chunks of a stream response into one frame per event. The `[DONE]` and
+    usage events are dropped, replay adds them again as the request asks for.
+
+    Returns:
+        Tuple[List[bytes], List[float], dict | None]: The frames, the seconds before each
+            of them and the usage the stream reported, if any.
+    """
+    parser = SSEParser()
+    frames, frame_delays, usage = [], [], None
+    pending = 0.0
+    for i, chunk in enumerate(chunks):
+        pending += delays[i] if delays else 0
+        for data in parser.feed(chunk):
+            if data == b"[DONE]":
+                continue
+            if b'"usage"' in data:
+                try:
+                    event = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    event = {}
+                if event.get("usage"):
+                    usage = event["usage"]
+                    if not event.get("choices"):
+                        continue
+            frames.append(b"data: " + data + b"\n\n")
+            frame_delays.append(round(pending, 3))
+            pending = 0.0
+    return frames, frame_delays, usage
+
+
+def estimate_usage(messages: list, assistant: str | list, model: str) -> dict | None:
+    """Count the tokens of a response with tiktoken, None if that is not possible."""
+    text, tool_calls = split_assistant(assistant)
+    if tool_calls:
+        text = tool_calls[0]['function']['arguments']
+    try:
+        return count_tokens(messages, text or "", model)
+    except Exception as e:
+        logger.debug(f"token count error: {e!r}")
+        return None
+
+
+def make_variant(
+    model: str,
+    assistant: str | list,
+    frames: List[bytes] | None = None,
+    delays: List[float] | None = None,
+    usage: dict | None = None,
+    messages: list | None = None,
+) -> dict:
+    """
+    Build a cached variant of a chat response, with the frames to replay it as a stream
+    and its token usage.
+
+    Args:
+        model (str): The requested model.
+        assistant (str | list): The text, or the tool calls, of the response.
+        frames (List[bytes] | None): The chunks of the original stream response, None to
+            render them from `assistant`.
+        delays (List[float] | None): Seconds before each of the `frames` arrived.
+        usage (dict | None): The usage the response reported.
+        messages (list | None): The request messages, to count the tokens when the
+            response did not report its usage.
+    """
+    if frames is None:
+        frames, delays = (
+            render_frames(model, *split_assistant(assistant), done=False),
+            None,
+        )
+    else:
+        frames, delays, stream_usage = split_frames(frames, delays)
+        usage = usage or stream_usage
+    if usage is None and messages is not None:
+        usage = estimate_usage(messages, assistant, model)
+    return {"assistant": assistant, "frames": frames, "delays": delays, "usage": usage}
+
+
+def usage_frame(model: str, usage: dict, frames: List[bytes]) -> bytes:
+    """The usage frame of a replayed stream, with the id of its other frames."""
+    try:
+        first = orjson.loads(frames[0][len(b"data: ") :])
+        return render_usage_frame(model, usage, first.get("id"), first.get("created"))
+    except (orjson.JSONDecodeError, IndexError, AttributeError):
+        return render_usage_frame(model, usage)
+
+
+async def replay_frames(
+    frames: List[bytes],
+    delays: List[float] | None,
+    mode: str,
+    token_interval: float = 0,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Replay the frames of a cached stream response.
+
+    Args:
+        frames (List[bytes]): The frames.
+        delays (List[float] | None): Seconds before each frame, as recorded.
+        mode (str): "instant" sends everything at once, "recorded" keeps the recorded
+            timing and "throttled" paces the frames with the token rate limit.
+        token_interval (float): Seconds between two frames in "throttled" mode.
+    """
+    if mode == "recorded" and delays is not None:
+        for frame, delay in zip(frames, delays):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield frame
+    elif mode == "throttled" and token_interval > 0:
+        for i, frame in enumerate(frames):
+            if i:
+                await asyncio.sleep(token_interval)
+            yield frame
+    else:
+        yield b"".join(frames)
+
+
+def get_response_from_value(
+    value, payload_info, request, policy: CachePolicy | None = None, **kwargs
+):
     cache_values = value['data']
     idx = random.randint(0, len(cache_values) - 1) if len(cache_values) > 1 else 0
     uid = payload_info["uid"]
     logger.info(f'chat uid: {uid} >>>{idx}>>>> [cache hit]')
     # todo: handle multiple choices
     cache_value = cache_values[idx]
+    frames = delays = None
+    if isinstance(cache_value, dict):
+        frames, delays = cache_value["frames"], cache_value["delays"]
+        usage = cache_value.get("usage")
+        cache_value = cache_value["assistant"]
+    else:
+        # cached before frames and usage were stored, lookups run off the event loop
+        usage = estimate_usage(
+            payload_info['messages'], cache_value, payload_info['model']
+        )
     if isinstance(cache_value, list):
         text = None
         tool_calls = cache_value
@@ -64,19 +201,31 @@ def get_response_from_key(key, payload_info, request, **kwargs):
         logger_instance.log_result(result_info)
 
     if payload_info["stream"]:
+        if frames is None:
+            frames = render_frames(payload_info['model'], text, tool_calls, done=False)
+        if not frames or not frames[-1].endswith(DONE_FRAME):
+            tail = []
+            stream_options = payload_info.get("stream_options") or {}
+            if usage and stream_options.get("include_usage"):
+                tail.append(usage_frame(payload_info['model'], usage, frames))
+            tail.append(DONE_FRAME)
+            frames = frames + tail
+            if delays is not None:
+                delays = delays + [0] * len(tail)
+        policy = policy or cache_policies.get(CHAT_COMPLETION_ROUTE)
         return StreamingResponse(
-            stream_generate_efficient(
-                payload_info['model'],
-                text,
-                tool_calls,
-                request,
+            replay_frames(
+                frames,
+                delays,
+                policy.replay,
+                get_token_interval(request, token_interval_conf, FWD_KEY),
             ),
             status_code=200,
             media_type="text/event-stream",
         )
 
     else:
-        usage = {
+        usage = usage or {
             "prompt_tokens": 0,
             "completion_tokens": 0,
             "total_tokens": 0,
@@ -102,17 +251,30 @@ def get_cached_chat_response(payload_info, valid_payload, request, **kwargs):
 
     Note:
         If a cache hit occurs, the cached response is immediately returned without contacting the external server.
+        A stale hit is returned as well, `payload_info["stale"]` then asks for a background refresh.
     """
     if not (CACHE_OPENAI and valid_payload):
         return None, None
 
-    cache_key = construct_cache_key(payload_info)
+    policy = cache_policies.get(CHAT_COMPLETION_ROUTE, payload_info['model'])
+    cache_key = policy.make_key(payload_info)
 
-    if payload_info['caching'] and cache_key in db_dict:
-        return (
-            get_response_from_key(cache_key, payload_info, request, **kwargs),
-            cache_key,
-        )
+    if payload_info['caching']:
+        value = db_dict.get(cache_key)
+        if (
+            value is not None
+            and key_matches(value, cache_key)
+            and policy.is_servable(value.get("created"))
+        ):
+            payload_info["stale"] = not policy.is_fresh(value.get("created"))
+            cache_stats.hit(CHAT_COMPLETION_ROUTE, payload_info['model'])
+            return (
+                get_response_from_value(
+                    value, payload_info, request, policy=policy, **kwargs
+                ),
+                cache_key,
+            )
+        cache_stats.miss(CHAT_COMPLETION_ROUTE, payload_info['model'])
 
     return None, cache_key
 
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 try:
     import tiktoken
 
@@ -34,23 +36,39 @@ def encode_as_pieces(sentence):
     return words
 
 
+@lru_cache(maxsize=64)
+def get_encoding(model: str):
+    """The tiktoken encoding of a model, loaded once per model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print(f"Warning: model {model} not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def message_text(message: dict) -> str:
+    """The text of a message, including the text parts of multimodal content."""
+    content = message.get('content') or ""
+    if isinstance(content, list):
+        content = "".join(
+            part.get('text', "") for part in content if isinstance(part, dict)
+        )
+    return content
+
+
 def count_tokens(messages, assistant_content, model="gpt-3.5-turbo"):
     """Return the usage information of tokens in the messages list."""
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_format_inputs_to_ChatGPT_models.ipynb
     if not TIKTOKEN_VALID:
         print("Warning: `tiktoken` not found. Install with `pip install tiktoken`.")
         raise ImportError
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
 
     count_name = 0
     messages_len = len(messages)
     content = ""
     for i in messages:
-        content += i['content'] + i['role']
+        content += message_text(i) + i['role']
         name = i.get('name')
         if name:
             count_name += 1
@@ -1,9 +1,52 @@
+from pathlib import Path
+
 from flaxkv import FlaxKV
+from loguru import logger
+
+from ..config.settings import (
+    CACHE_BACKEND,
+    CACHE_BLOOM,
+    CACHE_HOT_SIZE,
+    CACHE_MAX_SIZE,
+    CACHE_ROOT_PATH_OR_URL,
+    CACHE_TTL,
+    LOG_CACHE_DB_INFO,
+)
+from ..helper import parse_size
+from .bloom import ScalableBloomFilter
+from .memory import MemoryCache
+from .policy import CACHE_KEY_VERSION
+from .tiered import TieredCache
+
+
+def check_key_version(store, path: Path) -> bool:
+    """
+    Check that the entries of a persistent store were written with the current cache
+    key version, then record it.
+
+    Entries of another version are never hit again, they only take space until the
+    cache directory is reset, which is logged once.
+
+    Returns:
+        bool: Whether the store matched the current key version.
+    """
+    version = path.read_text().strip() if path.exists() else None
+    if version == str(CACHE_KEY_VERSION):
+        return True
+    matched = not len(store)
+    if not matched:
+        logger.warning(
+            f"the cache at {path.parent} was written with cache key version "
+            f"{version or 'before 3'}, this release uses {CACHE_KEY_VERSION}: its "
+            f"{len(store)} entries are never hit again, delete the directory to "
+            f"reclaim the space"
+        )
+    path.write_text(str(CACHE_KEY_VERSION))
+    return matched
 
-from ..config.settings import CACHE_BACKEND, CACHE_ROOT_PATH_OR_URL, LOG_CACHE_DB_INFO
 
 if CACHE_BACKEND.upper() == "MEMORY":
-    db_dict = {}
+    db_dict = MemoryCache(max_size=parse_size(CACHE_MAX_SIZE), ttl=CACHE_TTL)
 
 elif CACHE_BACKEND.lower() in ("leveldb", "lmdb"):
 
@@ -17,6 +60,16 @@ elif CACHE_BACKEND.lower() in ("leveldb", "lmdb"):
         log=log,
         save_log=save_log,
     )
+    check_key_version(db_dict, Path(CACHE_ROOT_PATH_OR_URL) / "CACHE_DB.key_version")
+    bloom = None
+    if CACHE_BLOOM.get("enabled", True):
+        bloom = ScalableBloomFilter(
+            capacity=CACHE_BLOOM.get("capacity", 100_000),
+            error_rate=CACHE_BLOOM.get("error_rate", 0.01),
+            path=Path(CACHE_ROOT_PATH_OR_URL) / "CACHE_DB.bloom",
+        )
+    # serve repeated hits from memory and definite misses without touching the disk
+    db_dict = TieredCache(db_dict, max_items=CACHE_HOT_SIZE, bloom=bloom)
 
 else:
     raise ValueError(
@@ -1,39 +1,237 @@
 from __future__ import annotations
 
+import time
+from typing import Dict, List, Tuple
+
+import orjson
 from fastapi.responses import Response
-from flaxkv.pack import encode
 from loguru import logger
 
-from ...config.settings import CACHE_OPENAI
+from ...config.settings import CACHE_OPENAI, EMBEDDING_ROUTE
+from ..admin import cache_stats
 from ..database import db_dict
+from ..policy import cache_policies, key_matches, key_payload
+from .vectors import pack_vector, render_vector
+
+
+def split_inputs(input) -> List:
+    """
+    The single inputs of an embedding request, a string or a list of token ids each.
+    """
+    if isinstance(input, str):
+        return [input]
+    if isinstance(input, list) and input and isinstance(input[0], int):
+        return [input]
+    return list(input)
+
+
+def construct_cache_key(payload_info) -> Tuple[bytes, ...]:
+    """
+    Every input is cached on its own, the key of a request is the keys of its inputs.
+    """
+    policy = cache_policies.get(EMBEDDING_ROUTE, payload_info['model'])
+    return tuple(
+        policy.make_key({**payload_info, "input": item})
+        for item in split_inputs(payload_info['input'])
+    )
+
+
+def split_tokens(items: List, total: int) -> List[int]:
+    """
+    Split the prompt tokens of a batch over its inputs, in proportion to their length.
+    Every non-empty input gets at least one token, as long as there are enough.
+    """
+    if len(items) == 1:
+        return [total]
+    sizes = [max(len(item), 1) for item in items]
+    largest = sorted(range(len(items)), key=lambda i: -sizes[i])
+    tokens = [0] * len(items)
+    for i in largest[:total]:
+        if len(items[i]):
+            tokens[i] = 1
+    rest = total - sum(tokens)
+    size = sum(sizes)
+    for i, s in enumerate(sizes):
+        tokens[i] += rest * s // size
+    # hand out the rounding remainder to the largest inputs
+    for i in largest[: total - sum(tokens)]:
+        tokens[i] += 1
+    return tokens
+
+
+def parse_items(
+    body: bytes,
+    inputs: List,
+    keys: List[bytes],
+    route_path: str = EMBEDDING_ROUTE,
+    dtype: str = "float32",
+) -> Dict[bytes, dict]:
+    """
+    Split an upstream embedding response into cache entries per input.
+
+    Args:
+        body (bytes): The response body, its vectors either floats or base64.
+        inputs (List): The inputs of the upstream request.
+        keys (List[bytes]): The cache key of each of the `inputs`.
+        dtype (str): How the vectors are packed, see `pack_vector`.
+    """
+    result = orjson.loads(body)
+    tokens = split_tokens(inputs, result["usage"]["prompt_tokens"])
+    created = time.time()
+    return {
+        keys[d["index"]]: {
+            **pack_vector(d["embedding"], dtype),
+            "payload": key_payload(keys[d["index"]]),
+            "tokens": tokens[d["index"]],
+            "model": result["model"],
+            "route_path": route_path,
+            "created": created,
+        }
+        for d in result["data"]
+    }
 
 
-def construct_cache_key(payload_info):
-    elements = [
-        payload_info['model'],
-        payload_info['input'],
-        payload_info['encoding_format'],
-    ]
-    return encode(elements)
+def _render_item(item: dict, encoding_format: str):
+    if "vector" not in item:
+        # entries cached before vectors were packed
+        item = pack_vector(item["embedding"])
+    return render_vector(item, encoding_format)
+
+
+def render_embeddings(
+    items: List[dict], model: str, encoding_format: str | None = None
+) -> bytes:
+    """
+    Render the response of an embedding request from the cache entries of its inputs.
+
+    Args:
+        items (List[dict]): The cache entries, in the order of the inputs.
+        model (str): The model of the response.
+        encoding_format (str | None): "base64", otherwise the vectors are float arrays.
+    """
+    encoding_format = encoding_format or "float"
+    tokens = sum(item["tokens"] for item in items)
+    return orjson.dumps(
+        {
+            "object": "list",
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": _render_item(item, encoding_format),
+                }
+                for i, item in enumerate(items)
+            ],
+            "model": model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        },
+        option=orjson.OPT_SERIALIZE_NUMPY,
+    )
+
+
+def reduce_payload(payload: bytes, payload_info: dict) -> bytes:
+    """
+    The request body with only the inputs missing from the cache.
+    """
+    body = orjson.loads(payload)
+    inputs = split_inputs(payload_info['input'])
+    body["input"] = [inputs[i] for i in payload_info["embedding_misses"]]
+    # the response is rendered from the cache entries, base64 is the smaller transfer
+    body["encoding_format"] = "base64"
+    return orjson.dumps(body)
+
+
+def merge_response(
+    body: bytes, payload_info: dict, keys: Tuple[bytes, ...]
+) -> Tuple[bytes, Dict[bytes, dict]]:
+    """
+    Merge the upstream response for the missing inputs with the cached ones, in the
+    original order.
+
+    Returns:
+        Tuple[bytes, Dict[bytes, dict]]: The response body, and the new cache entries.
+    """
+    policy = cache_policies.get(EMBEDDING_ROUTE, payload_info['model'])
+    inputs = split_inputs(payload_info['input'])
+    misses = payload_info["embedding_misses"]
+    new_items = parse_items(
+        body,
+        [inputs[i] for i in misses],
+        [keys[i] for i in misses],
+        dtype=policy.vector_dtype,
+    )
+    cached_items = payload_info["embedding_hits"]
+    items = [cached_items.get(i) or new_items[key] for i, key in enumerate(keys)]
+    content = render_embeddings(
+        items, items[0]["model"], payload_info.get("encoding_format")
+    )
+    return content, new_items
 
 
 def get_cached_embedding_response(payload_info, valid_payload, request, **kwargs):
     """
     Attempts to retrieve a cached response based on the current request's payload information.
 
+    Every input of the request is looked up on its own. When only some of them are
+    cached, `payload_info["embedding_hits"]` holds them by position and
+    `payload_info["embedding_misses"]` the positions of the distinct inputs that still
+    have to be sent upstream.
+
     Note:
         If a cache hit occurs, the cached response is immediately returned without contacting the external server.
+        A stale hit is returned as well, `payload_info["stale"]` then asks for a background refresh.
     """
     if not (CACHE_OPENAI and valid_payload):
         return None, None
 
+    policy = cache_policies.get(EMBEDDING_ROUTE, payload_info['model'])
     cache_key = construct_cache_key(payload_info)
+    if not cache_key:
+        # nothing to look up for an empty input, upstream answers it
+        return None, None
+
+    if payload_info['caching']:
+        hits, stale = {}, False
+        for i, key in enumerate(cache_key):
+            item = db_dict.get(key)
+            if (
+                item is not None
+                and key_matches(item, key)
+                and policy.is_servable(item.get("created"))
+            ):
+                hits[i] = item
+                stale = stale or not policy.is_fresh(item.get("created"))
 
-    if payload_info['caching'] and cache_key in db_dict:
-        logger.info(f'embedding uid: {payload_info["uid"]} >>>>> [cache hit]')
-        cache_data = db_dict[cache_key]
-        content = cache_data['data']
+        cache_stats.hit(EMBEDDING_ROUTE, payload_info['model'], len(hits))
+        cache_stats.miss(
+            EMBEDDING_ROUTE, payload_info['model'], len(cache_key) - len(hits)
+        )
+        if len(hits) == len(cache_key):
+            payload_info["stale"] = stale
+            logger.info(f'embedding uid: {payload_info["uid"]} >>>>> [cache hit]')
+            items = [hits[i] for i in range(len(cache_key))]
+            content = render_embeddings(
+                items, items[0]["model"], payload_info.get("encoding_format")
+            )
+            return Response(content=content, media_type="application/json"), cache_key
 
-        return Response(content=content, media_type="application/json"), cache_key
+        if hits:
+            # stale inputs are refreshed along with the missing ones
+            hits = {
+                i: item
+                for i, item in hits.items()
+                if policy.is_fresh(item.get("created"))
+            }
+            misses, seen = [], set()
+            for i, key in enumerate(cache_key):
+                if i not in hits and key not in seen:
+                    seen.add(key)
+                    misses.append(i)
+            payload_info["embedding_hits"] = hits
+            payload_info["embedding_misses"] = misses
+            logger.info(
+                f'embedding uid: {payload_info["uid"]} >>>>> '
+                f'[partial cache hit {len(hits)}/{len(cache_key)}]'
+            )
 
     return None, cache_key
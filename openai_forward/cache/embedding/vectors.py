@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import base64
+import sys
+from array import array
+from typing import List
+
+from loguru import logger
+
+try:
+    import numpy as np
+
+    NUMPY_VALID = True
+
+except ImportError:
+    NUMPY_VALID = False
+
+
+def _as_float32(embedding: List[float] | str):
+    """
+    An embedding of an upstream response, either a list of floats or base64 encoded
+    little-endian float32, as a float32 array.
+    """
+    if isinstance(embedding, str):
+        raw = base64.b64decode(embedding)
+        if NUMPY_VALID:
+            return np.frombuffer(raw, dtype="<f4")
+        vector = array("f", raw)
+        if sys.byteorder == "big":
+            vector.byteswap()
+        return vector
+    if NUMPY_VALID:
+        return np.asarray(embedding, dtype=np.float32)
+    return array("f", embedding)
+
+
+def pack_vector(embedding: List[float] | str, dtype: str = "float32") -> dict:
+    """
+    Pack an embedding into compact bytes for the cache.
+
+    Args:
+        embedding (List[float] | str): The embedding as returned by upstream.
+        dtype (str): "float32", "float16" or "int8". The latter two need NumPy, int8
+            vectors are scaled by their largest absolute value.
+
+    Returns:
+        dict: `{"vector": bytes, "dtype": str, "scale": float | None}`.
+    """
+    if dtype != "float32" and not NUMPY_VALID:
+        logger.warning(f"{dtype} vectors need `numpy`, falling back to float32")
+        dtype = "float32"
+    vector = _as_float32(embedding)
+    scale = None
+    if not NUMPY_VALID:
+        if sys.byteorder == "big":
+            vector.byteswap()
+        return {"vector": vector.tobytes(), "dtype": dtype, "scale": scale}
+
+    if dtype == "int8":
+        scale = float(np.abs(vector).max()) or 1.0
+        packed = np.round(vector * (127 / scale)).astype(np.int8)
+    else:
+        packed = vector.astype("<f2" if dtype == "float16" else "<f4")
+    return {"vector": packed.tobytes(), "dtype": dtype, "scale": scale}
+
+
+def unpack_vector(entry: dict):
+    """
+    The float32 array of a packed vector, a NumPy array if available.
+    """
+    dtype, raw = entry["dtype"], entry["vector"]
+    if not NUMPY_VALID:
+        if dtype != "float32":
+            raise ImportError(f"`numpy` is needed to read {dtype} vectors")
+        vector = array("f", raw)
+        if sys.byteorder == "big":
+            vector.byteswap()
+        return vector
+    if dtype == "int8":
+        return np.frombuffer(raw, dtype=np.int8).astype(np.float32) * np.float32(
+            entry["scale"] / 127
+        )
+    return np.frombuffer(raw, dtype="<f2" if dtype == "float16" else "<f4").astype(
+        np.float32
+    )
+
+
+def render_vector(entry: dict, encoding_format: str = "float"):
+    """
+    Render a packed vector for a response, as a float array or a base64 string.
+    """
+    vector = unpack_vector(entry)
+    if encoding_format == "base64":
+        if NUMPY_VALID:
+            raw = vector.astype("<f4", copy=False).tobytes()
+        else:
+            if sys.byteorder == "big":
+                vector.byteswap()
+            raw = vector.tobytes()
+        return base64.b64encode(raw).decode()
+    return vector if NUMPY_VALID else vector.tolist()
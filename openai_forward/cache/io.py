@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List
+
+from loguru import logger
+
+from ..config.settings import CACHE_BACKEND, CACHE_WRITE_BEHIND
+
+
+class CacheIO:
+    """
+    Keeps cache database I/O off the event loop.
+
+    Lookups run in a small thread pool. Writes are queued and flushed in batches by a
+    single writer thread, so read-modify-write updates of the same key never race. When
+    the queue is full, new writes are dropped rather than blocking the responses.
+
+    With `offload=False`, e.g. for the in-memory backend, lookups run inline. Writes are
+    always queued, they may render frames or count tokens, and only run inline outside
+    of an event loop.
+    """
+
+    def __init__(
+        self,
+        offload: bool = True,
+        max_pending: int = 1024,
+        batch_size: int = 64,
+        flush_interval: float = 0.05,
+        read_workers: int = 4,
+    ):
+        """
+        Args:
+            offload (bool): Whether to run lookups in threads.
+            max_pending (int): Maximum number of queued writes.
+            batch_size (int): Maximum number of writes flushed at once.
+            flush_interval (float): Seconds to wait for more writes before flushing a batch.
+            read_workers (int): Threads for lookups.
+        """
+        self.offload = offload
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.read_workers = read_workers
+
+        self._reader: ThreadPoolExecutor | None = None
+        self._writer: ThreadPoolExecutor | None = None
+        self._queue: asyncio.Queue | None = None
+        self._flusher: asyncio.Task | None = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def _ensure_started(self):
+        if self._flusher is None or self._flusher.done():
+            self._queue = asyncio.Queue(self.max_pending)
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        Asynchronously run a cache lookup.
+        """
+        if not self.offload:
+            return func(*args, **kwargs)
+        if self._reader is None:
+            self._reader = ThreadPoolExecutor(
+                self.read_workers, thread_name_prefix="cache-read"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, partial(func, *args, **kwargs))
+
+    def submit(self, func: Callable, *args, **kwargs):
+        """
+        Queue a cache write, it is executed later in the writer thread.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(partial(func, *args, **kwargs))
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(partial(func, *args, **kwargs))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("cache write queue is full, a write was dropped")
+
+    async def write(self, func: Callable, *args, **kwargs):
+        """
+        Asynchronously run a cache write in the writer thread, after the writes queued
+        before it, and return its result. Unlike `submit` it waits for a full queue
+        instead of dropping the write.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(result, error):
+            if not future.done():
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+        def write():
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                loop.call_soon_threadsafe(settle, None, e)
+                raise
+            loop.call_soon_threadsafe(settle, result, None)
+
+        self._ensure_started()
+        await self._queue.put(write)
+        return await future
+
+    def _write(self, write: Callable):
+        try:
+            write()
+            self.written += 1
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"cache write error: {e!r}")
+
+    def _write_batch(self, batch: List[Callable]):
+        for write in batch:
+            self._write(write)
+
+    async def _flush_forever(self):
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(1, thread_name_prefix="cache-write")
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Callable]):
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(
+            self._writer, self._write_batch, batch
+        )
+        self.flushes += 1
+        self.last_flush_latency = time.perf_counter() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+    async def close(self):
+        """
+        Asynchronously flush the pending writes and stop the threads.
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+            pending = []
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            if pending:
+                await self._flush(pending)
+        for executor in (self._reader, self._writer):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._reader = self._writer = None
+
+    def stats(self) -> dict:
+        return {
+            "offload": self.offload,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_pending": self.max_pending,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_latency": round(self.last_flush_latency, 6),
+            "max_flush_latency": round(self.max_flush_latency, 6),
+        }
+
+
+cache_io = CacheIO(offload=CACHE_BACKEND.upper() != "MEMORY", **CACHE_WRITE_BEHIND)
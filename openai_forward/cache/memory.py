@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+from flaxkv.pack import decode, encode
+from loguru import logger
+
+# rough memory footprint of an entry besides its key and value bytes
+_ENTRY_OVERHEAD = 100
+
+
+class MemoryCache:
+    """
+    An in-process cache with a memory budget, LRU eviction and per route/model TTLs.
+
+    Values are stored packed as bytes, which is both compact and safe from callers
+    mutating cached objects. The dict-like interface matches `FlaxKV`, so it can stand in
+    for it as `db_dict`. It is safe to write from the cache writer thread while the
+    event loop reads.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256 << 20,
+        ttl: Dict | None = None,
+        on_remove: Callable[[Any], None] | None = None,
+    ):
+        """
+        Args:
+            max_size (int): Memory budget in bytes.
+            ttl (Dict | None): Seconds entries live, e.g.
+                `{"default": 86400, "routes": {"/v1/embeddings": 3600}, "models": {"gpt-4o": 600}}`.
+                A model TTL takes precedence over a route TTL. 0 or absent for no expiry.
+            on_remove (Callable[[Any], None] | None): Called with the key of every entry
+                the cache drops by itself, i.e. evicted, expired or too large to keep.
+        """
+        self.max_size = max_size
+        ttl = ttl or {}
+        self.default_ttl = ttl.get("default", 0)
+        self.route_ttl: Dict[str, float] = ttl.get("routes", {})
+        self.model_ttl: Dict[str, float] = ttl.get("models", {})
+
+        # key -> (packed value, expire time or None)
+        self._data: OrderedDict[Any, Tuple[bytes, float | None]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.on_remove = on_remove
+        self._lock = threading.RLock()
+
+    def ttl_for(self, route_path: str | None = None, model: str | None = None) -> float:
+        if model is not None and model in self.model_ttl:
+            return self.model_ttl[model]
+        if route_path is not None and route_path in self.route_ttl:
+            return self.route_ttl[route_path]
+        return self.default_ttl
+
+    @staticmethod
+    def _entry_size(key, packed: bytes) -> int:
+        key_size = len(key) if isinstance(key, (bytes, str)) else 0
+        return key_size + len(packed) + _ENTRY_OVERHEAD
+
+    def _lookup(self, key) -> bytes | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            packed, expire_at = entry
+            if expire_at is not None and expire_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self._notify_remove(key)
+                return None
+            self._data.move_to_end(key)
+            return packed
+
+    def _remove(self, key):
+        packed, _ = self._data.pop(key)
+        self.size -= self._entry_size(key, packed)
+
+    def _notify_remove(self, key):
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def set(
+        self,
+        key,
+        value,
+        route_path: str | None = None,
+        model: str | None = None,
+        ttl: float | None = None,
+    ):
+        """
+        Store a value, with the TTL of its route and model unless `ttl` is given.
+
+        Returns:
+            int: The bytes the entry takes, 0 if it was not stored because it exceeds the
+                budget.
+        """
+        packed = encode(value)
+        entry_size = self._entry_size(key, packed)
+        if ttl is None:
+            ttl = self.ttl_for(route_path, model)
+        expire_at = time.monotonic() + ttl if ttl and ttl > 0 else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if entry_size > self.max_size:
+                logger.warning(
+                    f"cache value of {entry_size} bytes exceeds max_size, skipped"
+                )
+                self._notify_remove(key)
+                return 0
+
+            while self._data and self.size + entry_size > self.max_size:
+                old_key, (old_packed, _) = self._data.popitem(last=False)
+                self.size -= self._entry_size(old_key, old_packed)
+                self.evictions += 1
+                self._notify_remove(old_key)
+
+            self._data[key] = (packed, expire_at)
+            self.size += entry_size
+        return entry_size
+
+    def get(self, key, default=None):
+        packed = self._lookup(key)
+        if packed is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return decode(packed)
+
+    def peek(self, key, default=None):
+        """
+        Read a value without counting a hit or making it the most recently used one.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None:
+            return default
+        packed, expire_at = entry
+        if expire_at is not None and expire_at <= time.monotonic():
+            return default
+        return decode(packed)
+
+    def __getitem__(self, key):
+        packed = self._lookup(key)
+        if packed is None:
+            raise KeyError(key)
+        return decode(packed)
+
+    def __setitem__(self, key, value):
+        route_path = value.get("route_path") if isinstance(value, dict) else None
+        model = value.get("model") if isinstance(value, dict) else None
+        self.set(key, value, route_path, model)
+
+    def __contains__(self, key):
+        if self._lookup(key) is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._data:
+                raise KeyError(key)
+            self._remove(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self._data),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import time
+from typing import Any, Dict, List, Tuple
+
+import orjson
+
+from ..config.settings import (
+    CACHE_POLICY,
+    CACHE_TTL,
+    CHAT_COMPLETION_ROUTE,
+    EMBEDDING_ROUTE,
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+REPLAY_MODES = ("instant", "recorded", "throttled")
+
+# version of the cache key derivation, entries stored under another one are never hit:
+# 1 the raw payload, 2 the canonical key fields of a policy, 3 their 128-bit digest
+CACHE_KEY_VERSION = 3
+
+# fields of the parsed payload that form the cache key, the order is part of the key
+CHAT_KEY_FIELDS = [
+    "n",
+    "messages",
+    "model",
+    "max_tokens",
+    "response_format",
+    "seed",
+    "tools",
+    "tool_choice",
+]
+# the vector is rendered in the requested `encoding_format`, so it is not part of the key
+EMBEDDING_KEY_FIELDS = ["model", "input", "dimensions"]
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+_ROUTE_DEFAULTS = {
+    CHAT_COMPLETION_ROUTE: {"key_fields": CHAT_KEY_FIELDS, "max_variants": 10},
+    EMBEDDING_ROUTE: {"key_fields": EMBEDDING_KEY_FIELDS, "max_variants": 1},
+}
+
+
+class CacheKey(bytes):
+    """
+    A fixed-size cache key, the 128-bit BLAKE2b digest of the canonical payload it was
+    built from.
+
+    The payload is kept along, it is stored in the cached value so a hash collision is
+    detected on lookup. The database itself only sees the 16 bytes of the digest.
+    """
+
+    payload: bytes
+
+    def __new__(cls, payload: bytes):
+        key = super().__new__(cls, hashlib.blake2b(payload, digest_size=16).digest())
+        key.payload = payload
+        return key
+
+
+def key_payload(key) -> bytes | None:
+    """The canonical payload of a key, None for a plain key."""
+    return getattr(key, "payload", None)
+
+
+def key_matches(value, key) -> bool:
+    """
+    Whether a cached value was stored for the payload of the key, rather than for another
+    payload with the same digest.
+    """
+    stored = value.get("payload") if isinstance(value, dict) else None
+    # values stored without their payload can not be checked
+    return stored is None or key_payload(key) in (None, stored)
+
+
+class CachePolicy:
+    """
+    How the responses of a route, or of a model on it, are cached.
+    """
+
+    def __init__(
+        self,
+        key_fields: List[str] | None = None,
+        normalize: Dict | None = None,
+        ttl: float | None = None,
+        max_variants: int = 3,
+        deterministic: bool = True,
+        stale_while_revalidate: float | None = None,
+        replay: str = "throttled",
+        vector_dtype: str = "float32",
+    ):
+        """
+        Args:
+            key_fields (List[str] | None): Payload fields that form the cache key, None for
+                the whole payload.
+            normalize (Dict | None): `{"whitespace": bool, "sort_keys": bool}`, whether runs
+                of whitespace in strings are collapsed and whether the order of object keys
+                is ignored when building the key.
+            ttl (float | None): Seconds a cached entry is fresh, 0 or None for no expiry.
+            max_variants (int): Maximum number of responses cached for one key, a hit
+                returns one of them at random.
+            deterministic (bool): Whether a request with temperature 0 or a `seed` is
+                treated as deterministic, so a single cached response is enough.
+            stale_while_revalidate (float | None): Seconds an expired entry is still served
+                while it is refreshed in the background, None for as long as the TTL, 0 to
+                disable.
+            replay (str): How cached streams are replayed, "instant" all at once,
+                "recorded" with the timing of the original stream or "throttled" with the
+                token rate limit.
+            vector_dtype (str): How cached embeddings are stored, "float32", "float16" or
+                "int8" quantized.
+        """
+        if replay not in REPLAY_MODES:
+            raise ValueError(f"replay must be one of {REPLAY_MODES}, got {replay!r}")
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(
+                f"vector_dtype must be one of {VECTOR_DTYPES}, got {vector_dtype!r}"
+            )
+        self.key_fields = list(key_fields) if key_fields else None
+        normalize = normalize or {}
+        self.whitespace = normalize.get("whitespace", False)
+        self.sort_keys = normalize.get("sort_keys", False)
+        self.ttl = ttl
+        self.max_variants = max_variants
+        self.deterministic = deterministic
+        if stale_while_revalidate is None:
+            stale_while_revalidate = ttl or 0
+        self.stale_while_revalidate = stale_while_revalidate
+        self.replay = replay
+        self.vector_dtype = vector_dtype
+
+    @property
+    def retention(self) -> float:
+        """Seconds an entry has to be kept, 0 for no expiry."""
+        return self.ttl + self.stale_while_revalidate if self.ttl else 0
+
+    def normalize(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return _WHITESPACE.sub(" ", value).strip() if self.whitespace else value
+        if isinstance(value, dict):
+            items = sorted(value.items()) if self.sort_keys else value.items()
+            return {k: self.normalize(v) for k, v in items}
+        if isinstance(value, (list, tuple)):
+            return [self.normalize(v) for v in value]
+        return value
+
+    def canonical(self, payload: Dict) -> bytes:
+        """
+        The canonical byte form of the fields of a parsed payload that form the key.
+        """
+        if self.key_fields is None:
+            elements = payload
+        else:
+            elements = [payload.get(field) for field in self.key_fields]
+        if self.whitespace or self.sort_keys:
+            elements = self.normalize(elements)
+        return orjson.dumps(elements, option=orjson.OPT_NON_STR_KEYS)
+
+    def make_key(self, payload: Dict) -> CacheKey:
+        """
+        Build the cache key from the fields of a parsed payload.
+        """
+        return CacheKey(self.canonical(payload))
+
+    def make_raw_key(self, payload: bytes) -> CacheKey:
+        """
+        Build the cache key from a raw request body, e.g. of a general route.
+
+        Without key fields or normalization the body is hashed as it is, without
+        parsing it.
+        """
+        if self.key_fields is None and not (self.whitespace or self.sort_keys):
+            return CacheKey(bytes(payload))
+        try:
+            return self.make_key(orjson.loads(payload))
+        except (orjson.JSONDecodeError, AttributeError, TypeError):
+            return CacheKey(bytes(payload))
+
+    def is_deterministic(self, payload: Dict) -> bool:
+        return self.deterministic and (
+            payload.get("temperature") == 0 or payload.get("seed") is not None
+        )
+
+    def variants_for(self, payload: Dict | None) -> int:
+        if payload is not None and self.is_deterministic(payload):
+            return 1
+        return self.max_variants
+
+    def is_fresh(self, created: float | None) -> bool:
+        # entries written before timestamps were stored never expire
+        if not self.ttl or created is None:
+            return True
+        return time.time() - created < self.ttl
+
+    def is_servable(self, created: float | None) -> bool:
+        """Whether an entry may be served, either fresh or stale but to be revalidated."""
+        if self.is_fresh(created):
+            return True
+        return time.time() - created < self.retention
+
+
+class CachePolicies:
+    """
+    Resolves the `CachePolicy` of a route and model from the `cache.policy` setting.
+
+    Options are merged in the order: built-in route defaults, `default`, `routes`,
+    `models`. The TTL falls back to the `cache.ttl` setting.
+    """
+
+    def __init__(self, config: Dict | None = None, ttl: Dict | None = None):
+        config = config or {}
+        self.default: Dict = config.get("default", {})
+        self.routes: Dict[str, Dict] = config.get("routes", {})
+        self.models: Dict[str, Dict] = config.get("models", {})
+        ttl = ttl or {}
+        self.default_ttl = ttl.get("default", 0)
+        self.route_ttl: Dict[str, float] = ttl.get("routes", {})
+        self.model_ttl: Dict[str, float] = ttl.get("models", {})
+        self._policies: Dict[Tuple[str, str | None], CachePolicy] = {}
+
+    def _ttl_for(self, route_path: str, model: str | None) -> float:
+        if model is not None and model in self.model_ttl:
+            return self.model_ttl[model]
+        return self.route_ttl.get(route_path, self.default_ttl)
+
+    def get(self, route_path: str, model: str | None = None) -> CachePolicy:
+        # models without settings of their own share the policy of the route
+        if model not in self.models and model not in self.model_ttl:
+            model = None
+        policy = self._policies.get((route_path, model))
+        if policy is None:
+            options = {
+                **_ROUTE_DEFAULTS.get(route_path, {}),
+                **self.default,
+                **self.routes.get(route_path, {}),
+                **self.models.get(model, {}),
+            }
+            if options.get("ttl") is None:
+                options["ttl"] = self._ttl_for(route_path, model)
+            policy = self._policies[(route_path, model)] = CachePolicy(**options)
+        return policy
+
+
+cache_policies = CachePolicies(CACHE_POLICY, CACHE_TTL)
@@ -0,0 +1,330 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import aiohttp
+from flaxkv.pack import decode, encode
+from loguru import logger
+
+from ..config.settings import (
+    CACHE_BACKEND,
+    CACHE_ROOT_PATH_OR_URL,
+    CACHE_SEMANTIC,
+    CHAT_COMPLETION_ROUTE,
+)
+from .chat.response import get_response_from_value
+from .chat.tokenizer import message_text
+from .database import db_dict
+from .embedding.vectors import NUMPY_VALID
+from .io import cache_io
+from .policy import CachePolicy, cache_policies
+
+if NUMPY_VALID:
+    import numpy as np
+
+
+class SemanticIndex:
+    """
+    A bounded in-process index of prompt embeddings for similarity search.
+
+    Vectors are normalized and quantized to int8, so an entry of a 1536 dimensional
+    model takes 1.5 KB. A search is one vectorized dot product over the entries of the
+    same scope. Once `capacity` entries are stored, the least recently used one is
+    evicted.
+    """
+
+    def __init__(self, capacity: int = 10_000, path: str | Path | None = None):
+        """
+        Args:
+            capacity (int): Maximum number of entries.
+            path (str | Path | None): File of the snapshot.
+        """
+        self.capacity = capacity
+        self.path = Path(path) if path else None
+        self.dim: int | None = None
+        self._vectors = None
+        self._scopes = np.zeros(capacity, dtype=np.uint64)
+        # time of the last insert or hit of every slot, 0 for a free one
+        self._used = np.zeros(capacity, dtype=np.float64)
+        self._keys: List[bytes | None] = [None] * capacity
+        self._slots: Dict[bytes, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    @staticmethod
+    def quantize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(vector)) or 1.0
+        return np.round(vector * (127 / norm)).astype(np.int8)
+
+    def _reset(self, dim: int):
+        if self.dim is not None:
+            logger.warning(
+                f"semantic index dimension changed {self.dim} -> {dim}, index cleared"
+            )
+        self.dim = dim
+        self._vectors = np.zeros((self.capacity, dim), dtype=np.int8)
+        self._used[:] = 0
+        self._keys = [None] * self.capacity
+        self._slots.clear()
+
+    def add(self, key: bytes, vector, scope: int):
+        # a `CacheKey` would keep its whole payload in memory
+        key = bytes(key)
+        vector = self.quantize(vector)
+        with self._lock:
+            if self.dim != len(vector):
+                self._reset(len(vector))
+            slot = self._slots.get(key)
+            if slot is None:
+                # a free slot, or the least recently used one
+                slot = int(np.argmin(self._used))
+                evicted = self._keys[slot]
+                if evicted is not None:
+                    del self._slots[evicted]
+                self._keys[slot] = key
+                self._slots[key] = slot
+            self._vectors[slot] = vector
+            self._scopes[slot] = scope
+            self._used[slot] = time.time()
+
+    def remove(self, key: bytes):
+        with self._lock:
+            slot = self._slots.pop(key, None)
+            if slot is not None:
+                self._keys[slot] = None
+                self._used[slot] = 0
+
+    def search(self, vector, scope: int) -> Tuple[bytes | None, float]:
+        """
+        The key of the most similar entry of a scope and its cosine similarity.
+        """
+        vector = self.quantize(vector)
+        with self._lock:
+            if self.dim != len(vector) or not self._slots:
+                return None, 0.0
+            slots = np.flatnonzero((self._scopes == scope) & (self._used > 0))
+            if not len(slots):
+                return None, 0.0
+            scores = self._vectors[slots].astype(np.int32) @ vector.astype(np.int32)
+            best = int(np.argmax(scores))
+            slot = int(slots[best])
+            self._used[slot] = time.time()
+            return self._keys[slot], float(scores[best]) / 127**2
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            slots = np.array(sorted(self._slots.values()), dtype=np.int64)
+            data = encode(
+                {
+                    "dim": self.dim,
+                    "keys": [self._keys[slot] for slot in slots],
+                    "scopes": self._scopes[slots].tobytes(),
+                    "used": self._used[slots].tobytes(),
+                    "vectors": (self._vectors[slots].tobytes() if self.dim else b""),
+                }
+            )
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> bool:
+        """
+        Load the snapshot, the most recently used entries if it exceeds the capacity.
+
+        Returns:
+            bool: Whether the snapshot was loaded.
+        """
+        if self.path is None or not self.path.exists():
+            return False
+        try:
+            data = decode(self.path.read_bytes())
+            dim = data["dim"]
+            keys = data["keys"]
+            scopes = np.frombuffer(data["scopes"], dtype=np.uint64)
+            used = np.frombuffer(data["used"], dtype=np.float64)
+            vectors = np.frombuffer(data["vectors"], dtype=np.int8)
+        except Exception as e:
+            logger.warning(f"invalid semantic index snapshot {self.path}: {e!r}")
+            return False
+        if not dim or not keys:
+            return True
+        order = np.argsort(-used)[: self.capacity]
+        vectors = vectors.reshape(len(keys), dim)
+        with self._lock:
+            self._reset(dim)
+            n = len(order)
+            self._vectors[:n] = vectors[order]
+            self._scopes[:n] = scopes[order]
+            self._used[:n] = used[order]
+            for slot, i in enumerate(order):
+                self._keys[slot] = keys[i]
+                self._slots[keys[i]] = slot
+        return True
+
+
+class SemanticCache:
+    """
+    A cache tier for chat completions that also hits on similar, not only identical,
+    prompts.
+
+    The last user message is embedded with an OpenAI compatible embedding endpoint,
+    e.g. a local embedding server, and looked up in a `SemanticIndex`. The index is
+    partitioned by everything else that forms the cache key, so only the last user
+    message may differ. A hit above the similarity threshold serves the cached response
+    of the similar prompt through the usual replay path.
+    """
+
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        base_url: str = "https://api.openai.com",
+        api_key: str | None = None,
+        threshold: float = 0.95,
+        capacity: int = 10_000,
+        timeout: float = 5,
+        path: str | Path | None = None,
+    ):
+        """
+        Args:
+            model (str): The embedding model.
+            base_url (str): Base URL of the embedding endpoint.
+            api_key (str | None): Key of the embedding endpoint, if it needs one.
+            threshold (float): Minimum cosine similarity of a hit.
+            capacity (int): Maximum number of indexed prompts.
+            timeout (float): Seconds to wait for an embedding, the request is then
+                treated as a miss.
+            path (str | Path | None): File of the index snapshot.
+        """
+        self.model = model
+        self.url = f"{base_url.rstrip('/')}/v1/embeddings"
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.threshold = threshold
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.index = SemanticIndex(capacity, path)
+        self.index.load()
+        self._session: aiohttp.ClientSession | None = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def query(payload_info: dict, policy: CachePolicy) -> Tuple[str | None, int]:
+        """
+        The text of the last user message of a request, and the scope of the rest of
+        its cache key.
+        """
+        messages = payload_info.get("messages") or []
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get("role") == "user":
+                break
+        else:
+            return None, 0
+        text = message_text(messages[i])
+        context = [*messages[:i], {"role": "user"}, *messages[i + 1 :]]
+        key = policy.make_key({**payload_info, "messages": context})
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return text or None, int.from_bytes(digest, "little")
+
+    async def embed(self, text: str):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        try:
+            async with self._session.post(
+                self.url,
+                json={"model": self.model, "input": text, "encoding_format": "base64"},
+                headers=self.headers,
+            ) as r:
+                r.raise_for_status()
+                result = await r.json()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"semantic cache embedding error: {e!r}")
+            return None
+        embedding = result["data"][0]["embedding"]
+        if isinstance(embedding, str):
+            return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+        return np.asarray(embedding, dtype=np.float32)
+
+    def find(self, vector, scope: int, policy: CachePolicy):
+        """
+        The fresh cached value of the most similar prompt, if it is similar enough.
+        """
+        key, similarity = self.index.search(vector, scope)
+        if key is None or similarity < self.threshold:
+            return None, similarity
+        value = db_dict.get(key)
+        if value is None or not policy.is_fresh(value.get("created")):
+            self.index.remove(key)
+            return None, similarity
+        return value, similarity
+
+    async def lookup(self, payload_info: dict, request, **kwargs):
+        """
+        Asynchronously look up a response of a similar prompt.
+
+        On a miss, the embedding is kept in `payload_info["semantic"]`, so the response
+        is indexed once it is cached.
+        """
+        policy = cache_policies.get(CHAT_COMPLETION_ROUTE, payload_info["model"])
+        text, scope = self.query(payload_info, policy)
+        if text is None:
+            return None
+        vector = await self.embed(text)
+        if vector is None:
+            return None
+
+        value, similarity = await cache_io.run(self.find, vector, scope, policy)
+        if value is None:
+            self.misses += 1
+            payload_info["semantic"] = (vector, scope)
+            return None
+        self.hits += 1
+        logger.info(
+            f'chat uid: {payload_info["uid"]} >>>>> '
+            f'[semantic cache hit {similarity:.3f}]'
+        )
+        return get_response_from_value(
+            value, payload_info, request, policy=policy, **kwargs
+        )
+
+    def add(self, cache_key: bytes, vector, scope: int):
+        self.index.add(cache_key, vector, scope)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self.index.save()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.index),
+            "capacity": self.index.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+semantic_cache = None
+if CACHE_SEMANTIC.get("enabled", False):
+    if not NUMPY_VALID:
+        logger.warning("the semantic cache needs `numpy`, it is disabled")
+    else:
+        options = {k: v for k, v in CACHE_SEMANTIC.items() if k != "enabled"}
+        if CACHE_BACKEND.lower() in ("leveldb", "lmdb"):
+            options.setdefault(
+                "path", Path(CACHE_ROOT_PATH_OR_URL) / "CACHE_DB.semantic"
+            )
+        semantic_cache = SemanticCache(**options)
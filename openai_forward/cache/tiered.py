@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+_MISSING = object()
+
+
+class TieredCache:
+    """
+    A small in-process LRU of decoded values in front of a persistent store, e.g. a
+    LevelDB/LMDB `FlaxKV`.
+
+    Reads are served from the hot tier when possible and promote values from the store.
+    Writes and deletes go through to the store and update the hot tier, so both tiers
+    never disagree. A value of the hot tier is handed to every reader as it is, so it
+    must never be modified in place, a changed value is written as a new object.
+    """
+
+    def __init__(self, store, max_items: int = 1024, bloom=None):
+        """
+        Args:
+            store: The persistent dict-like store.
+            max_items (int): Number of values kept in the hot tier.
+            bloom (ScalableBloomFilter, optional): A filter over the keys of the store,
+                definite misses skip the store.
+        """
+        self.store = store
+        self.max_items = max_items
+        self.bloom = bloom
+        if bloom is not None and not bloom.load(len(store)):
+            bloom.update(store.keys())
+        self._hot: OrderedDict[Any, Any] = OrderedDict()
+        # lookups and writes may run in different threads, see `CacheIO`
+        self._lock = threading.RLock()
+        self.hot_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _promote(self, key, value):
+        with self._lock:
+            self._hot[key] = value
+            self._hot.move_to_end(key)
+            while len(self._hot) > self.max_items:
+                self._hot.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            value = self._hot.get(key, _MISSING)
+            if value is not _MISSING:
+                self._hot.move_to_end(key)
+                self.hot_hits += 1
+                return value
+        if self.bloom is not None and key not in self.bloom:
+            self.misses += 1
+            return _MISSING
+        value = self.store.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return value
+        self.store_hits += 1
+        with self._lock:
+            # a write that raced with this read wins
+            value = self._hot.setdefault(key, value)
+            self._promote(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        # a hit is promoted, so the `db_dict[key]` that usually follows is served hot
+        return self._lookup(key) is not _MISSING
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.store[key] = value
+            if self.bloom is not None:
+                self.bloom.add(key)
+            self._promote(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._hot.pop(key, None)
+            del self.store[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._hot.pop(key, None)
+            return self.store.pop(key, default)
+
+    def __len__(self):
+        return len(self.store)
+
+    def keys(self):
+        return self.store.keys()
+
+    def clear(self):
+        with self._lock:
+            self._hot.clear()
+            self.store.clear()
+
+    def save_snapshot(self):
+        """
+        Persist the bloom filter, so the next start does not scan the whole store.
+        Only a clean shutdown saves it, any other start rebuilds the filter.
+        """
+        if self.bloom is not None:
+            self.bloom.save(len(self.store))
+
+    def stats(self) -> dict:
+        lookups = self.hot_hits + self.store_hits + self.misses
+        hits = self.hot_hits + self.store_hits
+        bloom = {"bloom": self.bloom.stats()} if self.bloom is not None else {}
+        return {
+            **bloom,
+            "hot_items": len(self._hot),
+            "hot_max_items": self.max_items,
+            "hot_hits": self.hot_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
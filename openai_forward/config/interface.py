@@ -1,5 +1,5 @@
 import json
-from typing import Literal
+from typing import Literal, Union
 
 from attrs import asdict, define, field
 
@@ -24,7 +24,7 @@ class Base:
 
 @define(slots=True)
 class ForwardItem(Base):
-    base_url: str
+    base_url: Union[str, List[str]]
     route: str
     type: Literal["openai", "general"] = field(default="general")
 
@@ -56,6 +56,12 @@ if not config:
 
     CUSTOM_MODEL_CONFIG = env2dict("CUSTOM_MODEL_CONFIG", {})
 
+    RETRY_CONFIG = env2dict("RETRY_CONFIG", {})
+
+    STREAM_REQUEST_BODY = (
+        os.environ.get("STREAM_REQUEST_BODY", "false").strip().lower() == "true"
+    )
+
     token_rate_limit_conf = env2dict("TOKEN_RATE_LIMIT")
     PRINT_CHAT = os.environ.get("PRINT_CHAT", "False").strip().lower() == "true"
 
@@ -72,6 +78,13 @@ if not config:
     )
     CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "MEMORY").strip()
     CACHE_ROOT_PATH_OR_URL = os.environ.get("CACHE_ROOT_PATH_OR_URL", "..").strip()
+    CACHE_MAX_SIZE = os.environ.get("CACHE_MAX_SIZE", "256MB").strip()
+    CACHE_TTL = env2dict("CACHE_TTL", {})
+    CACHE_HOT_SIZE = int(os.environ.get("CACHE_HOT_SIZE", "").strip() or "1024")
+    CACHE_WRITE_BEHIND = env2dict("CACHE_WRITE_BEHIND", {})
+    CACHE_BLOOM = env2dict("CACHE_BLOOM", {})
+    CACHE_POLICY = env2dict("CACHE_POLICY", {})
+    CACHE_SEMANTIC = env2dict("CACHE_SEMANTIC", {})
 
     PROXY = os.environ.get("PROXY", "").strip() or None
     GLOBAL_RATE_LIMIT = os.environ.get("GLOBAL_RATE_LIMIT", "").strip() or "inf"
@@ -118,6 +131,10 @@ else:
 
     CUSTOM_MODEL_CONFIG = config.get('custom_model_config', {})
 
+    RETRY_CONFIG = config.get('retry', {})
+
+    STREAM_REQUEST_BODY = config.get('stream_request_body', False)
+
     PRINT_CHAT = config.get('print_chat', False)
 
     LOG_OPENAI = config.get('log', {}).get('openai', False)
@@ -134,6 +151,13 @@ else:
     LOG_CACHE_DB_INFO = config.get('log_cache_db_info', False)
     CACHE_BACKEND = config.get('cache', {}).get('backend', 'MEMORY')
     CACHE_ROOT_PATH_OR_URL = config.get('cache', {}).get('root_path_or_url', '.')
+    CACHE_MAX_SIZE = config.get('cache', {}).get('max_size', '256MB')
+    CACHE_TTL = config.get('cache', {}).get('ttl', {})
+    CACHE_HOT_SIZE = config.get('cache', {}).get('hot_size', 1024)
+    CACHE_WRITE_BEHIND = config.get('cache', {}).get('write_behind', {})
+    CACHE_BLOOM = config.get('cache', {}).get('bloom', {})
+    CACHE_POLICY = config.get('cache', {}).get('policy', {})
+    CACHE_SEMANTIC = config.get('cache', {}).get('semantic', {})
 
     PROXY = config.get('proxy')
 
@@ -166,23 +190,13 @@ general_additional_start_info = {}
 openai_additional_start_info['cache_routes'] = CACHE_ROUTE_SET
 general_additional_start_info['cache_routes'] = CACHE_ROUTE_SET
 
-OPENAI_BASE_URL = [
-    i['base_url'] for i in FORWARD_CONFIG if i and i.get('type') == 'openai'
-]
-OPENAI_ROUTE_PREFIX = [
-    format_route_prefix(i['route'])
-    for i in FORWARD_CONFIG
-    if i and i.get('type') == 'openai'
-]
-
-GENERAL_BASE_URL = [
-    i['base_url'] for i in FORWARD_CONFIG if i and i.get('type') == 'general'
-]
-GENERAL_ROUTE_PREFIX = [
-    format_route_prefix(i['route'])
-    for i in FORWARD_CONFIG
-    if i and i.get('type') == 'general'
-]
+OPENAI_FORWARD_CONFIG = [i for i in FORWARD_CONFIG if i and i.get('type') == 'openai']
+OPENAI_BASE_URL = [i['base_url'] for i in OPENAI_FORWARD_CONFIG]
+OPENAI_ROUTE_PREFIX = [format_route_prefix(i['route']) for i in OPENAI_FORWARD_CONFIG]
+
+GENERAL_FORWARD_CONFIG = [i for i in FORWARD_CONFIG if i and i.get('type') == 'general']
+GENERAL_BASE_URL = [i['base_url'] for i in GENERAL_FORWARD_CONFIG]
+GENERAL_ROUTE_PREFIX = [format_route_prefix(i['route']) for i in GENERAL_FORWARD_CONFIG]
 
 for openai_route, general_route in zip(OPENAI_ROUTE_PREFIX, GENERAL_ROUTE_PREFIX):
     assert openai_route not in GENERAL_ROUTE_PREFIX
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 from typing import List
 
 from rich.console import Console, Text
@@ -31,18 +33,49 @@ def markdown_print(text="", role: str = None, end="\n", **kwargs):
 # ------------- parse sse -------------
 
 
-def parse_sse_buffer(buffer: bytearray) -> List[str]:
+class SSEParser:
     """
-    Parse SSE buffer into a list of SSE message list.
-
-    Args:
-        buffer (bytearray): The SSE buffer to parse.
-
-    Returns:
-        list: A list of SSE messages.
+    Incremental parser of a server-sent events stream. Events may be split across chunks.
     """
-    sse_str = buffer.decode("utf-8")
 
-    events = sse_str.split("\n\n")
-    events.pop()
-    return events
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        Feed the next chunk of the stream.
+
+        Args:
+            chunk (bytes): The chunk.
+
+        Returns:
+            List[bytes]: The `data` of each event completed by this chunk.
+        """
+        buffer = self._buffer
+        buffer.extend(chunk)
+        events = []
+        start = 0
+        # the boundary of an event may have been split right before this chunk
+        end = buffer.find(b"\n\n", max(self._scanned - 1, 0))
+        while end != -1:
+            data = self._parse_event(buffer[start:end])
+            if data is not None:
+                events.append(data)
+            start = end + 2
+            end = buffer.find(b"\n\n", start)
+        if start:
+            del buffer[:start]
+        self._scanned = len(buffer)
+        return events
+
+    @staticmethod
+    def _parse_event(event: bytearray) -> bytes | None:
+        data_lines = []
+        for line in event.split(b"\n"):
+            if line.startswith(b"data:"):
+                line = line[5:].rstrip(b"\r")
+                data_lines.append(line[1:] if line.startswith(b" ") else line)
+        if not data_lines:
+            return None
+        return bytes(b"\n".join(data_lines))
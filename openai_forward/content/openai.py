@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import os
 import threading
 import time
@@ -12,7 +14,96 @@ from orjson import JSONDecodeError
 from openai_forward.config.settings import DEFAULT_REQUEST_CACHING_VALUE
 
 from ..helper import get_client_ip, get_unique_id, route_prefix_to_str
-from .helper import markdown_print, parse_sse_buffer, print
+from .helper import SSEParser, markdown_print, print
+
+
+class StreamAccumulator(ABC):
+    """
+    Builds the result of a stream response from its events as they arrive.
+    """
+
+    def feed(self, data: bytes):
+        """
+        Feed the data of one event, malformed events are skipped.
+        """
+        if data == b"[DONE]":
+            return
+        try:
+            self._feed(orjson.loads(data))
+        except (JSONDecodeError, KeyError, IndexError, TypeError):
+            pass
+
+    @abstractmethod
+    def _feed(self, event: dict):
+        pass
+
+    @abstractmethod
+    def result(self) -> Dict:
+        pass
+
+
+class CompletionAccumulator(StreamAccumulator):
+    def __init__(self):
+        self._texts: List[str] = []
+
+    def _feed(self, event: dict):
+        self._texts.append(event["choices"][0]["text"])
+
+    def result(self):
+        return {'text': "".join(self._texts)}
+
+
+class ChatAccumulator(StreamAccumulator):
+    """
+    Joins the content deltas of the first choice, or the arguments of its first tool call.
+    """
+
+    def __init__(self):
+        self.role = None
+        self.tool_calls = None
+        self.usage = None
+        self._parts: List[str] = []
+
+    def _feed(self, event: dict):
+        if event.get("usage"):
+            # the last event when the request set `stream_options.include_usage`
+            self.usage = event["usage"]
+        # todo: multiple choices
+        delta = event["choices"][0]["delta"]
+        if self.role is None:
+            self.role = delta.get("role", "assistant")  # always be "assistant"
+        tool_calls = delta.get("tool_calls")
+        if tool_calls:
+            if self.tool_calls is None:
+                """
+                tool_calls:
+                    [{
+                    "index": 0,
+                    "id": 'xx',
+                    'type": 'function',
+                    'function': {'name': 'xxx', 'arguments': ''}
+                     }]
+                """
+                self.tool_calls = tool_calls
+            self._parts.append(tool_calls[0]["function"].get("arguments") or "")
+        elif self.tool_calls is None:
+            self._parts.append(delta.get("content") or "")
+
+    def result(self):
+        if self.role is None:
+            return {}
+        if self.tool_calls is not None:
+            self.tool_calls[0]["function"]["arguments"] = "".join(self._parts)
+            return {
+                self.role: self.tool_calls,
+                "is_tool_calls": True,
+                "usage": self.usage,
+            }
+        return {
+            self.role: "".join(self._parts),
+            "is_tool_calls": False,
+            "usage": self.usage,
+        }
 
 
 class LoggerBase(ABC):
@@ -60,6 +151,23 @@ class LoggerBase(ABC):
     def parse_bytearray(buffer: bytearray) -> Dict:
         pass
 
+    def stream_accumulator(self) -> StreamAccumulator | None:
+        """
+        Returns:
+            StreamAccumulator | None: A new accumulator that builds the result of a stream
+                response event by event, None if this kind of response is not streamed.
+        """
+        return None
+
+    def parse_stream(self, buffer: bytes) -> Dict:
+        """
+        Parse a whole SSE stream response with the accumulator of this logger.
+        """
+        accumulator = self.stream_accumulator()
+        for data in SSEParser().feed(buffer):
+            accumulator.feed(data)
+        return accumulator.result()
+
     @abstractmethod
     def log_result(self, *args, **kwargs):
         pass
@@ -91,8 +199,7 @@ class CompletionLogger(LoggerBase):
         }
         return content, raw_payload
 
-    @staticmethod
-    def parse_bytearray(buffer: bytearray):
+    def parse_bytearray(self, buffer: bytearray):
         """
         Parses a bytearray, usually from an API response, into a dictionary containing various information.
 
@@ -103,41 +210,14 @@ class CompletionLogger(LoggerBase):
             Dict[str, Any]: A dictionary containing metadata and content. The keys include:
                 - "text" (str)
         """
-        start_token = "data: "
-        start_token_len = len(start_token)
         if buffer.startswith(b'data: '):
-            txt_lines = parse_sse_buffer(buffer)
-            stream = True
-            first_dict = orjson.loads(txt_lines[0][start_token_len:])
-            text = first_dict["choices"][0]["text"]
-        else:
-            stream = False
-            first_dict = orjson.loads(buffer)
-            text = first_dict["choices"][0]["text"]
-
-        target_info = dict()
-        verbose = False
-        if verbose:
-            target_info["created"] = first_dict["created"]
-            target_info["id"] = first_dict["id"]
-            target_info["model"] = first_dict["model"]
-            target_info["usage"] = first_dict.get("usage")
-
-        target_info['text'] = text
-
-        if not stream:
-            return target_info
-
-        # loop for stream
-        for line in txt_lines[1:]:
-            if line.startswith(start_token):
-                try:
-                    line_dict = orjson.loads(line[start_token_len:])
-                    text += line_dict["choices"][0]["text"]
-                except (JSONDecodeError, KeyError):
-                    pass
-        target_info['text'] = text
-        return target_info
+            return self.parse_stream(buffer)
+
+        first_dict = orjson.loads(buffer)
+        return {'text': first_dict["choices"][0]["text"]}
+
+    def stream_accumulator(self):
+        return CompletionAccumulator()
 
     def log_result(self, chat_info: dict):
         """
@@ -189,6 +269,7 @@ class ChatLogger(LoggerBase):
             "messages": payload["messages"],
             "model": payload["model"],
             "stream": payload.get("stream", False),
+            "stream_options": payload.get("stream_options", None),
             "max_tokens": payload.get("max_tokens", None),
             "response_format": payload.get("response_format", None),
             "n": payload.get("n", 1),
@@ -221,93 +302,24 @@ class ChatLogger(LoggerBase):
             Dict[str, Any]: A dictionary containing metadata and content. The keys include:
                 - "assistant" (str): content
                 - "is_tool_calls" (boolean)
+                - "usage" (dict | None): token usage, if the response reported it
         """
-        start_token = "data: "
-        start_token_len = len(start_token)
         if buffer.startswith(b'data: '):
-            txt_lines = parse_sse_buffer(buffer)
-            stream = True
-            first_dict = orjson.loads(txt_lines[0][start_token_len:])
-            # todo: multiple choices
-            msg = first_dict["choices"][0]["delta"]
-        else:
-            stream = False
-            first_dict = orjson.loads(buffer)
-            # todo: multiple choices
-            msg = first_dict["choices"][0]["message"]
-
-        target_info = dict()
-        verbose = False
-        if verbose:
-            target_info["created"] = first_dict["created"]
-            target_info["id"] = first_dict["id"]
-            target_info["model"] = first_dict["model"]
-            target_info["role"] = msg["role"]
+            return self.parse_stream(buffer)
+
+        first_dict = orjson.loads(buffer)
+        # todo: multiple choices
+        msg = first_dict["choices"][0]["message"]
         role = msg["role"]  # always be "assistant"
 
-        content, tool_calls = msg.get("content"), msg.get("tool_calls")
+        tool_calls = msg.get("tool_calls")
+        usage = first_dict.get("usage")
         if tool_calls:
-            """
-            tool_calls:
-                [{
-                "index": 0,
-                "id": 'xx',
-                'type": 'function',
-                'function': {'name': 'xxx', 'arguments': ''}
-                 }]
-            """
-            target_info[role] = tool_calls
-            target_info["is_tool_calls"] = True
-            parse_content_key = "tool_calls"
+            return {role: tool_calls, "is_tool_calls": True, "usage": usage}
+        return {role: msg.get("content"), "is_tool_calls": False, "usage": usage}
 
-        else:
-            target_info[role] = content
-            target_info["is_tool_calls"] = False
-            parse_content_key = "content"
-
-        if not stream:
-            return target_info
-
-        # loop for stream
-        stream_content = ""
-        for line in txt_lines[1:]:
-            if line.startswith(start_token):
-                stream_content += self._parse_one_line_content(
-                    line[start_token_len:], parse_content_key
-                )
-        if target_info['is_tool_calls']:
-            tool_calls[0]['function']['arguments'] = stream_content
-            target_info[role] = tool_calls
-        else:
-            target_info[role] = stream_content
-        return target_info
-
-    @staticmethod
-    def _parse_one_line_content(line: str, parse_key="content"):
-        """
-        Helper method to parse a single line.
-
-        Args:
-            line (str): The line to parse.
-            parse_key (str): .
-
-        Returns:
-            str: The parsed content from the line.
-        """
-        try:
-            line_dict = orjson.loads(line)
-            if parse_key == "content":
-                return line_dict["choices"][0]["delta"][parse_key]
-            elif parse_key == "tool_calls":
-                tool_calls = line_dict["choices"][0]["delta"]["tool_calls"]
-                return tool_calls[0]["function"]['arguments']
-            else:
-                logger.error(f"Unknown parse key: {parse_key}")
-                return ""
-        except JSONDecodeError:
-            return ""
-        except KeyError:
-            return ""
+    def stream_accumulator(self):
+        return ChatAccumulator()
 
     def log(self, chat_info: dict):
         """
@@ -374,6 +386,7 @@ class EmbeddingLogger(LoggerBase):
             "input": payload['input'],
             "model": payload['model'],
             "encoding_format": payload.get("encoding_format", 'float'),
+            "dimensions": payload.get("dimensions", None),
             "ip": get_client_ip(request) or "",
             "uid": uid,
             "caching": caching,
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import asyncio
 import inspect
 import random
@@ -8,6 +10,8 @@ from typing import Callable
 from fastapi import Request
 from loguru import logger
 
+from .helper import parse_retry_after
+
 
 def retry(max_retries=3, delay=1, backoff=2, exceptions=(Exception,)):
     """
@@ -48,11 +52,42 @@ def retry(max_retries=3, delay=1, backoff=2, exceptions=(Exception,)):
     return decorator
 
 
+class RetryBudget:
+    """
+    A token bucket that caps retries to a ratio of the calls, to avoid retry storms.
+    """
+
+    def __init__(self, ratio=0.1, burst=10):
+        """
+        Args:
+            ratio (float): Retries allowed per call.
+            burst (float): Maximum number of retries that can be saved up.
+        """
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+
+    def deposit(self):
+        self._tokens = min(self._tokens + self.ratio, self.burst)
+
+    def try_acquire(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
 def async_retry(
     max_retries=3,
     delay=1,
     backoff=2,
     exceptions=(Exception,),
+    fail_fast_exceptions=(),
+    retry_on_status=(),
+    max_retry_after=5,
+    jitter=False,
+    budget: RetryBudget | None = None,
+    retry_handler_name=None,
     raise_callback_name=None,
     raise_handler_name=None,
 ):
@@ -64,6 +99,17 @@ def async_retry(
         delay (float): The initial delay between retries in seconds.
         backoff (float): The multiplier by which the delay should increase after each retry.
         exceptions (tuple): A tuple of exception classes upon which to retry.
+        fail_fast_exceptions (tuple): A tuple of exception classes that are passed to the error
+            handler at once without retrying, e.g. when a circuit breaker is open.
+        retry_on_status (tuple): Status codes of a returned response upon which to retry. The
+            response is released and its `Retry-After` header honored. When retries run out
+            the last response is returned.
+        max_retry_after (float): A response asking to wait longer than this is returned as is.
+        jitter (bool): Whether to randomize the delays.
+        budget (RetryBudget): A budget shared by all calls that every retry is paid from.
+        retry_handler_name (str): A method called with the same arguments before each retry,
+            e.g. to switch to another upstream. It may return False to give up retrying,
+            e.g. when the request body can not be sent again.
         raise_callback_name (str): A callback function to call when the maximum number of retries is reached.
         raise_handler_name (str): A error handler function to call when the maximum number of retries is reached.
 
@@ -72,18 +118,68 @@ def async_retry(
         Raises the last encountered exception if the function never succeeds.
     """
 
+    def may_retry(retries):
+        return retries < max_retries and (budget is None or budget.try_acquire())
+
+    def next_delay(current_delay):
+        if jitter:
+            return current_delay / 2 + random.uniform(0, current_delay / 2)
+        return current_delay
+
+    def prepare_retry(args, kwargs) -> bool:
+        if retry_handler_name:
+            retry_handler: Callable = getattr(args[0], retry_handler_name, None)
+            if retry_handler:
+                return retry_handler(*args[1:], **kwargs) is not False
+        return True
+
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             retries = 0
             current_delay = delay
+            if budget is not None:
+                budget.deposit()
             while retries <= max_retries:
                 try:
                     result = await func(*args, **kwargs)
-                    return result
+                    status = getattr(result, "status", None)
+                    if not retry_on_status or status not in retry_on_status:
+                        return result
+                    retry_after = parse_retry_after(result.headers)
+                    if (
+                        (retry_after is not None and retry_after > max_retry_after)
+                        or not may_retry(retries)
+                        or not prepare_retry(args, kwargs)
+                    ):
+                        return result
+
+                    result.release()
+                    retries += 1
+                    sleep_time = max(retry_after or 0, next_delay(current_delay))
+                    logger.warning(
+                        f"Status:{status}\n"
+                        f"Retrying `{func.__name__}` after {sleep_time:.2f} seconds, "
+                        f"retry : {retries}\n"
+                    )
+                    await asyncio.sleep(sleep_time)
+                    current_delay *= backoff
+                    continue
+                except fail_fast_exceptions as e:
+                    if raise_handler_name:
+                        raise_handler: Callable = getattr(
+                            args[0], raise_handler_name, None
+                        )
+                        if raise_handler:
+                            raise_handler(e)
+                    raise
                 except exceptions as e:
 
-                    if retries == max_retries:
+                    if (
+                        retries == max_retries
+                        or (budget is not None and not budget.try_acquire())
+                        or not prepare_retry(args, kwargs)
+                    ):
                         # Experimental
                         if raise_callback_name:
                             self = args[0]
@@ -110,11 +206,13 @@ def async_retry(
                         raise
 
                     retries += 1
+                    sleep_time = next_delay(current_delay)
                     logger.warning(
                         f"Error:{type(e)}\n"
-                        f"Retrying `{func.__name__}` after {current_delay} seconds, retry : {retries}\n"
+                        f"Retrying `{func.__name__}` after {sleep_time:.2f} seconds, "
+                        f"retry : {retries}\n"
                     )
-                    await asyncio.sleep(current_delay)
+                    await asyncio.sleep(sleep_time)
                     current_delay *= backoff
 
         return wrapper
@@ -169,6 +267,29 @@ def async_token_rate_limit(token_rate_limit: dict):
     return decorator
 
 
+def get_token_interval(
+    request: Request, token_rate_limit: dict, key_level_map: dict
+) -> float:
+    """
+    Get the minimum interval between two streamed tokens of a request.
+
+    Args:
+        request (Request): The incoming request.
+        token_rate_limit (dict): A dictionary mapping route paths to their respective token
+            intervals (in seconds).
+        key_level_map (dict): A dictionary mapping keys to their levels.
+
+    Returns:
+        float: The interval in seconds, 0 if not limited.
+    """
+    route_path = f"{request.scope.get('root_path')}{request.scope.get('path')}"
+    fk_or_sk = request.headers.get("Authorization", "default")
+    level = key_level_map.get(fk_or_sk, 0)
+    default_interval = 0
+    token_level_dict = token_rate_limit.get(route_path, {level: default_interval})
+    return token_level_dict[level]
+
+
 def async_token_rate_limit_auth_level(token_rate_limit: dict, key_level_map: dict):
     """
     A decorator for rate-limiting requests based on tokens. It limits the rate at which tokens can be consumed
@@ -195,14 +316,9 @@ def async_token_rate_limit_auth_level(token_rate_limit: dict, key_level_map: dic
                 request_index = func_argspec.args.index('request')
                 request = args[request_index]
 
-            route_path = f"{request.scope.get('root_path')}{request.scope.get('path')}"
-            fk_or_sk = request.headers.get("Authorization", "default")
-            level = key_level_map.get(fk_or_sk, 0)
-            default_interval = 0
-            token_level_dict = token_rate_limit.get(
-                route_path, {level: default_interval}
+            token_interval = get_token_interval(
+                request, token_rate_limit, key_level_map
             )
-            token_interval = token_level_dict[level]
 
             async_gen = async_gen_func(*args, **kwargs)
 
@@ -1,14 +1,19 @@
 from typing import List
 
+from openai_forward.cache.admin import cache_index
+from openai_forward.cache.database import db_dict
+from openai_forward.cache.io import cache_io
+from openai_forward.cache.semantic import semantic_cache
+from openai_forward.cache.tiered import TieredCache
 from openai_forward.config.settings import (
-    GENERAL_BASE_URL,
-    GENERAL_ROUTE_PREFIX,
-    OPENAI_BASE_URL,
-    OPENAI_ROUTE_PREFIX,
+    GENERAL_FORWARD_CONFIG,
+    OPENAI_FORWARD_CONFIG,
     PROXY,
 )
+from openai_forward.helper import format_route_prefix
 
 from .core import GenericForward, OpenaiForward
+from .pool import ClientRegistry
 
 
 class ForwardManager:
@@ -17,45 +22,86 @@ class ForwardManager:
         Initializes the class by creating OpenAI and Generic forward objects and their root objects.
         """
         self.openai_objs, self.openai_root_obj = self._create_forward_obj(
-            OPENAI_BASE_URL, OPENAI_ROUTE_PREFIX, OpenaiForward
+            OPENAI_FORWARD_CONFIG, OpenaiForward
         )
         self.generic_objs, self.generic_root_obj = self._create_forward_obj(
-            GENERAL_BASE_URL, GENERAL_ROUTE_PREFIX, GenericForward
+            GENERAL_FORWARD_CONFIG, GenericForward
         )
         self.root_objs = [i for i in [self.openai_root_obj, self.generic_root_obj] if i]
         if len(self.root_objs) == 2:
             raise ValueError("Only one root routing forwarding object can exist!")
+        # upstreams of the same host share one client session across routes
+        self.clients = ClientRegistry()
 
     @staticmethod
-    def _create_forward_obj(base_urls: List, route_prefixes: List, Forward):
+    def _create_forward_obj(forward_config: List[dict], Forward):
         """
         Generate OpenaiForward or GenericForward objects.
 
+        Args:
+            forward_config (List[dict]): The `forward` config entries of one type.
+
         Returns:
             _objs (list): A list of Forward objects.
         """
 
         root_forward_obj = None
         _objs = []
-        for base_url, route_prefix in zip(base_urls, route_prefixes):
+        for item in forward_config:
+            route_prefix = format_route_prefix(item['route'])
+            options = {
+                "hedge": item.get('hedge'),
+                "circuit_breaker": item.get('circuit_breaker'),
+                "pool": item.get('pool'),
+            }
+            if issubclass(Forward, OpenaiForward):
+                options["embedding_batch"] = item.get('embedding_batch')
+            forward_obj = Forward(item['base_url'], route_prefix, PROXY, **options)
             if route_prefix == "/":
-                root_forward_obj = Forward(base_url, route_prefix, PROXY)
+                root_forward_obj = forward_obj
             else:
-                _objs.append(Forward(base_url, route_prefix, PROXY))
+                _objs.append(forward_obj)
         return _objs, root_forward_obj
 
     async def start_up(self):
         """
-        Asynchronously starts up the objects by building clients for openai_objs, generic_objs, and root_objs.
+        Asynchronously starts up the objects by building clients for openai_objs, generic_objs,
+        and root_objs, then warms up their connection pools.
         """
-        [await obj.build_client() for obj in self.openai_objs]
-        [await obj.build_client() for obj in self.generic_objs]
-        [await obj.build_client() for obj in self.root_objs]
+        [await obj.build_client(self.clients) for obj in self.openai_objs]
+        [await obj.build_client(self.clients) for obj in self.generic_objs]
+        [await obj.build_client(self.clients) for obj in self.root_objs]
+        cache_index.start(db_dict)
+        await self.clients.warm_up()
 
     async def shutdown(self):
         """
         Asynchronous shut down the client connections.
         """
-        [await obj.client.close() for obj in self.openai_objs]
-        [await obj.client.close() for obj in self.generic_objs]
-        [await obj.client.close() for obj in self.root_objs]
+        for obj in [*self.openai_objs, *self.root_objs]:
+            if isinstance(obj, OpenaiForward):
+                if obj.batcher is not None:
+                    await obj.batcher.close()
+                await obj.cancel_revalidations()
+        await self.clients.close()
+        await cache_io.close()
+        if semantic_cache is not None:
+            await semantic_cache.close()
+        if isinstance(db_dict, TieredCache):
+            db_dict.save_snapshot()
+        cache_index.stop()
+        cache_index.save(len(db_dict))
+
+    def stats(self) -> dict:
+        """
+        The upstream state of every forward route, and the occupancy of the shared
+        connection pools.
+        """
+        info = {
+            obj.ROUTE_PREFIX: obj.stats()
+            for obj in [*self.openai_objs, *self.generic_objs, *self.root_objs]
+        }
+        info["pools"] = self.clients.to_dict()
+        if semantic_cache is not None:
+            info["semantic_cache"] = semantic_cache.stats()
+        return info
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import random
+import time
+from typing import Iterable, List
+
+from loguru import logger
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when every upstream of a route has an open circuit.
+    """
+
+    def __init__(self, base_url: str, retry_after: float):
+        self.base_url = base_url
+        self.retry_after = retry_after
+        super().__init__(
+            f"circuit of upstream {base_url} is open, retry after {retry_after:.1f}s"
+        )
+
+
+class CircuitBreaker:
+    """
+    A circuit breaker with closed, open and half-open states.
+
+    After `max_fails` consecutive failures the circuit opens and requests fail fast.
+    Once `fail_timeout` seconds passed it turns half-open and lets a single probe
+    request through: a success closes the circuit, a failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, max_fails: int = 3, fail_timeout: float = 30.0):
+        """
+        Args:
+            max_fails (int): Consecutive failures before the circuit opens.
+            fail_timeout (float): Seconds the circuit stays open before probing.
+        """
+        self.max_fails = max_fails
+        self.fail_timeout = fail_timeout
+        self.fails = 0
+        self._opened_at: float | None = None
+        self._probe_started_at: float | None = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.fail_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(self._opened_at + self.fail_timeout - time.monotonic(), 0.0)
+
+    def allow_request(self) -> bool:
+        """
+        Whether a request may be sent now, takes the probe slot when half-open.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        now = time.monotonic()
+        # a probe that never reported back (e.g. cancelled) expires after `fail_timeout`
+        if (
+            self._probe_started_at is None
+            or now - self._probe_started_at > self.fail_timeout
+        ):
+            self._probe_started_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.fails = 0
+        self._opened_at = None
+        self._probe_started_at = None
+
+    def record_failure(self) -> bool:
+        """
+        Returns:
+            bool: Whether the circuit has just been opened.
+        """
+        state = self.state
+        self.fails += 1
+        if state == self.HALF_OPEN or (
+            state == self.CLOSED and self.fails >= self.max_fails
+        ):
+            self._opened_at = time.monotonic()
+            self._probe_started_at = None
+            self.fails = 0
+            return True
+        return False
+
+
+class Upstream:
+    """
+    A single upstream base URL together with its circuit breaker and latency statistics.
+    """
+
+    def __init__(
+        self, base_url: str, decay: float = 0.3, max_fails=3, fail_timeout=30.0
+    ):
+        """
+        Args:
+            base_url (str): The base URL of the upstream.
+            decay (float): Weight of the newest sample in the EWMA latency.
+            max_fails (int): Consecutive failures before the circuit opens.
+            fail_timeout (float): Seconds the circuit stays open before probing again.
+        """
+        self.base_url = base_url
+        self.decay = decay
+        self.breaker = CircuitBreaker(max_fails, fail_timeout)
+        # the client session of this upstream, see `GenericForward.build_client`
+        self.client = None
+
+        self.ewma = 0.0
+        self.inflight = 0
+
+    @property
+    def max_fails(self) -> int:
+        return self.breaker.max_fails
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    @property
+    def score(self) -> float:
+        """Expected cost of sending one more request to this upstream, lower is better."""
+        return self.ewma * (self.inflight + 1)
+
+    def observe(self, latency: float, ok: bool = True):
+        """
+        Record the outcome of one request.
+
+        Args:
+            latency (float): Seconds until the response headers arrived.
+            ok (bool): Whether the upstream answered healthily.
+        """
+        if ok:
+            self.breaker.record_success()
+            if self.ewma:
+                self.ewma += self.decay * (latency - self.ewma)
+            else:
+                self.ewma = latency
+        elif self.breaker.record_failure():
+            logger.warning(
+                f"circuit of upstream {self.base_url} opened for {self.breaker.fail_timeout}s"
+            )
+
+    def to_dict(self):
+        return {
+            "base_url": self.base_url,
+            "state": self.breaker.state,
+            "retry_after": round(self.breaker.retry_after, 3),
+            "ewma_latency": round(self.ewma, 4),
+            "inflight": self.inflight,
+        }
+
+    def __repr__(self):
+        return f"Upstream({self.base_url!r}, ewma={self.ewma:.3f}, inflight={self.inflight})"
+
+
+class UpstreamPool:
+    """
+    Balances requests over equivalent upstreams with power-of-two-choices on EWMA latency,
+    skipping upstreams whose circuit is open.
+    """
+
+    def __init__(self, base_urls: str | Iterable[str], **kwargs):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.upstreams: List[Upstream] = [Upstream(url, **kwargs) for url in base_urls]
+        if not self.upstreams:
+            raise ValueError("At least one base_url is required")
+
+    def __len__(self):
+        return len(self.upstreams)
+
+    def __iter__(self):
+        return iter(self.upstreams)
+
+    def pick(self, exclude: Iterable[Upstream] = ()) -> Upstream:
+        """
+        Pick an upstream for the next request.
+
+        Args:
+            exclude (Iterable[Upstream]): Upstreams to avoid, e.g. ones that already failed
+                for this request. Ignored when nothing else is left.
+
+        Returns:
+            Upstream: The chosen upstream.
+        """
+        if len(self.upstreams) == 1:
+            return self.upstreams[0]
+
+        candidates = [u for u in self.upstreams if u.available and u not in exclude]
+        if not candidates:
+            candidates = [u for u in self.upstreams if u.available] or self.upstreams
+        if len(candidates) == 1:
+            return candidates[0]
+
+        a, b = random.sample(candidates, 2)
+        return a if a.score <= b.score else b
+
+    def acquire(self, upstream: Upstream, exclude: Iterable[Upstream] = ()) -> Upstream:
+        """
+        Make sure the request may be sent to `upstream`, failing over to another upstream
+        when its circuit is open.
+
+        Raises:
+            CircuitOpenError: If no upstream lets the request through.
+        """
+        if upstream.breaker.allow_request():
+            return upstream
+        tried = {upstream, *exclude}
+        for candidate in sorted(self.upstreams, key=lambda u: u.score):
+            if candidate not in tried and candidate.breaker.allow_request():
+                return candidate
+        retry_after = min(u.breaker.retry_after for u in self.upstreams)
+        raise CircuitOpenError(upstream.base_url, retry_after)
+
+    def to_list(self):
+        return [upstream.to_dict() for upstream in self.upstreams]
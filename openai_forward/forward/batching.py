@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import orjson
+
+from ..cache.embedding.response import split_inputs, split_tokens
+
+# (status, content type, body) of an upstream response
+Result = Tuple[int, Optional[str], bytes]
+
+
+class _Batch:
+    def __init__(self, key: Hashable, body: dict, send: Callable):
+        self.key = key
+        self.body = body
+        self.send = send
+        self.inputs: List = []
+        # position of every distinct input in `inputs`
+        self.positions: Dict[bytes, int] = {}
+        self.waiters: List[Tuple[asyncio.Future, List[int]]] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+    def add(self, inputs: List) -> asyncio.Future:
+        indices = []
+        for item in inputs:
+            item_key = orjson.dumps(item)
+            if item_key not in self.positions:
+                self.positions[item_key] = len(self.inputs)
+                self.inputs.append(item)
+            indices.append(self.positions[item_key])
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, indices))
+        return future
+
+
+class EmbeddingBatcher:
+    """
+    Collects concurrent embedding requests with the same parameters and key level for a
+    few milliseconds, sends their inputs upstream as one request and hands every waiter
+    its own part of the response, with its share of the usage.
+
+    Identical inputs of a batch are only sent once.
+    """
+
+    def __init__(self, max_wait: float = 0.005, max_inputs: int = 64):
+        """
+        Args:
+            max_wait (float): Seconds a batch waits for more requests after its first one.
+            max_inputs (int): A batch is sent right away once it has this many inputs,
+                larger requests are not batched.
+        """
+        self.max_wait = max_wait
+        self.max_inputs = max_inputs
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.requests = 0
+
+    @staticmethod
+    def group_key(body: dict, inputs: List, group: Hashable) -> Hashable:
+        # text and token inputs can not be mixed in one request
+        kind = "tokens" if inputs and isinstance(inputs[0], list) else "text"
+        params = {k: v for k, v in body.items() if k != "input"}
+        return group, kind, orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+
+    def accepts(self, inputs: List) -> bool:
+        return 0 < len(inputs) <= self.max_inputs
+
+    async def submit(
+        self,
+        body: dict,
+        group: Hashable,
+        send: Callable[[bytes], Awaitable[Result]],
+    ) -> Result:
+        """
+        Asynchronously add the inputs of a request to a batch and wait for its part of
+        the response.
+
+        Args:
+            body (dict): The parsed request body.
+            group (Hashable): Requests of different groups, e.g. key levels, are never
+                batched together.
+            send (Callable[[bytes], Awaitable[Result]]): Sends a request body upstream,
+                the one of the first request of a batch is used for the whole batch.
+
+        Returns:
+            Result: The status, content type and body of the response to this request.
+        """
+        inputs = split_inputs(body["input"])
+        key = self.group_key(body, inputs, group)
+        batch = self._batches.get(key)
+        if batch is not None and len(batch.inputs) + len(inputs) > self.max_inputs:
+            self._flush(batch)
+            batch = None
+        if batch is None:
+            batch = self._batches[key] = _Batch(key, body, send)
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush, batch
+            )
+        future = batch.add(inputs)
+        self.requests += 1
+        if len(batch.inputs) >= self.max_inputs:
+            self._flush(batch)
+        return await future
+
+    def _flush(self, batch: _Batch):
+        if self._batches.get(batch.key) is not batch:
+            return
+        del self._batches[batch.key]
+        batch.timer.cancel()
+        self.batches += 1
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: _Batch):
+        try:
+            status, media_type, body = await batch.send(
+                orjson.dumps({**batch.body, "input": batch.inputs})
+            )
+        except asyncio.CancelledError:
+            for future, _ in batch.waiters:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if status >= 400:
+            # every request of the batch gets the error
+            results = [(status, media_type, body)] * len(batch.waiters)
+        else:
+            try:
+                results = [
+                    (status, media_type, content)
+                    for content in self.scatter(body, batch)
+                ]
+            except Exception as e:
+                results = [e] * len(batch.waiters)
+
+        for (future, _), result in zip(batch.waiters, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def scatter(body: bytes, batch: _Batch) -> List[bytes]:
+        """
+        Split the response of a batch into the responses of its requests.
+        """
+        result = orjson.loads(body)
+        data = {d["index"]: d["embedding"] for d in result["data"]}
+        tokens = split_tokens(batch.inputs, result["usage"]["prompt_tokens"])
+        contents = []
+        for _, indices in batch.waiters:
+            usage = sum(tokens[i] for i in indices)
+            contents.append(
+                orjson.dumps(
+                    {
+                        "object": "list",
+                        "data": [
+                            {"object": "embedding", "index": j, "embedding": data[i]}
+                            for j, i in enumerate(indices)
+                        ],
+                        "model": result["model"],
+                        "usage": {"prompt_tokens": usage, "total_tokens": usage},
+                    }
+                )
+            )
+        return contents
+
+    async def close(self):
+        """
+        Asynchronously send the batches still waiting and wait for all of them.
+        """
+        for batch in list(self._batches.values()):
+            self._flush(batch)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def to_dict(self) -> dict:
+        return {
+            "max_wait": self.max_wait,
+            "max_inputs": self.max_inputs,
+            "batches": self.batches,
+            "requests": self.requests,
+            "waiting": sum(len(b.waiters) for b in self._batches.values()),
+        }
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import re
+from typing import AsyncIterator
+
+from fastapi import Request
+
+PEEK_SIZE = 64 * 1024
+
+
+class RequestBody:
+    """
+    A request body of which only the first bytes have been read, the rest is still
+    waiting in the client connection and can be piped to the upstream.
+    """
+
+    def __init__(self, head: bytes, rest: AsyncIterator[bytes] | None):
+        """
+        Args:
+            head (bytes): The bytes read so far.
+            rest (AsyncIterator[bytes] | None): The remaining body, None if fully read.
+        """
+        self.head = head
+        self._rest = rest
+
+    @property
+    def complete(self) -> bool:
+        return self._rest is None
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        if self.head:
+            yield self.head
+        if self._rest is not None:
+            async for chunk in self._rest:
+                if chunk:
+                    yield chunk
+
+    def form_field(self, name: str) -> str | None:
+        """
+        Find a small text field of a multipart/form-data body in the bytes read so far,
+        e.g. the `model` of an audio upload.
+        """
+        match = re.search(
+            rb'name="'
+            + re.escape(name.encode())
+            + rb'"\r\n(?:[^\r\n]+\r\n)*\r\n([^\r\n]*)\r\n',
+            self.head,
+        )
+        if match:
+            return match.group(1).decode("utf-8", errors="ignore")
+        return None
+
+
+async def peek_body(request: Request, size: int = PEEK_SIZE) -> RequestBody:
+    """
+    Read the request body up to about `size` bytes without buffering the rest.
+
+    Args:
+        request (Request): The incoming FastAPI request object.
+        size (int): Number of bytes to read ahead.
+
+    Returns:
+        RequestBody: The peeked body.
+    """
+    stream = request.stream()
+    head = bytearray()
+    async for chunk in stream:
+        head.extend(chunk)
+        if len(head) >= size:
+            return RequestBody(bytes(head), stream)
+    return RequestBody(bytes(head), None)
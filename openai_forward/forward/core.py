@@ -1,26 +1,32 @@
 from __future__ import annotations
 
 import asyncio
+import time
 import traceback
-from asyncio import Queue
-from itertools import cycle
-from typing import AsyncGenerator
+import weakref
+from asyncio import FIRST_COMPLETED
+from typing import AsyncGenerator, Dict, List, Tuple
 
 import aiohttp
 import anyio
 import litellm
 import orjson
-from aiohttp import TCPConnector
 from fastapi import HTTPException, Request, status
 from loguru import logger
-from starlette.responses import BackgroundTask, StreamingResponse
+from starlette.responses import Response, StreamingResponse
 
 from ..cache import (
+    cache_embedding_items,
     cache_generic_response,
     cache_response,
     get_cached_generic_response,
     get_cached_response,
+    merge_response,
+    reduce_payload,
+    split_inputs,
 )
+from ..cache.io import cache_io
+from ..cache.semantic import semantic_cache
 from ..config.settings import *
 from ..content.openai import (
     ChatLogger,
@@ -28,11 +34,26 @@ from ..content.openai import (
     EmbeddingLogger,
     WhisperLogger,
 )
-from ..decorators import async_retry, async_token_rate_limit_auth_level
+from ..decorators import (
+    RetryBudget,
+    async_retry,
+    async_token_rate_limit_auth_level,
+    get_token_interval,
+)
 from ..helper import InfiniteSet, get_client_ip
+from .balancer import CircuitOpenError, Upstream, UpstreamPool
+from .batching import EmbeddingBatcher, Result
+from .body import peek_body
+from .hedging import HedgePolicy
+from .key_scheduler import KeyScheduler, estimate_cost
+from .pool import ClientRegistry, PoolProfile
+from .pump import ChunkCapture, SSEStage, Stage, TokenPacer, pump, relay
+from .singleflight import Flight, SingleFlight
 
 # from beartype import beartype
 
+retry_budget = RetryBudget(ratio=RETRY_CONFIG.get("budget", 0.1))
+
 
 class GenericForward:
     """
@@ -41,7 +62,6 @@ class GenericForward:
     """
 
     validate_host = bool(IP_BLACKLIST or IP_WHITELIST)
-    timeout = aiohttp.ClientTimeout(connect=TIMEOUT)
 
     _fk_to_level = FWD_KEY
     _sk_to_levels = OPENAI_API_KEY
@@ -54,38 +74,60 @@ class GenericForward:
         for level in levels:
             _level_to_sks[level] = _level_to_sks.get(level, []) + [sk]
 
-    _level_to_sk = {}
-    for level, sks in _level_to_sks.items():
-        _level_to_sk[level] = cycle(sks)
+    _key_scheduler = KeyScheduler(_level_to_sks)
 
-    def __init__(self, base_url: str, route_prefix: str, proxy=None):
+    def __init__(
+        self,
+        base_url: str | List[str],
+        route_prefix: str,
+        proxy=None,
+        hedge: dict | None = None,
+        circuit_breaker: dict | None = None,
+        pool: dict | None = None,
+    ):
         """
         Args:
-            base_url (str): The base URL to which requests will be forwarded.
+            base_url (str | List[str]): The base URL(s) to which requests will be forwarded.
+                Several equivalent base URLs are load balanced.
             route_prefix (str): The prefix of the route.
             proxy (str, optional): The proxy to use for the requests. Defaults to None.
+            hedge (dict, optional): Enables request hedging with the given `HedgePolicy`
+                arguments. Defaults to None.
+            circuit_breaker (dict, optional): `max_fails` and `fail_timeout` of the circuit
+                breaker of every upstream. Defaults to None.
+            pool (dict, optional): `PoolProfile` arguments of the upstream connection pool.
+                Defaults to None.
         """
-        self.BASE_URL = base_url
+        self.upstreams = UpstreamPool(base_url, **(circuit_breaker or {}))
+        self.BASE_URL = self.upstreams.upstreams[0].base_url
         self.PROXY = proxy
         self.ROUTE_PREFIX = route_prefix
         self.client: aiohttp.ClientSession | None = None
+        self.clients: ClientRegistry | None = None
+        # identical cacheable requests in flight share one upstream call
+        self.flights = SingleFlight()
+        self.hedge = HedgePolicy(**hedge) if hedge is not None else None
+        self.pool = PoolProfile(**{"connect_timeout": TIMEOUT, **(pool or {})})
+        self.timeout = self.pool.timeout
 
     @classmethod
-    def fk_to_sk(cls, forward_key: str):
+    def fk_to_sk(cls, forward_key: str, cost: int = 0, exclude=()):
         """
-        Convert a forward key to a secret key.
+        Convert a forward key to the secret key with the most headroom.
 
         Args:
             forward_key (str): The forward key to convert.
+            cost (int, optional): Estimated token cost of the request.
+            exclude (Iterable[str], optional): Secret keys to avoid.
 
         Returns:
             str: The corresponding secret key, if it exists. Otherwise, None.
         """
         level = cls._fk_to_level.get(forward_key)
         if level is not None:
-            sk = cls._level_to_sk.get(level)
+            sk = cls._key_scheduler.pick(level, cost, exclude)
             if sk:
-                return next(sk), level
+                return sk, level
         return None, level
 
     @classmethod
@@ -106,21 +148,68 @@ class GenericForward:
         if auth:
             fk = auth[len(auth_prefix) :]
             if fk in FWD_KEY:
-                sk, level = cls.fk_to_sk(fk)
+                level = cls._fk_to_level.get(fk)
                 assert level is not None
                 if level != 0:
                     model_set = cls._level_to_model_set[level]
-                if sk:
-                    auth = auth_prefix + sk
-                    client_config["headers"]["Authorization"] = auth
+                # the secret key itself is assigned right before sending, see `assign_key`
+                client_config["fk"] = fk
         return auth, model_set
 
-    async def build_client(self):
+    @classmethod
+    def assign_key(cls, client_config: dict, exclude=()):
+        """
+        Replace the forward key of the request with a scheduled secret key.
+
+        Args:
+            client_config (dict): The configuration for the client.
+            exclude (Iterable[str], optional): Secret keys to avoid.
+
+        Returns:
+            str | None: The assigned secret key.
+        """
+        fk = client_config.get("fk")
+        if fk is None:
+            return None
+        sk, _ = cls.fk_to_sk(fk, client_config.get("cost", 0), exclude)
+        if sk:
+            client_config["sk"] = sk
+            headers = client_config["headers"]
+            headers.pop("authorization", None)
+            headers["Authorization"] = f"Bearer {sk}"
+        return sk
+
+    @classmethod
+    def release_key(cls, client_config: dict):
+        """
+        Mark the request holding a secret key as finished.
+        """
+        if client_config.pop("key_acquired", False):
+            cls._key_scheduler.release(
+                client_config["sk"], client_config.get("cost", 0)
+            )
+
+    async def build_client(self, registry: ClientRegistry | None = None):
         """
         Asynchronously build the client for making requests.
+
+        Args:
+            registry (ClientRegistry, optional): Shares the clients of the upstreams with
+                other routes. Defaults to a registry of this route only.
+        """
+        self.clients = registry if registry is not None else ClientRegistry()
+        for upstream in self.upstreams:
+            upstream.client = self.clients.get(upstream.base_url, self.PROXY, self.pool)
+        self.client = self.upstreams.upstreams[0].client
+
+    def stats(self) -> dict:
+        """
+        The state of the upstreams of this route.
         """
-        connector = TCPConnector(limit=500, limit_per_host=0, force_close=False)
-        self.client = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        info = {"upstreams": self.upstreams.to_list()}
+        if self.hedge is not None:
+            info["hedge"] = self.hedge.to_dict()
+        return info
 
     @staticmethod
     def validate_request_host(ip):
@@ -146,12 +235,37 @@ class GenericForward:
             )
 
     @staticmethod
-    @async_token_rate_limit_auth_level(token_interval_conf, FWD_KEY)
+    def build_stages(
+        request: Request, *stages: Stage | None, paced: bool = True
+    ) -> List[Stage]:
+        """
+        Build the stages a streamed response passes through, starting with the token
+        rate limit pacing of the request.
+
+        Args:
+            request (Request): The original FastAPI request object.
+            *stages (Stage | None): Further stages, None entries are skipped.
+            paced (bool): Whether to apply the token rate limit, i.e. whether a client
+                reads the response. Defaults to True.
+
+        Returns:
+            List[Stage]: The stages for `pump`.
+        """
+        pacer = None
+        if paced:
+            token_interval = get_token_interval(request, token_interval_conf, FWD_KEY)
+            pacer = TokenPacer(token_interval) if token_interval > 0 else None
+        return [stage for stage in (pacer, *stages) if stage is not None]
+
+    @classmethod
     async def aiter_bytes(
+        cls,
         r: aiohttp.ClientResponse,
         request: Request,
         route_path: str,
         cache_key: str | None = None,
+        prefetched: bytes = b"",
+        flight: Flight | None = None,
     ) -> AsyncGenerator[bytes, Any]:
         """
         Asynchronously iterates through the bytes in the given aiohttp.ClientResponse object
@@ -162,29 +276,93 @@ class GenericForward:
             request (Request): The original FastAPI request object.
             route_path (str): The API route path.
             cache_key (str | None): The cache key. Defaults to None.
+            prefetched (bytes): Bytes already read from the response. Defaults to b"".
+            flight (Flight | None): The flight this request leads, if any. Defaults to None.
 
         Returns:
             AsyncGenerator[bytes, Any]: Each chunk of bytes from the server's response.
         """
-        chunk_list = []
         cache = True if route_path in CACHE_ROUTE_SET else False
+        capture = flight or (ChunkCapture() if cache or LOG_GENERAL else None)
 
-        async for chunk, _ in r.content.iter_chunks():  # yield chunk one by one.
-            if cache:
-                chunk_list.append(chunk)
+        # yield chunk one by one.
+        async for chunk in pump(
+            r, cls.build_stages(request, capture), prefetched, "precision"
+        ):
             yield chunk
 
         if r.ok and cache and cache_key:
-            cache_generic_response(cache_key, chunk_list, route_path)
+            cache_io.submit(
+                cache_generic_response, cache_key, capture.chunks, route_path
+            )
 
         # Only log non-stream response:
-        if len(chunk_list) == 1 and LOG_GENERAL:
-            logger.debug(f"result: {chunk_list[0]}")
+        if LOG_GENERAL and len(capture.chunks) == 1:
+            logger.debug(f"result: {capture.chunks[0]}")
+
+    def join_flight(
+        self, cache_key, caching=True, shape: Tuple = ()
+    ) -> Tuple[Flight | None, bool]:
+        """
+        Join the in-flight request with the same cache key.
+
+        Args:
+            cache_key: The cache key of the request.
+            caching (bool): Whether the request may be answered from the cache.
+            shape (Tuple): Request fields that are not part of the cache key but change
+                the response, e.g. whether it is streamed.
+
+        Returns:
+            Tuple[Flight | None, bool]: The flight, None if the request is not coalesced,
+                and whether the request leads it.
+        """
+        if cache_key is None or not caching:
+            return None, True
+        return self.flights.join((cache_key, *shape))
+
+    async def follow_flight(self, flight: Flight, request: Request):
+        """
+        Asynchronously answer a request with the response of the identical request in flight.
+
+        Returns:
+            StreamingResponse: The shared response.
+        """
+        try:
+            await flight.wait_ready()
+        except BaseException:
+            flight.unfollow()
+            raise
+        logger.info(f"{request.url.path} >>>>> [in-flight hit]")
+        return StreamingResponse(
+            relay(flight.follow(), self.build_stages(request)),
+            status_code=flight.status,
+            media_type=flight.media_type,
+        )
+
+    async def send_in_flight(self, client_config: dict, data, flight: Flight | None):
+        """
+        Asynchronously send the request of a flight leader and let the followers know
+        about its response or failure.
+        """
+        try:
+            r = await self.send(client_config, data=data)
+        except BaseException as e:
+            if flight is not None:
+                flight.fail(e)
+            raise
+        if flight is not None:
+            flight.start(
+                r.status,
+                r.headers.get("content-type"),
+                r,
+                client_config.get("prefetched", b""),
+            )
+        return r
 
     @async_retry(
-        max_retries=3,
-        delay=0.2,
-        backoff=2,
+        max_retries=RETRY_CONFIG.get("max_retries", 3),
+        delay=RETRY_CONFIG.get("delay", 0.2),
+        backoff=RETRY_CONFIG.get("backoff", 2),
         exceptions=(
             aiohttp.ServerTimeoutError,
             aiohttp.ServerConnectionError,
@@ -193,6 +371,12 @@ class GenericForward:
             anyio.EndOfStream,
             RuntimeError,
         ),
+        fail_fast_exceptions=(CircuitOpenError,),
+        retry_on_status=tuple(RETRY_CONFIG.get("on_status", (429, 500, 502, 503))),
+        max_retry_after=RETRY_CONFIG.get("max_retry_after", 5),
+        jitter=True,
+        budget=retry_budget,
+        retry_handler_name="prepare_retry",
         # raise_callback_name="build_client",
         raise_handler_name="handle_exception",
     )
@@ -207,14 +391,159 @@ class GenericForward:
         Returns:
             aiohttp.ClientResponse: The response from the server.
         """
+        if "sk" not in client_config:
+            self.assign_key(client_config)
 
-        return await self.client.request(
-            method=client_config["method"],
-            url=client_config['url'],
-            data=data,
-            headers=client_config["headers"],
-            proxy=self.PROXY,
-        )
+        if self.hedge is None or not isinstance(data, (bytes, bytearray, type(None))):
+            return await self._send_once(client_config, data)
+        return await self._send_hedged(client_config, data)
+
+    async def _send_once(self, client_config: dict, data=None):
+        """
+        Send one attempt of the request, keeping the upstream and key statistics.
+
+        For hedged stream requests the attempt only completes once the first bytes of
+        the body arrived, they are stored in `client_config["prefetched"]`.
+        """
+        upstream: Upstream = client_config["upstream"]
+        available_upstream = self.upstreams.acquire(upstream)
+        if available_upstream is not upstream:
+            # the circuit of the chosen upstream is open, fail over.
+            upstream = self.select_upstream(client_config, pick=available_upstream)
+
+        sk = client_config.get("sk")
+        if sk:
+            self._key_scheduler.acquire(sk, client_config.get("cost", 0))
+            client_config["key_acquired"] = True
+
+        upstream.inflight += 1
+        start_time = time.perf_counter()
+        try:
+            r = await (upstream.client or self.client).request(
+                method=client_config["method"],
+                url=client_config['url'],
+                data=data,
+                headers=client_config["headers"],
+                proxy=self.PROXY,
+                timeout=self.timeout,
+            )
+        except asyncio.CancelledError:
+            # a hedged attempt lost the race
+            self.release_key(client_config)
+            raise
+        except Exception:
+            upstream.observe(time.perf_counter() - start_time, ok=False)
+            self.release_key(client_config)
+            raise
+        finally:
+            upstream.inflight -= 1
+
+        latency = time.perf_counter() - start_time
+        upstream.observe(latency, ok=r.status < 500)
+        if sk:
+            self._key_scheduler.update(sk, r.status, r.headers)
+
+        if self.hedge is not None and r.ok:
+            if client_config.get("stream"):
+                try:
+                    client_config["prefetched"] = await r.content.readany()
+                except BaseException:
+                    r.release()
+                    self.release_key(client_config)
+                    raise
+                latency = time.perf_counter() - start_time
+            self.hedge.record(latency, bool(client_config.get("stream")))
+        return r
+
+    async def _send_hedged(self, client_config: dict, data=None):
+        """
+        Send the request, and if it has not answered within the hedge delay, send a duplicate
+        with another key and upstream. The first answer wins and the other one is cancelled.
+        """
+        hedge = self.hedge
+        hedge.on_request()
+        stream = bool(client_config.get("stream"))
+
+        first = asyncio.create_task(self._send_once(client_config, data))
+        done, _ = await asyncio.wait({first}, timeout=hedge.delay(stream))
+        if done or not hedge.try_acquire():
+            return await first
+
+        hedge_config = {
+            **client_config,
+            "headers": dict(client_config["headers"]),
+            "key_acquired": False,
+        }
+        self.select_upstream(hedge_config, exclude=(client_config["upstream"],))
+        if client_config.get("sk"):
+            self.assign_key(hedge_config, exclude=(client_config["sk"],))
+        second = asyncio.create_task(self._send_once(hedge_config, data))
+        attempts = {first: client_config, second: hedge_config}
+
+        pending = set(attempts)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    for loser in pending:
+                        loser.cancel()
+                    if pending:
+                        # let the loser clean up its own config before merging
+                        await asyncio.wait(pending)
+                    for loser in set(attempts) - {task}:
+                        if not loser.cancelled() and loser.exception() is None:
+                            loser.result().release()
+                            self.release_key(attempts[loser])
+                    if task is second:
+                        hedge.hedge_wins += 1
+                        client_config.update(hedge_config)
+                    return task.result()
+        except asyncio.CancelledError:
+            for task in attempts:
+                task.cancel()
+            raise
+        raise error
+
+    def prepare_retry(self, client_config: dict, data=None):
+        """
+        Switch the next attempt of a request to another upstream and secret key.
+
+        Args:
+            client_config (dict): The configuration for the client.
+            data (Any, optional): The data of the request. Defaults to None.
+
+        Returns:
+            bool: False if the request can not be retried because its body was streamed.
+        """
+        if not isinstance(data, (bytes, bytearray, type(None))):
+            return False
+        self.release_key(client_config)
+        self.select_upstream(client_config, exclude=(client_config["upstream"],))
+        if client_config.get("sk"):
+            self.assign_key(client_config, exclude=(client_config["sk"],))
+
+    def select_upstream(
+        self, client_config: dict, exclude=(), pick: Upstream | None = None
+    ) -> Upstream:
+        """
+        Choose an upstream for the request and point the client url at it.
+
+        Args:
+            client_config (dict): The configuration for the client.
+            exclude (Iterable[Upstream], optional): Upstreams to avoid.
+            pick (Upstream, optional): Use this upstream instead of balancing.
+
+        Returns:
+            Upstream: The chosen upstream.
+        """
+        upstream = pick or self.upstreams.pick(exclude)
+        client_config["upstream"] = upstream
+        client_config["url"] = f"{upstream.base_url}{client_config['path_qs']}"
+        return upstream
 
     def handle_exception(self, e):
         """
@@ -226,6 +555,7 @@ class GenericForward:
         Raises:
             HTTPException: An HTTPException with the appropriate status code and detail.
         """
+        headers = None
         if isinstance(
             e,
             (
@@ -235,12 +565,18 @@ class GenericForward:
                 aiohttp.ServerTimeoutError,
             ),
         ):
+            base_urls = ", ".join(u.base_url for u in self.upstreams)
             error_info = (
                 f"{type(e)}: {e} | "
-                f"Please check if your host can access [{self.BASE_URL}] successfully?"
+                f"Please check if your host can access [{base_urls}] successfully?"
             )
             status_code = status.HTTP_504_GATEWAY_TIMEOUT
 
+        elif isinstance(e, CircuitOpenError):
+            error_info = f"{e} | Failing fast until the upstream recovers."
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            headers = {"Retry-After": str(max(int(e.retry_after), 1))}
+
         elif isinstance(e, anyio.EndOfStream):
             error_info = "EndOfStream Error: trying to read from a stream that has been closed from the other end."
             status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -250,7 +586,7 @@ class GenericForward:
             status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
 
         logger.error(f"{error_info}\n{traceback.format_exc()}")
-        raise HTTPException(status_code=status_code, detail=error_info)
+        raise HTTPException(status_code=status_code, detail=error_info, headers=headers)
 
     def prepare_client(self, request: Request, return_origin_header=False) -> dict:
         """
@@ -275,9 +611,9 @@ class GenericForward:
             else _url_path
         )
         if request.url.query:
-            url = f"{self.BASE_URL}{route_path}?{request.url.query}"
+            path_qs = f"{route_path}?{request.url.query}"
         else:
-            url = f"{self.BASE_URL}{route_path}"
+            path_qs = route_path
 
         auth = request.headers.get("Authorization", "")
 
@@ -305,14 +641,41 @@ class GenericForward:
                 if key.startswith("openai"):
                     headers[key] = value
 
-        return {
+        client_config = {
             'auth': auth,
             'headers': headers,
             "method": request.method,
-            'url': url,
             'ip': ip,
             'route_path': route_path,
+            'path_qs': path_qs,
         }
+        self.select_upstream(client_config)
+        return client_config
+
+    @staticmethod
+    def validate_model(model: str | None, model_set):
+        """
+        Raises:
+            HTTPException: If the model can not be accessed with the forward key.
+        """
+        if model is not None and model not in model_set:
+            logger.warning(f"[Auth Warning] model: {model} is not allowed")
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"model: {model} is not allowed",
+            )
+
+    def _needs_payload(self, request: Request, route_path: str) -> bool:
+        """
+        Whether the whole request body has to be read, e.g. for model checks or caching.
+        Otherwise, it can be piped to the upstream when `STREAM_REQUEST_BODY` is on.
+        """
+        return route_path in (
+            CHAT_COMPLETION_ROUTE,
+            COMPLETION_ROUTE,
+            EMBEDDING_ROUTE,
+            CUSTOM_GENERAL_ROUTE,
+        ) or (CACHE_GENERAL and route_path in CACHE_ROUTE_SET)
 
     def _handle_payload(self, method: str, payload, route_path: str, model_set):
 
@@ -325,14 +688,7 @@ class GenericForward:
             EMBEDDING_ROUTE,
             CUSTOM_GENERAL_ROUTE,
         ):
-            model = payload.get("model", None)
-
-            if model is not None and model not in model_set:
-                logger.warning(f"[Auth Warning] model: {model} is not allowed")
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=f"model: {model} is not allowed",
-                )
+            self.validate_model(payload.get("model", None), model_set)
 
     async def reverse_proxy(self, request: Request):
         """
@@ -345,7 +701,26 @@ class GenericForward:
             StreamingResponse: A FastAPI StreamingResponse containing the server's response.
         """
         assert self.client
-        data = await request.body()
+        client_config = self.prepare_client(request, return_origin_header=True)
+        route_path = client_config["route_path"]
+        _, model_set = self.handle_authorization(client_config)
+
+        if STREAM_REQUEST_BODY and not self._needs_payload(request, route_path):
+            body = await peek_body(request)
+            if not body.complete:
+                # pipe the rest of a large body straight to the upstream
+                r = await self.send(client_config, data=body.stream())
+                return StreamingResponse(
+                    self.release_after(
+                        self.aiter_bytes(r, request, route_path), client_config, r
+                    ),
+                    status_code=r.status,
+                    media_type=r.headers.get("content-type"),
+                )
+            data = body.head
+        else:
+            data = await request.body()
+
         if data:
             payload = orjson.loads(data)
         else:
@@ -353,14 +728,14 @@ class GenericForward:
 
         if LOG_GENERAL:
             logger.debug(f"payload: {payload}")
-        client_config = self.prepare_client(request, return_origin_header=True)
-        route_path = client_config["route_path"]
-
-        _, model_set = self.handle_authorization(client_config)
-        self._handle_payload(request.method, payload, route_path, model_set)
-
-        cached_response, cache_key = get_cached_generic_response(
-            data, request, route_path
+        # any valid JSON body is forwarded, fields are only read from an object
+        fields = payload if isinstance(payload, dict) else {}
+        self._handle_payload(request.method, fields, route_path, model_set)
+        client_config["cost"] = estimate_cost(data, fields.get("max_tokens"))
+        client_config["stream"] = fields.get("stream", False)
+
+        cached_response, cache_key = await cache_io.run(
+            get_cached_generic_response, data, request, route_path
         )
 
         if cached_response:
@@ -397,15 +772,71 @@ class GenericForward:
                         status_code=200,
                         media_type="text/event-stream",
                     )
-        r = await self.send(client_config, data=data)
+        flight, leader = self.join_flight(cache_key)
+        if not leader:
+            return await self.follow_flight(flight, request)
 
+        r = await self.send_in_flight(client_config, data, flight)
+        body = self.aiter_bytes(
+            r,
+            request,
+            route_path,
+            cache_key,
+            prefetched=client_config.get("prefetched", b""),
+            flight=flight,
+        )
+        if flight is not None:
+            flight.bind(body)
         return StreamingResponse(
-            self.aiter_bytes(r, request, cache_key),
+            self.release_after(body, client_config, r, flight),
             status_code=r.status,
             media_type=r.headers.get("content-type"),
-            background=BackgroundTask(r.release),
         )
 
+    def release_response(self, r: aiohttp.ClientResponse, client_config: dict):
+        """
+        Release the upstream response and the secret key it was sent with.
+        """
+        r.release()
+        self.release_key(client_config)
+
+    def release_after(
+        self,
+        body: AsyncGenerator[bytes, None],
+        client_config: dict,
+        r: aiohttp.ClientResponse | None = None,
+        flight: Flight | None = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Stream a response body, then release the secret key it was sent with and, if
+        given, the upstream response.
+
+        Unlike a background task of the response, this also runs when the client
+        disconnects mid-stream or the body is never consumed. The key is released once.
+
+        Args:
+            body (AsyncGenerator[bytes, None]): The response body.
+            client_config (dict): The client config of the request.
+            r (aiohttp.ClientResponse | None): The upstream response. Defaults to None.
+            flight (Flight | None): The flight this request leads, which keeps the
+                upstream response while it reads it for the followers. Defaults to None.
+        """
+
+        async def stream():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                # close the body before the response it reads from
+                await body.aclose()
+                if r is not None and (flight is None or not flight.draining):
+                    r.release()
+                self.release_key(client_config)
+
+        released = stream()
+        weakref.finalize(released, self.release_key, client_config)
+        return released
+
 
 class OpenaiForward(GenericForward):
     """
@@ -413,47 +844,73 @@ class OpenaiForward(GenericForward):
     Inherits from the GenericForward class and adds specific functionality for the OpenAI API.
     """
 
-    def __init__(self, base_url: str, route_prefix: str, proxy=None):
+    def __init__(
+        self,
+        base_url: str | List[str],
+        route_prefix: str,
+        proxy=None,
+        embedding_batch: dict | None = None,
+        **kwargs,
+    ):
         """
         Initialize the OpenaiForward class.
 
         Args:
-            base_url (str): The base URL to which requests will be forwarded.
+            base_url (str | List[str]): The base URL(s) to which requests will be forwarded.
             route_prefix (str): The prefix of the route.
             proxy (str, optional): The proxy to use for the requests. Defaults to None.
+            embedding_batch (dict, optional): Enables batching of concurrent embedding
+                requests with the given `EmbeddingBatcher` arguments. Defaults to None.
+            **kwargs: The `hedge`, `circuit_breaker` and `pool` options of `GenericForward`.
         """
-        super().__init__(base_url, route_prefix, proxy)
+        super().__init__(base_url, route_prefix, proxy, **kwargs)
+        self.batcher = (
+            EmbeddingBatcher(**embedding_batch) if embedding_batch is not None else None
+        )
         if LOG_OPENAI or PRINT_CHAT:
             self.chat_logger = ChatLogger(self.ROUTE_PREFIX)
             self.completion_logger = CompletionLogger(self.ROUTE_PREFIX)
             self.whisper_logger = WhisperLogger(self.ROUTE_PREFIX)
             self.embedding_logger = EmbeddingLogger(self.ROUTE_PREFIX)
+        # background refreshes of stale cache entries by cache key
+        self.revalidations: Dict[bytes, asyncio.Task] = {}
+
+    def stats(self) -> dict:
+        info = {**super().stats(), "revalidating": len(self.revalidations)}
+        if self.batcher is not None:
+            info["embedding_batch"] = self.batcher.to_dict()
+        return info
 
     def _handle_result(
-        self, buffer: bytearray, uid: str, route_path: str, request_method: str
+        self,
+        buffer: bytearray | None,
+        uid: str,
+        route_path: str,
+        request_method: str,
+        result_info: dict | None = None,
     ):
         """
         Logs the result of the API call.
 
         Args:
-            buffer (bytearray): List of bytes, usually from the API response.
+            buffer (bytearray | None): List of bytes, usually from the API response.
             uid (str): Unique identifier for the request.
             route_path (str): API route path.
             request_method (str): HTTP method (e.g., 'GET', 'POST').
+            result_info (dict | None): The result already parsed while streaming, if any.
 
         Raises:
             Suppress all errors.
         """
-        result_info = {}
-
         # If not configured to log or print chat, or the method is not POST, return early
         if not (LOG_OPENAI or PRINT_CHAT) or request_method != "POST":
-            return result_info
+            return {}
 
         try:
             logger_instance = self.get_logger(route_path)
             if logger_instance:
-                result_info = logger_instance.parse_bytearray(buffer)
+                if result_info is None:
+                    result_info = logger_instance.parse_bytearray(buffer)
                 result_info["uid"] = uid
 
                 if LOG_OPENAI:
@@ -470,6 +927,13 @@ class OpenaiForward(GenericForward):
 
         return result_info
 
+    def _needs_payload(self, request: Request, route_path: str) -> bool:
+        if route_path in CACHE_ROUTE_SET:
+            return True
+        if CACHE_OPENAI and route_path in (CHAT_COMPLETION_ROUTE, EMBEDDING_ROUTE):
+            return True
+        return request.method == "POST" and self.get_logger(route_path) is not None
+
     def get_logger(self, route_path: str):
         """
         Get which logger to use based on the route_path
@@ -501,7 +965,15 @@ class OpenaiForward(GenericForward):
         """
         payload_log_info = {"uid": None}
 
-        payload = await request.body()
+        if STREAM_REQUEST_BODY and not self._needs_payload(request, route_path):
+            body = await peek_body(request)
+            if not body.complete:
+                # only the model of a (multipart) upload is checked, the rest is piped
+                self.validate_model(body.form_field("model"), model_set)
+                return False, payload_log_info, body.stream()
+            payload = body.head
+        else:
+            payload = await request.body()
 
         if not (LOG_OPENAI or PRINT_CHAT) or request.method != "POST":
             return False, payload_log_info, payload
@@ -535,45 +1007,10 @@ class OpenaiForward(GenericForward):
         valid = True if payload_log_info['uid'] is not None else False
 
         if valid:
-            if payload_log_info["model"] not in model_set:
-                logger.warning(
-                    f"[Auth Warning] model: {payload_log_info['model']} is not allowed"
-                )
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail=f"model: {payload_log_info['model']} is not allowed",
-                )
+            self.validate_model(payload_log_info["model"], model_set)
 
         return valid, payload_log_info, payload
 
-    @staticmethod
-    async def read_chunks(r: aiohttp.ClientResponse, queue):
-        """
-        Read chunks of data from the response.
-
-        Args:
-            r (aiohttp.ClientResponse): The aiohttp.ClientResponse object.
-            queue (Queue): The queue to put the chunks into.
-
-        """
-        buffer = bytearray()
-
-        # Efficiency Mode
-        if ITER_CHUNK_TYPE == "efficiency":
-            # yield all available data as soon as it is received.
-            async for chunk in r.content.iter_any():
-                buffer.extend(chunk)
-                await queue.put(chunk)
-
-        # Precision Mode
-        else:
-            async for chunk, _ in r.content.iter_chunks():
-                buffer.extend(chunk)
-                await queue.put(chunk)
-
-        await queue.put(buffer)  # add all information when the stream ends
-
-    @async_token_rate_limit_auth_level(token_interval_conf, FWD_KEY)
     async def aiter_bytes(
         self,
         r: aiohttp.ClientResponse,
@@ -582,6 +1019,10 @@ class OpenaiForward(GenericForward):
         uid: str,
         cache_key: str | None = None,
         stream: bool | None = None,
+        prefetched: bytes = b"",
+        flight: Flight | None = None,
+        payload_info: dict | None = None,
+        paced: bool = True,
     ):
         """
         Asynchronously iterates through the bytes in the given aiohttp.ClientResponse object
@@ -594,6 +1035,10 @@ class OpenaiForward(GenericForward):
             uid (str): Unique identifier for the request.
             cache_key (bytes): The cache key.
             stream (bool): Whether the response is a stream.
+            prefetched (bytes): Bytes already read from the response. Defaults to b"".
+            flight (Flight | None): The flight this request leads, if any. Defaults to None.
+            payload_info (dict | None): The parsed payload, for the cache policy. Defaults to None.
+            paced (bool): Whether to apply the token rate limit of the request. Defaults to True.
 
         Returns:
              AsyncGenerator[bytes]: Each chunk of bytes from the server's response.
@@ -601,32 +1046,51 @@ class OpenaiForward(GenericForward):
 
         yield_completed = False
         chunk_list = []
+        delays = None
         chunk = None
+        result_info = None
         if stream:
-            queue = Queue()
-            # todo:
-            task = asyncio.create_task(self.read_chunks(r, queue))
+            sse, capture = None, flight
+            if uid:
+                logger_instance = self.get_logger(route_path)
+                if r.ok and r.headers.get("content-type", "").startswith(
+                    "text/event-stream"
+                ):
+                    # parse the events as they stream by instead of at the end
+                    accumulator = (
+                        logger_instance and logger_instance.stream_accumulator()
+                    )
+                    if accumulator is not None:
+                        sse = SSEStage(accumulator)
+                # raw chunks are only kept when they are needed for logging or caching
+                if capture is None and (sse is None or cache_key is not None):
+                    capture = ChunkCapture()
             try:
-                while True:
-                    chunk = await queue.get()
-                    if not isinstance(chunk, bytes):
-                        queue.task_done()
-                        yield_completed = True
-                        break
-                    if CACHE_OPENAI:
-                        chunk_list.append(chunk)
+                async for chunk in pump(
+                    r,
+                    self.build_stages(request, sse, capture, paced=paced),
+                    prefetched,
+                    ITER_CHUNK_TYPE,
+                ):
                     yield chunk
+                yield_completed = True
+                if sse is not None and sse.completed:
+                    result_info = sse.result()
             except Exception as e:
                 logger.warning(
                     f"aiter_bytes error:{e}\nhost:{request.client.host} method:{request.method}: "
                     f"{traceback.format_exc()}"
                 )
-            finally:
-                if not task.done():
-                    task.cancel()
+            if capture is not None and capture.chunks:
+                chunk_list = capture.chunks
+                delays = capture.delays
+                chunk = capture.data
         else:
             try:
-                chunk = await r.read()
+                chunk = await (r.read() if flight is None else flight.read())
+                if flight is not None:
+                    flight.feed(chunk)
+                    flight.close(True)
                 yield chunk
                 chunk_list.append(chunk)
                 chunk = bytearray(chunk)
@@ -636,16 +1100,27 @@ class OpenaiForward(GenericForward):
                     f"aiter_bytes error:{e}\nhost:{request.client.host} method:{request.method}: "
                     f"{traceback.format_exc()}"
                 )
+            finally:
+                if flight is not None:
+                    flight.close(False)
 
         r.release()
 
         if uid:
             if r.ok and yield_completed:
                 target_info = self._handle_result(
-                    chunk, uid, route_path, request.method
+                    chunk, uid, route_path, request.method, result_info
                 )
                 if CACHE_OPENAI:
-                    cache_response(cache_key, target_info, route_path, chunk_list)
+                    cache_io.submit(
+                        cache_response,
+                        cache_key,
+                        target_info,
+                        route_path,
+                        chunk_list,
+                        payload_info=payload_info,
+                        delays=delays,
+                    )
 
             elif chunk is not None:
                 logger.warning(
@@ -654,6 +1129,159 @@ class OpenaiForward(GenericForward):
             else:
                 logger.warning(f'uid: {uid}\n' f'{r.status}')
 
+    def revalidate(
+        self, client_config: dict, payload, payload_info: dict, cache_key, request
+    ):
+        """
+        Refresh a stale cache entry from upstream in the background, at most once per key
+        at a time.
+        """
+        if cache_key in self.revalidations:
+            return
+        task = asyncio.create_task(
+            self._revalidate(client_config, payload, payload_info, cache_key, request)
+        )
+        self.revalidations[cache_key] = task
+        task.add_done_callback(lambda _: self.revalidations.pop(cache_key, None))
+
+    async def _revalidate(
+        self, client_config: dict, payload, payload_info: dict, cache_key, request
+    ):
+        try:
+            r = await self.send(client_config, data=payload)
+            # draining the response writes it to the cache
+            async for _ in self.aiter_bytes(
+                r,
+                request,
+                client_config["route_path"],
+                payload_info["uid"],
+                cache_key,
+                client_config["stream"],
+                prefetched=client_config.get("prefetched", b""),
+                payload_info=payload_info,
+                # nobody reads a background refresh, it is not paced for the client
+                paced=False,
+            ):
+                pass
+        except Exception as e:
+            logger.warning(f"revalidate error: {e!r}")
+        finally:
+            self.release_key(client_config)
+
+    async def send_embedding_misses(
+        self, client_config: dict, payload, payload_info: dict, cache_key, request
+    ):
+        """
+        Asynchronously send only the embedding inputs missing from the cache upstream, and
+        answer with the cached and the new embeddings in the original order.
+        """
+        status_code, media_type, body = await self.fetch_embeddings(
+            client_config, reduce_payload(payload, payload_info)
+        )
+        if status_code >= 400:
+            return Response(
+                content=body, status_code=status_code, media_type=media_type
+            )
+
+        content, new_items = merge_response(body, payload_info, cache_key)
+        self._handle_result(
+            bytearray(content),
+            payload_info["uid"],
+            client_config["route_path"],
+            request.method,
+        )
+        cache_io.submit(cache_embedding_items, new_items, payload_info.get("model"))
+        return Response(content=content, media_type="application/json")
+
+    def batchable(self, data) -> dict | None:
+        """
+        The parsed body of an embedding request that may be batched, otherwise None.
+        """
+        if self.batcher is None or not isinstance(data, (bytes, bytearray)):
+            return None
+        try:
+            body = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(body, dict) or "input" not in body:
+            return None
+        return body if self.batcher.accepts(split_inputs(body["input"])) else None
+
+    async def _fetch(self, client_config: dict, data) -> Result:
+        r = await self.send(client_config, data=data)
+        try:
+            body = await r.read()
+        finally:
+            self.release_response(r, client_config)
+        return r.status, r.headers.get("content-type"), body
+
+    async def _fetch_batched(self, client_config: dict, body: dict) -> Result:
+        fk = client_config.get("fk")
+        # keys of different levels, or the own keys of clients, are never mixed
+        if fk is not None:
+            group = ("level", self._fk_to_level.get(fk))
+        else:
+            group = ("auth", client_config["auth"])
+
+        def send(data: bytes):
+            batch_config = {
+                **client_config,
+                "headers": dict(client_config["headers"]),
+                "cost": estimate_cost(data),
+            }
+            return self._fetch(batch_config, data)
+
+        return await self.batcher.submit(body, group, send)
+
+    async def fetch_embeddings(self, client_config: dict, data) -> Result:
+        """
+        Asynchronously send an embedding request and read its response, in a batch with
+        concurrent requests when embedding batching is enabled.
+
+        Returns:
+            Result: The status, content type and body of the response.
+        """
+        body = self.batchable(data)
+        if body is None:
+            return await self._fetch(client_config, data)
+        return await self._fetch_batched(client_config, body)
+
+    async def send_embedding_batch(
+        self, client_config: dict, body: dict, payload_info: dict, cache_key, request
+    ):
+        """
+        Asynchronously send an embedding request in a batch, then log and cache its part
+        of the response.
+        """
+        route_path = client_config["route_path"]
+        status_code, media_type, content = await self._fetch_batched(
+            client_config, body
+        )
+        uid = payload_info["uid"]
+        if uid and status_code < 400:
+            target_info = self._handle_result(
+                bytearray(content), uid, route_path, request.method
+            )
+            if CACHE_OPENAI:
+                cache_io.submit(
+                    cache_response,
+                    cache_key,
+                    target_info,
+                    route_path,
+                    [content],
+                    payload_info=payload_info,
+                )
+        return Response(content=content, status_code=status_code, media_type=media_type)
+
+    async def cancel_revalidations(self):
+        """
+        Asynchronously cancel the background refreshes still running.
+        """
+        tasks = list(self.revalidations.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     async def reverse_proxy(self, request: Request):
         """
         Asynchronously handles reverse proxying the incoming request.
@@ -673,8 +1301,11 @@ class OpenaiForward(GenericForward):
         )
         uid = payload_info["uid"]
         stream = payload_info.get('stream', DEFAULT_STREAM_RESPONSE)
+        client_config["cost"] = estimate_cost(payload, payload_info.get("max_tokens"))
+        client_config["stream"] = stream
 
-        cached_response, cache_key = get_cached_response(
+        cached_response, cache_key = await cache_io.run(
+            get_cached_response,
             payload,
             payload_info,
             valid_payload,
@@ -684,11 +1315,60 @@ class OpenaiForward(GenericForward):
         )
 
         if cached_response:
+            if payload_info.get("stale"):
+                self.revalidate(
+                    client_config, payload, payload_info, cache_key, request
+                )
             return cached_response
 
-        r = await self.send(client_config, data=payload)
+        if (
+            semantic_cache is not None
+            and route_path == CHAT_COMPLETION_ROUTE
+            and cache_key is not None
+            and payload_info.get("caching")
+        ):
+            cached_response = await semantic_cache.lookup(
+                payload_info, request, logger_instance=self.get_logger(route_path)
+            )
+            if cached_response:
+                return cached_response
+
+        if payload_info.get("embedding_misses") is not None:
+            return await self.send_embedding_misses(
+                client_config, payload, payload_info, cache_key, request
+            )
+
+        if route_path == EMBEDDING_ROUTE and request.method == "POST":
+            body = self.batchable(payload)
+            if body is not None:
+                return await self.send_embedding_batch(
+                    client_config, body, payload_info, cache_key, request
+                )
+
+        flight, leader = self.join_flight(
+            cache_key,
+            payload_info.get("caching", True),
+            (stream, payload_info.get("encoding_format")),
+        )
+        if not leader:
+            return await self.follow_flight(flight, request)
+
+        r = await self.send_in_flight(client_config, payload, flight)
+        body = self.aiter_bytes(
+            r,
+            request,
+            route_path,
+            uid,
+            cache_key,
+            stream,
+            prefetched=client_config.get("prefetched", b""),
+            flight=flight,
+            payload_info=payload_info,
+        )
+        if flight is not None:
+            flight.bind(body)
         return StreamingResponse(
-            self.aiter_bytes(r, request, route_path, uid, cache_key, stream),
+            self.release_after(body, client_config),
             status_code=r.status,
             media_type=r.headers.get("content-type"),
         )
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from collections import deque
+
+
+class LatencyTracker:
+    """
+    Keeps a window of recent latencies to estimate percentiles.
+    """
+
+    def __init__(self, window: int = 512):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, latency: float):
+        self._samples.append(latency)
+
+    def percentile(self, q: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        idx = min(int(q * len(ordered)), len(ordered) - 1)
+        return ordered[idx]
+
+
+class HedgePolicy:
+    """
+    Decides when a duplicate (hedged) request should be fired and how many are allowed.
+
+    The hedge delay is a percentile of the recently observed latencies (time to the
+    response headers, or to the first streamed bytes), clamped to [min_delay, max_delay].
+    Hedges are paid from a token bucket that every request refills by `budget`, so at most
+    roughly `budget` extra requests are sent per request.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        min_delay: float = 0.05,
+        max_delay: float = 3.0,
+        budget: float = 0.05,
+        burst: float = 10,
+        min_samples: int = 20,
+    ):
+        """
+        Args:
+            percentile (float): Latency percentile after which a hedge is fired.
+            min_delay (float): Lower bound of the hedge delay in seconds.
+            max_delay (float): Upper bound of the hedge delay in seconds, also used
+                until enough latencies have been observed.
+            budget (float): Ratio of extra requests that hedging may add.
+            burst (float): Maximum number of hedges that can be saved up.
+            min_samples (int): Number of latencies needed before the percentile is trusted.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+
+        self._trackers = {False: LatencyTracker(), True: LatencyTracker()}
+        self._tokens = 0.0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self, stream: bool = False) -> float:
+        """
+        Seconds to wait for the first attempt before hedging.
+        """
+        tracker = self._trackers[stream]
+        if len(tracker) < self.min_samples:
+            return self.max_delay
+        value = tracker.percentile(self.percentile)
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def record(self, latency: float, stream: bool = False):
+        self._trackers[stream].record(latency)
+
+    def on_request(self):
+        self._tokens = min(self._tokens + self.budget, self.burst)
+
+    def try_acquire(self) -> bool:
+        """
+        Take a hedge from the budget.
+
+        Returns:
+            bool: Whether a hedge may be fired.
+        """
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.hedged += 1
+            return True
+        return False
+
+    def to_dict(self):
+        return {
+            "delay": self.delay(False),
+            "stream_delay": self.delay(True),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import math
+import re
+import time
+from typing import Dict, Iterable, List, Mapping
+
+from loguru import logger
+
+from ..helper import parse_retry_after
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNIT = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """
+    Parse the duration format used by `x-ratelimit-reset-*` headers, e.g. '20ms', '1s', '6m0s'.
+
+    Returns:
+        float | None: The duration in seconds, None if it can not be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(num) * _DURATION_UNIT[unit] for num, unit in matches)
+
+
+def estimate_cost(payload, max_tokens: int | None = None) -> int:
+    """
+    Roughly estimate the number of tokens a request will consume, the prompt is assumed
+    to be about 4 bytes per token. Streamed payloads are not counted.
+    """
+    prompt_tokens = len(payload) // 4 if isinstance(payload, (bytes, bytearray)) else 0
+    return prompt_tokens + (max_tokens or 0)
+
+
+class KeyState:
+    def __init__(self, sk: str):
+        self.sk = sk
+        self.inflight = 0
+        self.inflight_cost = 0
+        self.remaining_requests: int | None = None
+        self.remaining_tokens: int | None = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.cooldown_until = 0.0
+
+    def headroom(self, cost: int, now: float) -> float:
+        """
+        How many more requests of this cost the key can take, inf if unknown.
+        """
+        requests = tokens = math.inf
+        if self.remaining_requests is not None and now < self.requests_reset_at:
+            requests = self.remaining_requests - self.inflight
+        if self.remaining_tokens is not None and now < self.tokens_reset_at:
+            tokens = (self.remaining_tokens - self.inflight_cost - cost) / max(cost, 1)
+        return min(requests, tokens)
+
+    def to_dict(self):
+        return {
+            "inflight": self.inflight,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+            "cooldown": max(self.cooldown_until - time.monotonic(), 0),
+        }
+
+
+class KeyScheduler:
+    """
+    Schedules upstream secret keys by their remaining capacity.
+
+    Each key tracks its in-flight requests and estimated token cost, together with the
+    `x-ratelimit-*` headers of its latest response. Keys that were rate limited, ran out
+    of quota or were rejected (401) are put on a cooldown and skipped.
+    """
+
+    def __init__(
+        self,
+        level_to_sks: Dict[int, List[str]],
+        cooldown: float = 20,
+        auth_cooldown: float = 600,
+    ):
+        """
+        Args:
+            level_to_sks (Dict[int, List[str]]): The secret keys of every level.
+            cooldown (float): Seconds a rate limited key is skipped, if the response says
+                nothing about when it resets.
+            auth_cooldown (float): Seconds a key rejected with 401 is skipped.
+        """
+        self.cooldown = cooldown
+        self.auth_cooldown = auth_cooldown
+        self._states: Dict[str, KeyState] = {}
+        self._level_to_sks: Dict[int, List[str]] = {}
+        self._offsets: Dict[int, int] = {}
+        for level, sks in level_to_sks.items():
+            self._level_to_sks[level] = list(sks)
+            self._offsets[level] = 0
+            for sk in sks:
+                self._states.setdefault(sk, KeyState(sk))
+
+    def __contains__(self, level):
+        return bool(self._level_to_sks.get(level))
+
+    def pick(
+        self, level: int, cost: int = 0, exclude: Iterable[str] = ()
+    ) -> str | None:
+        """
+        Pick the key of a level with the most headroom. Ties are broken round-robin.
+
+        Args:
+            level (int): The level of the forward key.
+            cost (int): Estimated token cost of the request.
+            exclude (Iterable[str]): Keys to avoid, e.g. ones that already failed for this request.
+
+        Returns:
+            str | None: The secret key, None if the level has no keys.
+        """
+        sks = self._level_to_sks.get(level)
+        if not sks:
+            return None
+
+        now = time.monotonic()
+        offset = self._offsets[level]
+        self._offsets[level] = (offset + 1) % len(sks)
+
+        best, best_score = None, None
+        fallback = None
+        for i in range(len(sks)):
+            state = self._states[sks[(offset + i) % len(sks)]]
+            if state.sk in exclude:
+                continue
+            if state.cooldown_until > now:
+                if fallback is None or state.cooldown_until < fallback.cooldown_until:
+                    fallback = state
+                continue
+            score = (state.headroom(cost, now), -state.inflight)
+            if best_score is None or score > best_score:
+                best, best_score = state, score
+
+        if best is None:
+            # every key is cooling down (or excluded), use the one that recovers first.
+            best = fallback or self._states[sks[offset]]
+        return best.sk
+
+    def acquire(self, sk: str, cost: int = 0):
+        state = self._states.get(sk)
+        if state:
+            state.inflight += 1
+            state.inflight_cost += cost
+
+    def release(self, sk: str, cost: int = 0):
+        state = self._states.get(sk)
+        if state:
+            state.inflight = max(state.inflight - 1, 0)
+            state.inflight_cost = max(state.inflight_cost - cost, 0)
+
+    def update(self, sk: str, status: int, headers: Mapping):
+        """
+        Update the state of a key from the response it received.
+
+        Args:
+            sk (str): The secret key used for the request.
+            status (int): The response status code.
+            headers (Mapping): The response headers.
+        """
+        state = self._states.get(sk)
+        if state is None:
+            return
+        now = time.monotonic()
+
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and remaining_requests.isdigit():
+            state.remaining_requests = int(remaining_requests)
+            reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+            state.requests_reset_at = now + (reset if reset is not None else 60)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and remaining_tokens.isdigit():
+            state.remaining_tokens = int(remaining_tokens)
+            reset = parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+            state.tokens_reset_at = now + (reset if reset is not None else 60)
+
+        cooldown = None
+        if status == 401:
+            cooldown = self.auth_cooldown
+        elif status == 429:
+            cooldown = parse_retry_after(headers)
+            if cooldown is None:
+                resets = [
+                    at - now
+                    for at in (state.requests_reset_at, state.tokens_reset_at)
+                    if at > now
+                ]
+                cooldown = max(resets) if resets else self.cooldown
+        elif state.remaining_requests == 0 and state.requests_reset_at > now:
+            cooldown = state.requests_reset_at - now
+        elif state.remaining_tokens == 0 and state.tokens_reset_at > now:
+            cooldown = state.tokens_reset_at - now
+
+        if cooldown:
+            state.cooldown_until = now + cooldown
+            logger.warning(
+                f"api key {sk[:7]}... cooling down for {cooldown:.1f}s (status {status})"
+            )
+
+    def stats(self) -> Dict[str, dict]:
+        return {f"{sk[:7]}...": state.to_dict() for sk, state in self._states.items()}
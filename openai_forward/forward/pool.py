@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, Iterable, Tuple
+
+import aiohttp
+from aiohttp import TCPConnector
+from loguru import logger
+from yarl import URL
+
+
+class PoolProfile:
+    """
+    Connection pool and timeout settings of the upstream client of a forward route.
+    """
+
+    def __init__(
+        self,
+        limit: int = 500,
+        limit_per_host: int = 0,
+        ttl_dns_cache: float | None = 300,
+        keepalive_timeout: float = 30,
+        connect_timeout: float | None = None,
+        sock_read_timeout: float | None = None,
+        total_timeout: float | None = None,
+        warmup: int = 0,
+        warmup_timeout: float = 10,
+    ):
+        """
+        Args:
+            limit (int): Maximum number of open connections, 0 for no limit.
+            limit_per_host (int): Maximum number of open connections per host, 0 for no limit.
+            ttl_dns_cache (float | None): Seconds resolved addresses are cached, None forever.
+            keepalive_timeout (float): Seconds an idle connection is kept open.
+            connect_timeout (float | None): Timeout for acquiring and opening a connection.
+            sock_read_timeout (float | None): Maximum seconds between two reads of a response,
+                e.g. a stalled stream.
+            total_timeout (float | None): Timeout of a whole request.
+            warmup (int): Connections opened to every upstream on startup.
+            warmup_timeout (float): Timeout of the warm-up of one upstream.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.warmup = warmup
+        self.warmup_timeout = warmup_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, connect=connect_timeout, sock_read=sock_read_timeout
+        )
+
+    def build_session(self) -> aiohttp.ClientSession:
+        connector = TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+            force_close=False,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def warm_up(
+        self, session: aiohttp.ClientSession, base_urls: Iterable[str], proxy=None
+    ):
+        """
+        Resolve the upstream hosts and open `warmup` keep-alive connections to each of them,
+        so the first requests do not pay for DNS lookups and TLS handshakes.
+
+        Failures are logged and otherwise ignored.
+        """
+        if self.warmup <= 0:
+            return
+
+        async def touch(url: str):
+            async with session.head(url, proxy=proxy, allow_redirects=False) as r:
+                await r.read()
+
+        async def warm_up_one(url: str):
+            # concurrent requests make the pool open one connection each
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(touch(url) for _ in range(self.warmup))),
+                    self.warmup_timeout,
+                )
+            except Exception as e:
+                logger.warning(f"warm up {url} failed: {e!r}")
+            else:
+                logger.info(f"warmed up {self.warmup} connections to {url}")
+
+        await asyncio.gather(*(warm_up_one(url) for url in base_urls))
+
+    @property
+    def connector_options(self) -> tuple:
+        return (
+            self.limit,
+            self.limit_per_host,
+            self.ttl_dns_cache,
+            self.keepalive_timeout,
+        )
+
+    @staticmethod
+    def occupancy(session: aiohttp.ClientSession | None) -> dict:
+        """
+        The occupancy of the pool of `session`.
+        """
+        connector = getattr(session, "connector", None)
+        if not isinstance(connector, TCPConnector) or connector.closed:
+            return {}
+        info = {"limit": connector.limit, "limit_per_host": connector.limit_per_host}
+        # aiohttp does not expose these counters publicly, they are left out should its
+        # internals change
+        acquired = getattr(connector, "_acquired", None)
+        conns = getattr(connector, "_conns", None)
+        try:
+            if acquired is not None:
+                info["in_use"] = len(acquired)
+            if isinstance(conns, dict):
+                info["idle"] = sum(len(c) for c in conns.values())
+        except TypeError:
+            pass
+        return info
+
+
+class ClientRegistry:
+    """
+    Shares one client session, and so one keep-alive connection pool, among all upstreams
+    with the same scheme, host and proxy, even across forward routes.
+
+    The pool settings of the first route using a host apply, timeouts stay per route.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[Tuple, aiohttp.ClientSession] = {}
+        self._profiles: Dict[Tuple, PoolProfile] = {}
+        self._base_urls: Dict[Tuple, str] = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def key(base_url: str, proxy=None) -> Tuple:
+        url = URL(base_url)
+        return url.scheme, url.host, url.port, proxy
+
+    def get(
+        self, base_url: str, proxy=None, profile: PoolProfile | None = None
+    ) -> aiohttp.ClientSession:
+        """
+        Get the session for an upstream, creating it with `profile` on first use.
+        """
+        key = self.key(base_url, proxy)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            profile = profile or PoolProfile()
+            session = self._sessions[key] = profile.build_session()
+            self._profiles[key] = profile
+            self._base_urls[key] = base_url
+        elif (
+            profile is not None
+            and profile.connector_options != self._profiles[key].connector_options
+        ):
+            logger.info(
+                f"{base_url} shares the connection pool of {self._base_urls[key]}, "
+                f"its own pool settings are ignored"
+            )
+        return session
+
+    async def warm_up(self):
+        """
+        Asynchronously warm up the pool of every session once.
+        """
+        await asyncio.gather(
+            *(
+                self._profiles[key].warm_up(session, [self._base_urls[key]], key[-1])
+                for key, session in self._sessions.items()
+            )
+        )
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            self._base_urls[key]: PoolProfile.occupancy(session)
+            for key, session in self._sessions.items()
+        }
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import AsyncGenerator, AsyncIterable, Iterable, List
+
+import aiohttp
+from loguru import logger
+
+from ..content.helper import SSEParser
+
+
+class Stage:
+    """
+    A step of the streaming pipeline. Every chunk passes through all stages, in order,
+    right before it is sent to the client.
+    """
+
+    def feed(self, chunk: bytes) -> float:
+        """
+        Handle a chunk.
+
+        Returns:
+            float: Seconds to hold the chunk back, 0 to send it right away.
+        """
+        return 0
+
+    def close(self, completed: bool):
+        """
+        Called once after the last chunk.
+
+        Args:
+            completed (bool): Whether the whole response was read.
+        """
+
+
+class TokenPacer(Stage):
+    """
+    Paces chunks to at most one per `interval` seconds, i.e. the token rate limit.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._last = time.perf_counter()
+
+    def feed(self, chunk: bytes) -> float:
+        now = time.perf_counter()
+        delay = self.interval - (now - self._last)
+        if delay > 0:
+            self._last = now + delay
+            return delay
+        self._last = now
+        return 0
+
+
+class ChunkCapture(Stage):
+    """
+    Keeps the chunks of a response, e.g. for logging or caching once it completed, and
+    the seconds before each of them arrived.
+    """
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.delays: List[float] = []
+        self.completed = False
+        self._last = time.perf_counter()
+
+    def feed(self, chunk: bytes) -> float:
+        now = time.perf_counter()
+        self.chunks.append(chunk)
+        self.delays.append(now - self._last)
+        self._last = now
+        return 0
+
+    def close(self, completed: bool):
+        self.completed = completed
+
+    @property
+    def data(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+class SSEStage(Stage):
+    """
+    Parses server-sent events as they stream by and feeds their data to an accumulator,
+    so the result of a stream is ready as soon as it ends.
+    """
+
+    def __init__(self, accumulator):
+        """
+        Args:
+            accumulator (StreamAccumulator): Receives the data of every event.
+        """
+        self.accumulator = accumulator
+        self.parser = SSEParser()
+        self.completed = False
+
+    def feed(self, chunk: bytes) -> float:
+        if self.parser is not None:
+            try:
+                for data in self.parser.feed(chunk):
+                    self.accumulator.feed(data)
+            except Exception as e:
+                # never break the stream for the sake of logging
+                logger.warning(f"parse sse error: {e}")
+                self.parser = None
+        return 0
+
+    def close(self, completed: bool):
+        self.completed = completed and self.parser is not None
+
+    def result(self) -> dict:
+        return self.accumulator.result()
+
+
+async def pump(
+    r: aiohttp.ClientResponse,
+    stages: Iterable[Stage] = (),
+    prefetched: bytes = b"",
+    chunk_type: str = "efficiency",
+) -> AsyncGenerator[bytes, None]:
+    """
+    Stream the body of a response through the given stages in a single pass.
+
+    The upstream is only read when the client asks for the next chunk, so a slow client
+    slows down the upstream socket instead of piling up chunks in memory: aiohttp stops
+    reading from the socket once its own (bounded) buffer is full.
+
+    Args:
+        r (aiohttp.ClientResponse): The upstream response.
+        stages (Iterable[Stage]): Stages every chunk passes through.
+        prefetched (bytes): Bytes already read from the response. Defaults to b"".
+        chunk_type (str): "efficiency" yields whatever is available, otherwise the
+            chunks are yielded as they were received.
+
+    Yields:
+        bytes: Each chunk of the response.
+    """
+    stages = list(stages)
+    content = r.content
+    efficiency = chunk_type == "efficiency"
+    completed = False
+    chunk = prefetched
+    try:
+        while True:
+            if chunk:
+                delay = 0
+                for stage in stages:
+                    delay += stage.feed(chunk)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield chunk
+
+            if efficiency:
+                chunk = await content.readany()
+                if not chunk:
+                    break
+            else:
+                chunk, end_of_http_chunk = await content.readchunk()
+                if not chunk and not end_of_http_chunk:
+                    break
+        completed = True
+    finally:
+        for stage in stages:
+            stage.close(completed)
+
+
+async def relay(
+    chunks: AsyncIterable[bytes], stages: Iterable[Stage] = ()
+) -> AsyncGenerator[bytes, None]:
+    """
+    Like `pump`, for chunks that do not come from an upstream response.
+    """
+    stages = list(stages)
+    completed = False
+    try:
+        async for chunk in chunks:
+            delay = 0
+            for stage in stages:
+                delay += stage.feed(chunk)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield chunk
+        completed = True
+    finally:
+        for stage in stages:
+            stage.close(completed)
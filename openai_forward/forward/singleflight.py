@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import asyncio
+import weakref
+from typing import AsyncGenerator, Dict, Hashable, Tuple
+
+import aiohttp
+from fastapi import HTTPException, status
+from loguru import logger
+
+from .pump import ChunkCapture
+
+
+class Flight(ChunkCapture):
+    """
+    One upstream call that identical concurrent requests wait for instead of sending
+    their own. The leading request streams the response through it as a stage, every
+    follower replays the chunks received so far and then the new ones as they arrive.
+
+    If the client of the leading request goes away while followers are still waiting,
+    the flight reads the rest of the upstream response for them.
+    """
+
+    def __init__(self, key: Hashable, registry: SingleFlight | None = None):
+        super().__init__()
+        self.key = key
+        self.status: int | None = None
+        self.media_type: str | None = None
+        self.error: BaseException | None = None
+        self.done = False
+        self.followers = 0
+        self._registry = registry
+        self._ready = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._response: aiohttp.ClientResponse | None = None
+        self._prefetched = b""
+        self._reading: asyncio.Future | None = None
+        self._drainer: asyncio.Task | None = None
+
+    def start(
+        self,
+        status_code: int,
+        media_type: str | None,
+        response: aiohttp.ClientResponse | None = None,
+        prefetched: bytes = b"",
+    ):
+        """
+        The response headers of the leading request arrived.
+
+        Args:
+            status_code (int): The status of the response.
+            media_type (str | None): Its content type.
+            response (aiohttp.ClientResponse | None): The response itself, to read the
+                rest of it for the followers if the leading client goes away.
+            prefetched (bytes): Bytes already read from the response. Defaults to b"".
+        """
+        self.status = status_code
+        self.media_type = media_type
+        self._response = response
+        self._prefetched = prefetched
+        self._ready.set()
+
+    def fail(self, error: BaseException):
+        """The leading request failed before it got a response."""
+        self.error = error
+        self._ready.set()
+        self.close(False)
+
+    def feed(self, chunk: bytes) -> float:
+        super().feed(chunk)
+        self._notify()
+        return 0
+
+    def read(self) -> asyncio.Future:
+        """
+        Read the whole body of a non-stream response, it reaches the followers even if
+        the leading request is cancelled meanwhile.
+        """
+        self._reading = asyncio.ensure_future(self._response.read())
+        return asyncio.shield(self._reading)
+
+    def close(self, completed: bool):
+        if self.done or self._drainer is not None:
+            return
+        if not completed and self.followers and self._response is not None:
+            try:
+                self._drainer = asyncio.get_running_loop().create_task(self._drain())
+                return
+            except RuntimeError:
+                # no event loop anymore
+                pass
+        self._land(completed)
+
+    async def _drain(self):
+        completed = False
+        try:
+            if self._reading is not None:
+                self.feed(await self._reading)
+            else:
+                if not self.chunks and self._prefetched:
+                    self.feed(self._prefetched)
+                while True:
+                    chunk = await self._response.content.readany()
+                    if not chunk:
+                        break
+                    self.feed(chunk)
+                    if not self.followers:
+                        # every follower is gone as well
+                        return
+            completed = True
+        except Exception as e:
+            logger.warning(f"in-flight drain error: {e!r}")
+        finally:
+            self._response.release()
+            self._land(completed)
+
+    def _land(self, completed: bool):
+        self.done = True
+        self.completed = completed
+        self._ready.set()
+        self._notify()
+        if self._registry is not None:
+            self._registry.leave(self)
+
+    def unfollow(self):
+        """A follower stopped reading the response."""
+        self.followers -= 1
+
+    def follow(self) -> AsyncGenerator[bytes, None]:
+        """
+        The chunks of the response for a follower, which leaves the flight once it stops
+        reading them, also if it never started.
+        """
+        left = False
+
+        def leave():
+            nonlocal left
+            if not left:
+                left = True
+                self.unfollow()
+
+        async def chunks():
+            try:
+                async for chunk in self.iter_chunks():
+                    yield chunk
+            finally:
+                leave()
+
+        body = chunks()
+        weakref.finalize(body, leave)
+        return body
+
+    @property
+    def draining(self) -> bool:
+        """Whether the flight reads the rest of the response itself, and releases it."""
+        return self._drainer is not None
+
+    def bind(self, body: AsyncGenerator):
+        """
+        Land the flight once the response body of the leading request is gone, even if
+        it was never consumed, e.g. because the client disconnected right away.
+        """
+        weakref.finalize(body, self.close, False)
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_ready(self):
+        """
+        Wait for the response headers of the leading request.
+
+        Raises:
+            HTTPException: If the leading request failed.
+        """
+        await self._ready.wait()
+        if self.error is not None:
+            if isinstance(self.error, HTTPException):
+                raise HTTPException(
+                    status_code=self.error.status_code,
+                    detail=self.error.detail,
+                    headers=self.error.headers,
+                )
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"upstream request failed: {self.error!r}",
+            )
+        if self.status is None:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="upstream request was aborted",
+            )
+
+    async def iter_chunks(self) -> AsyncGenerator[bytes, None]:
+        """
+        Yield all chunks of the response, waiting for the ones still to come.
+        """
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent requests with the same cache key into a single upstream call.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def join(self, key: Hashable) -> Tuple[Flight, bool]:
+        """
+        Join the flight of `key`, starting a new one if none is in the air.
+
+        Returns:
+            Tuple[Flight, bool]: The flight, and whether the caller leads it, i.e. has to
+                send the upstream request and stream the response through the flight.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            return flight, False
+        flight = self._flights[key] = Flight(key, self)
+        return flight, True
+
+    def leave(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
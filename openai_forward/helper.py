@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import ast
 import hashlib
 import inspect
@@ -5,7 +7,7 @@ import os
 import re
 import time
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Mapping, Union
 
 import orjson
 from fastapi import Request
@@ -80,6 +82,41 @@ def get_client_ip(request: Request):
     return request.client.host
 
 
+def parse_retry_after(headers: Mapping) -> float | None:
+    """
+    Parse the `Retry-After` header (in seconds) of a response.
+    """
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+_SIZE_UNITS = {"": 1, "B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+
+
+def parse_size(size: int | str) -> int:
+    """
+    Parse a size in bytes, e.g. 1024, "512KB", "256MB" or "1GB".
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", size.upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    num, unit = match.groups()
+    return int(float(num) * _SIZE_UNITS[unit if unit in _SIZE_UNITS else unit + "B"])
+
+
 def route_prefix_to_str(route_prefix):
     return route_prefix.replace('/', '_').strip("_") or "openai"
 
@@ -0,0 +1,506 @@
+import time
+
+import orjson
+
+from openai_forward.cache.memory import MemoryCache
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_size=400)
+    cache[b'a'] = {'data': b'x' * 50}
+    cache[b'b'] = {'data': b'y' * 50}
+    assert b'a' in cache  # a is now more recently used than b
+    cache[b'c'] = {'data': b'z' * 50}
+
+    assert cache.get(b'b') is None
+    assert cache[b'a'] == {'data': b'x' * 50}
+    assert cache.size <= cache.max_size
+    assert cache.stats()['evictions'] == 1
+
+
+def test_memory_cache_ttl_by_route_and_model():
+    cache = MemoryCache(
+        ttl={'default': 0, 'routes': {'/v1/embeddings': 0.01}, 'models': {'m': 60}}
+    )
+    cache[b'a'] = {'route_path': '/v1/embeddings'}
+    cache[b'b'] = {'route_path': '/v1/embeddings', 'model': 'm'}
+    cache[b'c'] = {'route_path': '/v1/chat/completions'}
+    time.sleep(0.02)
+
+    assert b'a' not in cache
+    assert b'b' in cache and b'c' in cache
+    assert cache.stats()['expirations'] == 1
+
+
+def test_memory_cache_removals_leave_the_index():
+    from openai_forward.cache.admin import CacheIndex
+
+    index = CacheIndex()
+    cache = MemoryCache(
+        max_size=400, ttl={'models': {'m': 0.01}}, on_remove=index.discard
+    )
+    for key, model in ((b'a', 'm'), (b'b', None), (b'c', None)):
+        cache[key] = {'data': key * 50, 'model': model}
+        index.add(key, '/r', model, None, 50)
+    # c evicted a, the least recently used one
+    assert index.select() == [b'b', b'c']
+
+    cache.set(b'd', {'data': b'd'}, model='m')
+    index.add(b'd', '/r', 'm', None, 10)
+    time.sleep(0.02)
+    assert b'd' not in cache
+    assert b'd' not in index.select()
+    assert not cache.set(b'e', {'data': b'e' * 500})
+
+
+def test_tiered_cache_writes_through_and_serves_hot():
+    from openai_forward.cache.tiered import TieredCache
+
+    store = {}
+    cache = TieredCache(store, max_items=1)
+    cache[b'a'] = {'data': [1]}
+    assert store[b'a'] == {'data': [1]}
+
+    cache[b'b'] = {'data': [2]}  # evicts a from the hot tier only
+    assert b'a' in cache and cache[b'a'] == {'data': [1]}
+    assert cache.stats()['store_hits'] == 1
+
+    del cache[b'a']
+    assert b'a' not in cache and b'a' not in store
+
+
+def test_cache_response_never_changes_a_value_in_place(monkeypatch):
+    import openai_forward.cache as cache
+    from openai_forward.cache.tiered import TieredCache
+
+    monkeypatch.setattr(cache, 'db_dict', TieredCache({}, max_items=8))
+    monkeypatch.setattr(cache, 'CACHE_OPENAI', True)
+    payload_info = {'model': 'm', 'stream': False, 'temperature': 1}
+    for text in ('a', 'b'):
+        cache.cache_response(
+            b'key',
+            {'assistant': text},
+            '/v1/chat/completions',
+            [b'{}'],
+            payload_info,
+        )
+        if text == 'a':
+            served = cache.db_dict.get(b'key')
+    assert len(served['data']) == 1
+    assert len(cache.db_dict.get(b'key')['data']) == 2
+    cache.cache_index.discard(b'key')
+
+
+def test_cache_io_flushes_writes_in_batches():
+    import asyncio
+
+    from openai_forward.cache.io import CacheIO
+
+    store = {}
+    cache_io = CacheIO(offload=True, batch_size=8, flush_interval=0.01)
+
+    async def run():
+        for i in range(20):
+            cache_io.submit(store.__setitem__, i, i)
+        assert await cache_io.run(store.get, 0) is None  # not flushed yet
+        await asyncio.sleep(0.1)
+        await cache_io.close()
+
+    asyncio.run(run())
+    assert store == {i: i for i in range(20)}
+    stats = cache_io.stats()
+    assert stats['written'] == 20 and stats['flushes'] == 3
+
+
+def test_cache_io_awaited_writes_run_in_order_on_the_writer():
+    import asyncio
+    import threading
+
+    import pytest
+
+    from openai_forward.cache.io import CacheIO
+
+    store = {}
+    cache_io = CacheIO(offload=False, flush_interval=0.01)
+
+    def pop(key):
+        return store.pop(key), threading.current_thread().name
+
+    async def run():
+        cache_io.submit(store.__setitem__, 'a', 1)
+        value, thread = await cache_io.write(pop, 'a')
+        with pytest.raises(KeyError):
+            await cache_io.write(pop, 'a')
+        await cache_io.close()
+        return value, thread
+
+    value, thread = asyncio.run(run())
+    assert value == 1 and thread.startswith('cache-write')
+    assert cache_io.stats()['failed'] == 1
+
+
+def test_bloom_filter_skips_store_and_survives_restart(tmp_path):
+    from openai_forward.cache.bloom import ScalableBloomFilter
+    from openai_forward.cache.tiered import TieredCache
+
+    class Store(dict):
+        reads = 0
+
+        def get(self, key, default=None):
+            self.reads += 1
+            return super().get(key, default)
+
+    path = tmp_path / 'CACHE_DB.bloom'
+    store = Store()
+    cache = TieredCache(
+        store, max_items=0, bloom=ScalableBloomFilter(capacity=16, path=path)
+    )
+    for i in range(100):
+        cache[f'key-{i}'] = {'data': [i]}
+    assert all(f'key-{i}' in cache for i in range(100))  # no false negatives
+    assert len(cache.bloom._filters) > 1
+
+    store.reads = 0
+    misses = sum(f'other-{i}' not in cache for i in range(1000))
+    assert misses == 1000 and store.reads < 100
+
+    cache.save_snapshot()
+    restored = ScalableBloomFilter(capacity=16, path=path)
+    assert restored.load(len(store)) and 'key-42' in restored
+    # the snapshot is consumed, a run that does not save again leaves none behind
+    assert not path.exists() and not ScalableBloomFilter(path=path).load(len(store))
+
+    cache.save_snapshot()
+    assert not ScalableBloomFilter(path=path).load(len(store) + 1)
+
+
+def test_cache_policy_keys_variants_and_ttl():
+    from openai_forward.cache.policy import CachePolicies
+
+    policies = CachePolicies(
+        {
+            'routes': {
+                '/v1/chat/completions': {
+                    'normalize': {'whitespace': True, 'sort_keys': True},
+                    'ttl': 60,
+                }
+            },
+            'models': {'gpt-4o': {'key_fields': ['model', 'messages'], 'ttl': 0}},
+        },
+        ttl={'default': 10},
+    )
+    chat = policies.get('/v1/chat/completions', 'gpt-3.5-turbo')
+    assert chat is policies.get('/v1/chat/completions', 'other-model')
+    assert chat.max_variants == 10 and chat.ttl == 60
+    messages = [{'role': 'user', 'content': 'hi  there\n'}]
+    reordered = [{'content': 'hi there', 'role': 'user'}]
+    assert chat.make_key({'messages': messages}) == chat.make_key(
+        {'messages': reordered}
+    )
+    assert chat.make_key({'messages': messages}) != chat.make_key(
+        {'messages': messages, 'n': 2}
+    )
+
+    assert chat.variants_for({'temperature': 0}) == 1
+    assert chat.variants_for({'temperature': 1, 'seed': 7}) == 1
+    assert chat.variants_for({'temperature': 1}) == 10
+    assert chat.is_fresh(time.time() - 30) and not chat.is_fresh(time.time() - 90)
+    assert chat.is_fresh(None)
+
+    assert chat.retention == 120 and chat.is_servable(time.time() - 90)
+    assert not chat.is_servable(time.time() - 150)
+
+    gpt4o = policies.get('/v1/chat/completions', 'gpt-4o')
+    assert gpt4o.key_fields == ['model', 'messages'] and gpt4o.ttl == 0
+    assert gpt4o.is_fresh(0)
+
+    general = policies.get('/v1/images/generations')
+    assert general.max_variants == 3 and general.ttl == 10
+    assert general.make_raw_key(b'{"a": 1}') != general.make_raw_key(b'{"a":1}')
+
+
+def test_replay_frames_modes():
+    import asyncio
+
+    from openai_forward.cache.chat.response import make_variant, replay_frames
+
+    variant = make_variant('gpt-3.5-turbo', 'Hello, world.')
+    assert b'[DONE]' not in variant['frames'][-1] and variant['delays'] is None
+
+    recorded = make_variant('m', 'ab', [b'data: a\n\n', b'data: b\n\n'], [0, 0.05])
+
+    async def collect(*args):
+        start = time.perf_counter()
+        frames = [frame async for frame in replay_frames(*args)]
+        return frames, time.perf_counter() - start
+
+    frames, elapsed = asyncio.run(collect(variant['frames'], None, 'instant'))
+    assert frames == [b''.join(variant['frames'])] and elapsed < 0.05
+
+    frames, elapsed = asyncio.run(
+        collect(recorded['frames'], recorded['delays'], 'recorded')
+    )
+    assert frames == [b'data: a\n\n', b'data: b\n\n'] and elapsed >= 0.05
+
+    frames, elapsed = asyncio.run(collect(recorded['frames'], None, 'throttled', 0.02))
+    assert len(frames) == 2 and elapsed >= 0.02
+
+
+def test_split_frames_keeps_usage_for_replay():
+    from openai_forward.cache.chat.response import make_variant
+
+    usage = {'prompt_tokens': 5, 'completion_tokens': 2, 'total_tokens': 7}
+    chunks = [
+        b'data: {"choices":[{"delta":{"content":"a"}}]}\n\ndata: {"choi',
+        b'ces":[{"delta":{"content":"b"}}]}\n\n',
+        b'data: {"choices":[],"usage":'
+        + orjson.dumps(usage)
+        + b'}\n\ndata: [DONE]\n\n',
+    ]
+    variant = make_variant('m', 'ab', chunks, [0.1, 0.2, 0.3])
+    assert variant['frames'] == [
+        b'data: {"choices":[{"delta":{"content":"a"}}]}\n\n',
+        b'data: {"choices":[{"delta":{"content":"b"}}]}\n\n',
+    ]
+    assert variant['delays'] == [0.1, 0.2]
+    assert variant['usage'] == usage
+
+
+def test_embedding_partial_miss_is_merged_in_order():
+    from openai_forward.cache.embedding.response import (
+        construct_cache_key,
+        merge_response,
+        reduce_payload,
+        split_tokens,
+    )
+
+    payload_info = {
+        'model': 'text-embedding-3-small',
+        'input': ['a', 'bb', 'a', 'cccc'],
+        'encoding_format': 'float',
+    }
+    keys = construct_cache_key(payload_info)
+    assert len(keys) == 4 and keys[0] == keys[2] != keys[1]
+    assert split_tokens(['a', 'bbb'], 5) == [1, 4]
+    # no non-empty input is left without tokens
+    assert split_tokens(['a', 'bb'], 2) == [1, 1]
+    assert split_tokens(['a', 'b' * 100], 3) == [1, 2]
+    assert split_tokens(['a', 'bb', 'ccc'], 2) == [0, 1, 1]
+
+    # 'bb' is cached, the duplicate 'a' is sent once
+    cached = {'embedding': [0.25], 'tokens': 2, 'model': 'text-embedding-3-small'}
+    payload_info['embedding_hits'] = {1: cached}
+    payload_info['embedding_misses'] = [0, 3]
+    payload = orjson.dumps({'model': 'text-embedding-3-small', 'input': ['x']})
+    reduced = orjson.loads(reduce_payload(payload, payload_info))
+    assert reduced['input'] == ['a', 'cccc'] and reduced['encoding_format'] == 'base64'
+
+    upstream = {
+        'object': 'list',
+        'data': [
+            {'object': 'embedding', 'index': 1, 'embedding': [0.375]},
+            {'object': 'embedding', 'index': 0, 'embedding': [0.125]},
+        ],
+        'model': 'text-embedding-3-small',
+        'usage': {'prompt_tokens': 5, 'total_tokens': 5},
+    }
+    content, new_items = merge_response(orjson.dumps(upstream), payload_info, keys)
+    result = orjson.loads(content)
+    assert [d['embedding'] for d in result['data']] == [
+        [0.125],
+        [0.25],
+        [0.125],
+        [0.375],
+    ]
+    assert [d['index'] for d in result['data']] == [0, 1, 2, 3]
+    assert result['usage'] == {'prompt_tokens': 8, 'total_tokens': 8}
+    assert set(new_items) == {keys[0], keys[3]}
+
+
+def test_empty_embedding_input_skips_the_cache(monkeypatch):
+    from openai_forward.cache.embedding import response
+
+    monkeypatch.setattr(response, 'CACHE_OPENAI', True)
+    payload_info = {
+        'model': 'text-embedding-3-small',
+        'input': [],
+        'caching': True,
+        'uid': 'uid',
+    }
+    assert response.get_cached_embedding_response(payload_info, True, None) == (
+        None,
+        None,
+    )
+
+
+def test_embedding_vectors_are_packed_and_rendered_in_either_format():
+    import base64
+
+    import numpy as np
+
+    from openai_forward.cache.embedding.vectors import (
+        pack_vector,
+        render_vector,
+        unpack_vector,
+    )
+
+    embedding = np.random.default_rng(0).uniform(-1, 1, 256).astype(np.float32)
+    encoded = base64.b64encode(embedding.astype('<f4').tobytes()).decode()
+
+    entry = pack_vector(encoded)
+    assert entry['dtype'] == 'float32' and len(entry['vector']) == 256 * 4
+    assert np.array_equal(unpack_vector(entry), embedding)
+    assert render_vector(entry, 'base64') == encoded
+    assert np.array_equal(pack_vector(embedding.tolist())['vector'], entry['vector'])
+
+    half = pack_vector(embedding.tolist(), 'float16')
+    assert len(half['vector']) == 256 * 2
+    assert np.abs(unpack_vector(half) - embedding).max() < 1e-3
+
+    quantized = pack_vector(embedding.tolist(), 'int8')
+    assert len(quantized['vector']) == 256
+    error = np.abs(render_vector(quantized) - embedding).max()
+    assert error <= quantized['scale'] / 254 + 1e-6
+
+
+def test_semantic_index_searches_scope_and_evicts(tmp_path):
+    import numpy as np
+
+    from openai_forward.cache.policy import CachePolicy
+    from openai_forward.cache.semantic import SemanticCache, SemanticIndex
+
+    rng = np.random.default_rng(0)
+    a, b, c = rng.normal(size=(3, 64)).astype(np.float32)
+    index = SemanticIndex(capacity=2, path=tmp_path / 'CACHE_DB.semantic')
+    index.add(b'a', a, scope=1)
+    index.add(b'b', b, scope=2)
+
+    key, similarity = index.search(a + 0.05 * c, scope=1)
+    assert key == b'a' and similarity > 0.95
+    # the same prompt with another context does not match
+    assert index.search(a, scope=2)[0] == b'b'
+    assert index.search(a, scope=3) == (None, 0.0)
+
+    # 'a' was used least recently
+    index.add(b'c', c, scope=1)
+    assert len(index) == 2 and index.search(a, scope=1)[0] == b'c'
+
+    index.save()
+    restored = SemanticIndex(capacity=2, path=tmp_path / 'CACHE_DB.semantic')
+    assert restored.load() and restored.search(b, scope=2)[0] == b'b'
+
+    policy = CachePolicy(key_fields=['messages', 'model'])
+    question = {'role': 'user', 'content': 'How do I reset my password?'}
+    text, scope = SemanticCache.query(
+        {'model': 'm', 'messages': [{'role': 'system', 'content': 's'}, question]},
+        policy,
+    )
+    assert text == question['content']
+    other = {'role': 'user', 'content': 'Password reset?'}
+    assert SemanticCache.query({'model': 'm', 'messages': [other]}, policy)[1] != scope
+    assert (
+        SemanticCache.query(
+            {'model': 'm', 'messages': [{'role': 'system', 'content': 's'}, other]},
+            policy,
+        )[1]
+        == scope
+    )
+
+
+def test_cache_keys_are_fixed_size_digests_checked_for_collisions():
+    from openai_forward.cache.policy import CachePolicy, key_matches
+
+    policy = CachePolicy(key_fields=['model', 'messages'])
+    short = policy.make_key({'model': 'm', 'messages': [{'content': 'hi'}]})
+    long = policy.make_key({'model': 'm', 'messages': [{'content': 'x' * 100_000}]})
+    assert len(short) == len(long) == 16
+    assert short.payload == b'["m",[{"content":"hi"}]]'
+
+    assert key_matches({'payload': short.payload}, short)
+    # a value of another payload with the same digest is a miss
+    assert not key_matches({'payload': long.payload}, short)
+    assert key_matches({}, short) and key_matches({'payload': b'x'}, bytes(short))
+
+
+def test_cache_index_builds_in_background_and_saves_periodically(tmp_path):
+    from openai_forward.cache.admin import CacheIndex, value_size
+
+    value = {'route_path': '/r', 'model': 'm', 'created': 1.0, 'data': [b'xyz']}
+    store = {b'a': value, b'b': value}
+    index = CacheIndex(tmp_path / 'index', save_interval=0.02)
+    index.start(store)
+    # writes while the store is scanned are kept
+    index.discard(b'b')
+    index.add(b'c', '/r', 'm', 2.0, 10)
+    store[b'c'] = value
+    assert index.wait(1)
+    assert sorted(index.select(model='m')) == [b'a', b'c']
+    assert index.summary()[('/r', 'm')][1] >= 1 + value_size(value)
+    time.sleep(0.1)
+    index.stop()
+    assert (tmp_path / 'index').exists()
+
+    restarted = CacheIndex(tmp_path / 'index')
+    assert restarted.load(len(store))
+    assert b'c' in restarted.select(older_than=0)
+    assert not CacheIndex(tmp_path / 'index').load(len(store) + 1)
+
+
+def test_cache_key_version_is_checked_and_recorded(tmp_path):
+    from openai_forward.cache.database import check_key_version
+    from openai_forward.cache.policy import CACHE_KEY_VERSION
+
+    path = tmp_path / 'CACHE_DB.key_version'
+    assert check_key_version({}, path)
+    assert path.read_text() == str(CACHE_KEY_VERSION)
+    assert check_key_version({b'k': {}}, path)
+
+    path.write_text('2')
+    assert not check_key_version({b'k': {}}, path)
+    # the mismatch is only reported once
+    assert check_key_version({b'k': {}}, path)
+
+
+def test_cache_admin_stats_invalidation_and_snapshot():
+    import asyncio
+
+    from openai_forward.cache import load_records, store
+    from openai_forward.cache.admin import (
+        cache_index,
+        cache_stats,
+        export_snapshot,
+        import_snapshot,
+        invalidate,
+    )
+    from openai_forward.cache.database import db_dict
+
+    db_dict.clear()
+    old = time.time() - 3600
+    store(b'k1', {'model': 'a', 'created': old}, '/v1/chat/completions', 'a')
+    store(b'k2', {'model': 'b', 'created': time.time()}, '/v1/chat/completions', 'b')
+    store(b'k3', {'model': 'a', 'created': time.time()}, '/v1/embeddings', 'a')
+    cache_stats.hit('/v1/chat/completions', 'a')
+    cache_stats.miss('/v1/chat/completions', 'a')
+
+    report = cache_stats.report(cache_index)
+    chat_a = report['/v1/chat/completions']['a']
+    assert chat_a['items'] == 1 and chat_a['bytes'] > 0 and chat_a['hit_rate'] == 0.5
+
+    keys, hits = db_dict.keys(), db_dict.hits
+    snapshot = b''.join(export_snapshot())
+    # exporting neither counts hits nor reorders the LRU
+    assert db_dict.keys() == keys and db_dict.hits == hits
+    assert invalidate(older_than=60) == 1 and db_dict.get(b'k1') is None
+    assert invalidate(model='a') == 1 and db_dict.get(b'k3') is None
+    assert invalidate(route_path='/v1/chat/completions') == 1 and len(db_dict) == 0
+
+    async def stream():
+        for i in range(0, len(snapshot), 7):
+            yield snapshot[i : i + 7]
+
+    async def load(records):
+        load_records(records)
+
+    assert asyncio.run(import_snapshot(stream(), load, batch_size=2)) == 3
+    assert db_dict.get(b'k2')['model'] == 'b' and len(cache_index) == 3
+    db_dict.clear()
@@ -1,10 +1,15 @@
+import asyncio
 import importlib
+import time
 from unittest.mock import Mock
 
+import aiohttp
+import orjson
 import pytest
-from fastapi import Request
+from fastapi import HTTPException, Request
 
-from openai_forward.forward.core import GenericForward
+from openai_forward.forward import ForwardManager
+from openai_forward.forward.core import GenericForward, OpenaiForward
 
 
 @pytest.fixture(
@@ -106,3 +111,583 @@ def test_openai_forward_auth_handle(openai_forward):
     auth, model_set = openai_forward.handle_authorization(client_config)
     assert 'gpt-3.5-turbo' in model_set
     assert 'gpt-4' not in model_set
+
+
+def test_generic_forward_balances_multiple_base_urls():
+    generic_forward = GenericForward(['http://a.com', 'http://b.com'], '/test')
+    request = Mock(spec=Request)
+    request.headers = {'content-type': 'application/json'}
+    request.scope = {'root_path': '', 'path': '/test/123'}
+    request.url.query = 'x=1'
+    a, b = generic_forward.upstreams
+    a.observe(0.1)
+    b.observe(1.0)
+    for _ in range(5):
+        client_config = generic_forward.prepare_client(request)
+        assert client_config['url'] == 'http://a.com/123?x=1'
+
+    for _ in range(a.max_fails):
+        a.observe(0, ok=False)
+    assert not a.available
+    client_config = generic_forward.prepare_client(request)
+    assert client_config['url'] == 'http://b.com/123?x=1'
+
+
+def test_generic_forward_forwards_non_object_json_body():
+    generic_forward = GenericForward('http://a.com', '/test')
+    request = Mock(spec=Request)
+    request.method = 'POST'
+    request.headers = {'content-type': 'application/json'}
+    request.scope = {'root_path': '', 'path': '/test/items'}
+    request.url.query = ''
+
+    async def body():
+        return b'[1, 2, 3]'
+
+    request.body = body
+    sent = []
+
+    async def request_fn(method, url, data=None, **kwargs):
+        sent.append(data)
+        r = FakeResponse(url)
+        r.content = FakeContent([b'ok'])
+        return r
+
+    generic_forward.client = Mock(request=request_fn)
+
+    async def run():
+        response = await generic_forward.reverse_proxy(request)
+        return [chunk async for chunk in response.body_iterator]
+
+    assert asyncio.run(run()) == [b'ok']
+    assert sent == [b'[1, 2, 3]']
+
+
+def test_openai_forward_fk_to_sk_skips_exhausted_keys(openai_forward):
+    scheduler = openai_forward._key_scheduler
+    scheduler.update('sk1', 429, {'retry-after': '30'})
+    for _ in range(4):
+        sk, level = openai_forward.fk_to_sk('fk0')
+        assert sk == 'sk4'
+
+    scheduler.update(
+        'sk2',
+        200,
+        {'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '6m0s'},
+    )
+    sk, level = openai_forward.fk_to_sk('fk1')
+    assert sk == 'sk1'  # every level 1 key is cooling down, sk1 recovers first
+
+
+def test_forward_manager_creates_openai_route_with_options():
+    objs, root = ForwardManager._create_forward_obj(
+        [
+            {
+                'base_url': 'http://a.com',
+                'route': '/openai',
+                'type': 'openai',
+                'hedge': {'max_delay': 0.05},
+            }
+        ],
+        OpenaiForward,
+    )
+    assert root is None and len(objs) == 1
+    assert isinstance(objs[0], OpenaiForward) and objs[0].hedge is not None
+
+
+class FakeResponse:
+    def __init__(self, url, status=200):
+        self.url = url
+        self.status = status
+        self.ok = status < 400
+        self.headers = {}
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class FakeContent:
+    def __init__(self, chunks, delay=0):
+        self.chunks = list(chunks)
+        self.delay = delay
+
+    async def readany(self):
+        await asyncio.sleep(self.delay)
+        return self.chunks.pop(0) if self.chunks else b''
+
+    async def readchunk(self):
+        chunk = await self.readany()
+        return chunk, bool(chunk)
+
+
+def test_generic_forward_hedges_slow_request():
+    generic_forward = GenericForward(
+        ['http://a.com', 'http://b.com'],
+        '/test',
+        hedge={'max_delay': 0.05, 'budget': 1},
+    )
+    calls = []
+
+    async def request(method, url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return FakeResponse(url)
+
+    generic_forward.client = Mock(request=request)
+    client_config = {
+        'method': 'POST',
+        'headers': {},
+        'path_qs': '/v1/embeddings',
+        'stream': False,
+    }
+    generic_forward.select_upstream(client_config)
+
+    r = asyncio.run(generic_forward.send(client_config, data=b'{}'))
+    assert len(calls) == 2 and calls[0] != calls[1]
+    assert r.url == calls[1] == client_config['url']
+    assert generic_forward.hedge.hedge_wins == 1
+    assert all(u.inflight == 0 for u in generic_forward.upstreams)
+
+
+def test_generic_forward_fails_fast_when_circuit_is_open():
+    generic_forward = GenericForward(
+        'http://a.com', '/test', circuit_breaker={'max_fails': 1, 'fail_timeout': 60}
+    )
+    calls = []
+
+    async def request(method, url, **kwargs):
+        calls.append(url)
+        raise aiohttp.ServerDisconnectedError()
+
+    generic_forward.client = Mock(request=request)
+    client_config = {'method': 'POST', 'headers': {}, 'path_qs': '/v1/embeddings'}
+    generic_forward.select_upstream(client_config)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(generic_forward.send(client_config, data=b'{}'))
+    assert exc_info.value.status_code == 503
+    assert len(calls) == 1
+    assert generic_forward.stats()['upstreams'][0]['state'] == 'open'
+
+
+def test_openai_forward_retries_status_with_another_key(openai_forward):
+    responses = [FakeResponse('', status=429), FakeResponse('', status=200)]
+    responses[0].headers = {'retry-after': '0'}
+    auths = []
+
+    async def request(method, url, headers, **kwargs):
+        auths.append(headers['Authorization'])
+        return responses[len(auths) - 1]
+
+    openai_forward.client = Mock(request=request)
+    client_config = {
+        'method': 'POST',
+        'headers': {'authorization': 'Bearer fk0'},
+        'path_qs': '/v1/chat/completions',
+        'fk': 'fk0',
+    }
+    openai_forward.select_upstream(client_config)
+
+    r = asyncio.run(openai_forward.send(client_config, data=b'{}'))
+    assert r.status == 200
+    assert responses[0].released
+    assert sorted(auths) == ['Bearer sk1', 'Bearer sk4']
+    assert client_config['headers'] == {'Authorization': auths[1]}
+
+
+def test_openai_forward_does_not_retry_streamed_body(openai_forward):
+    from openai_forward.forward.body import peek_body
+
+    chunks = [
+        b'--x\r\nContent-Disposition: form-data; name="model"\r\n\r\nwhisper-1\r\n'
+    ]
+    chunks += [b'0' * 1024] * 4
+
+    async def receive():
+        body = chunks.pop(0) if chunks else b''
+        return {'type': 'http.request', 'body': body, 'more_body': bool(chunks)}
+
+    request = Request({'type': 'http', 'method': 'POST', 'headers': []}, receive)
+    calls = []
+
+    async def request_fn(method, url, headers, data=None, **kwargs):
+        calls.append(b''.join([chunk async for chunk in data]))
+        return FakeResponse('', status=503)
+
+    openai_forward.client = Mock(request=request_fn)
+    client_config = {
+        'method': 'POST',
+        'headers': {'authorization': 'Bearer fk0'},
+        'path_qs': '/v1/audio/transcriptions',
+        'fk': 'fk0',
+    }
+    openai_forward.select_upstream(client_config)
+
+    async def pipe():
+        body = await peek_body(request, size=1024)
+        assert not body.complete
+        assert body.form_field('model') == 'whisper-1'
+        return await openai_forward.send(client_config, data=body.stream())
+
+    r = asyncio.run(pipe())
+    assert r.status == 503
+    assert len(calls) == 1
+    assert calls[0].endswith(b'0' * 4 * 1024) and len(calls[0]) == 64 + 4 * 1024
+
+
+def test_pump_streams_through_stages():
+    from openai_forward.forward.pump import ChunkCapture, TokenPacer, pump
+
+    r = FakeResponse('')
+    r.content = FakeContent([b'b', b'c'])
+    capture = ChunkCapture()
+
+    async def consume():
+        stages = [TokenPacer(0.05), capture]
+        return [chunk async for chunk in pump(r, stages, prefetched=b'a')]
+
+    start = time.perf_counter()
+    assert asyncio.run(consume()) == [b'a', b'b', b'c']
+    assert time.perf_counter() - start >= 0.1
+    assert capture.completed
+    assert capture.data == b'abc'
+
+
+def test_sse_parser_accumulates_split_events():
+    from openai_forward.content.helper import SSEParser
+    from openai_forward.content.openai import ChatAccumulator
+
+    events = [
+        {'choices': [{'delta': {'role': 'assistant', 'content': ''}}]},
+        {'choices': [{'delta': {'content': 'Hello'}}]},
+        {'choices': [{'delta': {'content': ', world'}}]},
+        {'choices': [], 'usage': {'total_tokens': 9}},
+    ]
+    stream = b''.join(b'data: ' + orjson.dumps(e) + b'\n\n' for e in events)
+    stream += b'data: [DONE]\n\n'
+
+    parser, accumulator = SSEParser(), ChatAccumulator()
+    for i in range(0, len(stream), 7):
+        for data in parser.feed(stream[i : i + 7]):
+            accumulator.feed(data)
+    assert accumulator.result() == {
+        'assistant': 'Hello, world',
+        'is_tool_calls': False,
+        'usage': {'total_tokens': 9},
+    }
+
+
+def test_completion_logger_parses_stream():
+    from openai_forward.content.openai import CompletionLogger
+
+    events = [{'choices': [{'text': 'Hel'}]}, {'choices': [{'text': 'lo'}]}]
+    stream = b''.join(b'data: ' + orjson.dumps(e) + b'\n\n' for e in events)
+    stream += b'data: [DONE]\n\n'
+
+    completion_logger = CompletionLogger('/openai')
+    assert completion_logger.parse_bytearray(bytearray(stream)) == {'text': 'Hello'}
+    assert completion_logger.parse_bytearray(orjson.dumps(events[0])) == {'text': 'Hel'}
+
+
+def test_forwards_share_clients_of_the_same_host():
+    from openai_forward.forward.pool import ClientRegistry
+
+    a = GenericForward('https://api.test.com/v1', '/a')
+    b = GenericForward(['https://api.test.com', 'https://other.test.com'], '/b')
+
+    async def build():
+        registry = ClientRegistry()
+        await a.build_client(registry)
+        await b.build_client(registry)
+        await registry.close()
+        return registry
+
+    asyncio.run(build())
+    assert a.client is b.client
+    assert b.upstreams.upstreams[1].client is not a.client
+
+
+def test_pool_warm_up_opens_keep_alive_connections():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from openai_forward.forward.pool import ClientRegistry, PoolProfile
+
+    async def handle(request):
+        # without a length the client can not reuse the connection of a HEAD response
+        return web.Response(headers={'Content-Length': '0'})
+
+    app = web.Application()
+    app.router.add_route('*', '/', handle)
+
+    async def run():
+        server = TestServer(app)
+        await server.start_server()
+        base_url = str(server.make_url('/'))
+        registry = ClientRegistry()
+        try:
+            registry.get(base_url, profile=PoolProfile(limit=10, warmup=3))
+            await registry.warm_up()
+            return registry.to_dict()[base_url]
+        finally:
+            await registry.close()
+            await server.close()
+
+    occupancy = asyncio.run(run())
+    assert occupancy == {'limit': 10, 'limit_per_host': 0, 'in_use': 0, 'idle': 3}
+    assert PoolProfile.occupancy(None) == {}
+
+
+def test_release_after_frees_the_key_once_on_disconnect(openai_forward, monkeypatch):
+    import gc
+
+    scheduler = Mock()
+    monkeypatch.setattr(type(openai_forward), '_key_scheduler', scheduler)
+
+    async def body():
+        for chunk in (b'a', b'b', b'c'):
+            yield chunk
+
+    async def run():
+        r = FakeResponse('')
+        client_config = {'key_acquired': True, 'sk': 'sk1', 'cost': 3}
+        stream = openai_forward.release_after(body(), client_config, r)
+        assert await stream.__anext__() == b'a'
+        # the client disconnects mid-stream
+        await stream.aclose()
+        assert r.released
+
+        # a body that is never consumed
+        never = {'key_acquired': True, 'sk': 'sk2', 'cost': 0}
+        openai_forward.release_after(body(), never)
+        gc.collect()
+
+    asyncio.run(run())
+    assert [c.args for c in scheduler.release.call_args_list] == [
+        ('sk1', 3),
+        ('sk2', 0),
+    ]
+
+
+def test_singleflight_fans_out_chunks_to_followers():
+    from openai_forward.forward.singleflight import SingleFlight
+
+    flights = SingleFlight()
+
+    async def follow():
+        flight, leader = flights.join('key')
+        assert not leader
+        await flight.wait_ready()
+        return [chunk async for chunk in flight.iter_chunks()]
+
+    async def run():
+        flight, leader = flights.join('key')
+        assert leader
+        followers = [asyncio.create_task(follow()) for _ in range(3)]
+        await asyncio.sleep(0)
+        flight.start(200, 'text/event-stream')
+        for chunk in (b'data: 1\n\n', b'data: 2\n\n'):
+            flight.feed(chunk)
+            await asyncio.sleep(0)
+        flight.close(True)
+        return await asyncio.gather(*followers), flight
+
+    results, flight = asyncio.run(run())
+    assert results == [[b'data: 1\n\n', b'data: 2\n\n']] * 3
+    assert flight.followers == 3
+    assert len(flights) == 0
+
+
+def test_singleflight_drains_for_followers_when_leader_leaves():
+    from openai_forward.forward.pump import pump
+    from openai_forward.forward.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    r = FakeResponse('')
+    r.content = FakeContent([b'b', b'c', b'd'], delay=0.01)
+
+    async def follow():
+        flight, _ = flights.join('key')
+        await flight.wait_ready()
+        return b''.join([chunk async for chunk in flight.iter_chunks()])
+
+    async def run():
+        flight, _ = flights.join('key')
+        follower = asyncio.create_task(follow())
+        await asyncio.sleep(0)
+        flight.start(200, 'text/event-stream', r, prefetched=b'a')
+        body = pump(r, [flight], prefetched=b'a')
+        assert await body.__anext__() == b'a'
+        # the client of the leading request disconnects
+        await body.aclose()
+        return await follower, flight
+
+    data, flight = asyncio.run(run())
+    assert data == b'abcd'
+    assert flight.completed and r.released
+    assert len(flights) == 0
+
+
+def test_singleflight_stops_draining_once_followers_are_gone():
+    from openai_forward.forward.singleflight import SingleFlight
+
+    flights = SingleFlight()
+    r = FakeResponse('')
+    r.content = FakeContent([b'b', b'c', b'd', b'e'], delay=0.01)
+
+    async def run():
+        flight, _ = flights.join('key')
+        flights.join('key')
+        assert flight.followers == 1
+        flight.start(200, 'text/event-stream', r)
+        follower = flight.follow()
+        # the leading client disconnects, then the follower after one chunk
+        flight.close(False)
+        assert await follower.__anext__() == b'b'
+        await follower.aclose()
+        assert flight.followers == 0
+        await asyncio.sleep(0.1)
+        return flight
+
+    flight = asyncio.run(run())
+    assert flight.done and not flight.completed
+    assert r.released and r.content.chunks
+    assert len(flights) == 0
+
+
+def test_singleflight_keeps_reading_body_when_leader_is_cancelled():
+    from openai_forward.forward.singleflight import SingleFlight
+
+    class SlowResponse(FakeResponse):
+        async def read(self):
+            await asyncio.sleep(0.02)
+            return b'{"ok": true}'
+
+    flights = SingleFlight()
+    r = SlowResponse('')
+
+    async def lead(flight):
+        try:
+            flight.feed(await flight.read())
+            flight.close(True)
+        finally:
+            flight.close(False)
+
+    async def run():
+        flight, _ = flights.join('key')
+        flights.join('key')
+        flight.start(200, 'application/json', r)
+        leader = asyncio.create_task(lead(flight))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        return b''.join([chunk async for chunk in flight.iter_chunks()]), flight
+
+    data, flight = asyncio.run(run())
+    assert data == b'{"ok": true}'
+    assert flight.completed
+
+
+def test_openai_forward_flights_depend_on_response_shape(openai_forward):
+    flight, leader = openai_forward.join_flight(b'key', True, (True, None))
+    assert leader
+    assert openai_forward.join_flight(b'key', True, (False, None))[1]
+    assert openai_forward.join_flight(b'key', True, (False, 'base64'))[1]
+    assert openai_forward.join_flight(b'key', True, (True, None)) == (flight, False)
+    assert openai_forward.join_flight(b'key', False, (True, None)) == (None, True)
+
+
+def test_openai_forward_revalidates_stale_key_once(openai_forward):
+    refreshed = []
+
+    async def revalidate(client_config, payload, payload_info, cache_key, request):
+        await asyncio.sleep(0.01)
+        refreshed.append(cache_key)
+
+    openai_forward._revalidate = revalidate
+
+    async def run():
+        for _ in range(3):
+            openai_forward.revalidate({}, b'{}', {}, b'key', None)
+        assert openai_forward.stats()['revalidating'] == 1
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert refreshed == [b'key']
+    assert openai_forward.revalidations == {}
+
+
+def test_revalidation_is_not_paced_by_the_client(openai_forward, monkeypatch):
+    from openai_forward.forward import core
+    from openai_forward.forward.pump import ChunkCapture, TokenPacer
+
+    monkeypatch.setattr(core, 'get_token_interval', lambda *args: 0.5)
+    capture = ChunkCapture()
+    stages = openai_forward.build_stages(None, capture)
+    assert isinstance(stages[0], TokenPacer) and stages[1] is capture
+    assert openai_forward.build_stages(None, capture, paced=False) == [capture]
+
+    r = FakeResponse('')
+    r.content = FakeContent([b'data: 1\n\n', b'data: 2\n\n', b'data: 3\n\n'])
+
+    async def send(client_config, data=None):
+        return r
+
+    openai_forward.send = send
+    client_config = {'route_path': '/v1/chat/completions', 'stream': True}
+    start = time.perf_counter()
+    asyncio.run(
+        openai_forward._revalidate(client_config, b'{}', {'uid': ''}, None, Mock())
+    )
+    assert time.perf_counter() - start < 0.5
+    assert r.released and not r.content.chunks
+
+
+def test_embedding_batcher_scatters_one_upstream_call():
+    from openai_forward.forward.batching import EmbeddingBatcher
+
+    batcher = EmbeddingBatcher(max_wait=0.01, max_inputs=8)
+    sent = []
+
+    async def send(data):
+        body = orjson.loads(data)
+        sent.append(body['input'])
+        return (
+            200,
+            'application/json',
+            orjson.dumps(
+                {
+                    'object': 'list',
+                    'data': [
+                        {'object': 'embedding', 'index': i, 'embedding': [float(i)]}
+                        for i in range(len(body['input']))
+                    ],
+                    'model': body['model'],
+                    'usage': {'prompt_tokens': 6, 'total_tokens': 6},
+                }
+            ),
+        )
+
+    async def run():
+        requests = [
+            {'model': 'm', 'input': 'aa'},
+            {'model': 'm', 'input': ['bb', 'aa']},
+            {'model': 'm', 'input': 'cc'},
+        ]
+        return await asyncio.gather(
+            *(batcher.submit(body, ('level', 1), send) for body in requests)
+        )
+
+    results = asyncio.run(run())
+    assert sent == [['aa', 'bb', 'cc']]
+    bodies = [orjson.loads(body) for _, _, body in results]
+    assert [[d['embedding'] for d in b['data']] for b in bodies] == [
+        [[0.0]],
+        [[1.0], [0.0]],
+        [[2.0]],
+    ]
+    assert [d['index'] for d in bodies[1]['data']] == [0, 1]
+    assert [b['usage']['prompt_tokens'] for b in bodies] == [2, 4, 2]
+    assert batcher.to_dict()['batches'] == 1
+    assert OpenaiForward('http://a.com', '/test', embedding_batch={}).batcher